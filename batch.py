@@ -0,0 +1,305 @@
+"""
+Batches of item creations, updates and deletions applied in one
+transaction.
+
+A batch is a list of operations:
+
+    {"op": "create", "name": ..., "description": ..., "picture": ...,
+     "category": <category name>}
+    {"op": "update", "item": <item name>, "name": ..., "description": ...,
+     "picture": ..., "category": ...}
+    {"op": "delete", "item": <item name>}
+
+Updates only change the fields given with a non-empty value, like the edit
+form. The categories and items named anywhere in the batch are loaded with
+one query each, then the operations are checked in order against that
+state, so an operation sees the items created, renamed or deleted by the
+ones before it. The rows are then written with one DELETE, one executemany
+UPDATE per set of changed columns and one executemany INSERT. The slug of
+an item follows its name, numbered when taken, see slugs.py, and the result
+of each valid operation gives it. The ownership rules are those of the
+views: any user may create items, an item is updated by the user who
+created it, and deleted by the owner of its category.
+
+Either every operation is valid and the caller commits them all, or none
+is applied and the result of each operation tells what was wrong.
+"""
+from collections import namedtuple
+
+from sqlalchemy import delete, insert, select, update
+
+from database_setup import Category, Item
+from slugs import free_slugs
+
+# operations accepted in one batch
+MAX_OPERATIONS = 1000
+# longest names, descriptions and picture URLs, as in the forms
+MAX_LENGTH = 250
+# names per IN (...) lookup, below the bound parameter limit of SQLite
+LOOKUP_CHUNK = 500
+
+OPERATIONS = ('create', 'update', 'delete')
+FIELDS = ('name', 'description', 'picture', 'category')
+
+# results holds one dict per operation; scopes the cache scopes to bump
+# and pictures the (picture URL, item slug) pairs to fetch once committed
+BatchResult = namedtuple('BatchResult', ['ok', 'results', 'scopes',
+                                         'pictures'])
+
+CategoryRow = namedtuple('CategoryRow', ['id', 'name', 'user_id', 'slug'])
+
+
+class InvalidBatch(Exception):
+    """raised when the batch isn't a list of operations"""
+
+
+class _ItemState(object):
+    """an item as the operations checked so far left it"""
+
+    __slots__ = ('id', 'name', 'slug', 'user_id', 'category', 'changes')
+
+    def __init__(self, id, name, slug, user_id, category):
+        # None for the items created by the batch
+        self.id = id
+        # None once deleted
+        self.name = name
+        # None for the created items until the batch is checked
+        self.slug = slug
+        self.user_id = user_id
+        self.category = category
+        # columns to write, every column for a created item
+        self.changes = {}
+
+
+def _chunks(names):
+    names = sorted(names)
+    for start in range(0, len(names), LOOKUP_CHUNK):
+        yield names[start:start + LOOKUP_CHUNK]
+
+
+def _check_fields(operation):
+    """Return the error of the fields of an operation, None when valid"""
+    for field in ('item',) + FIELDS:
+        value = operation.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            return '%s must be a string' % field
+        if len(value) > MAX_LENGTH:
+            return '%s is longer than %d characters' % (field, MAX_LENGTH)
+    return None
+
+
+def target(operation):
+    """Return the name of the item an operation is about"""
+    if operation.get('op') == 'create':
+        return operation.get('name')
+    return operation.get('item')
+
+
+def apply_batch(session, operations, user_id):
+    """
+    Check a batch of operations and, when they are all valid, write them in
+    the session's transaction without committing.
+    :param session: database session
+    :param operations: list of operation dicts, see the module docstring
+    :param user_id: id of the logged-in user
+    :return: a BatchResult
+    :raise InvalidBatch: when operations isn't a list of at most
+        MAX_OPERATIONS dicts
+    :raise IntegrityError: when the rows conflict with rows written by
+        another request since they were read
+    """
+    if not isinstance(operations, list) or \
+            not all(isinstance(op, dict) for op in operations):
+        raise InvalidBatch('Expected a list of operations')
+    if len(operations) > MAX_OPERATIONS:
+        raise InvalidBatch('At most %d operations per batch'
+                           % MAX_OPERATIONS)
+
+    category_names = set()
+    item_names = set()
+    for operation in operations:
+        for field in ('item', 'name'):
+            if isinstance(operation.get(field), str):
+                item_names.add(operation[field])
+        if isinstance(operation.get('category'), str):
+            category_names.add(operation['category'])
+    categories = {}
+    for names in _chunks(category_names):
+        for row in session.execute(
+                select(Category.id, Category.name, Category.user_id,
+                       Category.slug)
+                .where(Category.name.in_(names))):
+            categories[row.name] = CategoryRow(*row)
+    # the names taken by an item, None once deleted or renamed in this
+    # batch: a name given up is not taken again by the same batch, so the
+    # rows can be written in any order without breaking unique names
+    items = {}
+    for names in _chunks(item_names):
+        for row in session.execute(
+                select(Item.id, Item.name, Item.slug, Item.user_id,
+                       Category.id, Category.name, Category.user_id,
+                       Category.slug)
+                .join(Category, Item.category_id == Category.id)
+                .where(Item.name.in_(names))):
+            items[row[1]] = _ItemState(row[0], row[1], row[2], row[3],
+                                       CategoryRow(*row[4:]))
+
+    results = []
+    # (result, _ItemState) of the create operations
+    created = []
+    # (result, _ItemState) of every valid operation
+    touched = []
+    deleted = []
+    scopes = set()
+    pictures = []
+    ok = True
+    for operation in operations:
+        kind = operation.get('op')
+        result = {'op': kind, 'item': target(operation)}
+        results.append(result)
+        invalid = _check_fields(operation)
+        if kind not in OPERATIONS:
+            error = 400, 'op must be one of %s' % ', '.join(OPERATIONS)
+        elif invalid is not None:
+            error = 400, invalid
+        elif kind == 'create':
+            error = _create(operation, user_id, categories, items, result,
+                            created)
+        elif kind == 'update':
+            error = _update(operation, user_id, categories, items, result)
+        else:
+            error = _delete(operation, user_id, items, result, deleted)
+        if error is not None:
+            ok = False
+            result['status'], result['error'] = error
+            continue
+        scopes.update(result.pop('scopes'))
+        if kind != 'delete':
+            state = items[result['item']]
+            touched.append((result, state))
+            if operation.get('picture'):
+                pictures.append((operation['picture'], state))
+    if not ok:
+        return BatchResult(False, results, [], [])
+
+    # the created and renamed items get the first free slug of their name
+    named = [(name, state) for name, state in items.items()
+             if state is not None and
+             (state.id is None or 'name' in state.changes)]
+    slugs = free_slugs(session, Item.__table__,
+                       [name for name, state in named],
+                       dict((name, state.id) for name, state in named
+                            if state.id is not None))
+    for name, state in named:
+        state.slug = state.changes['slug'] = slugs[name]
+        scopes.add('item:' + state.slug)
+    for result, state in touched:
+        result['slug'] = state.slug
+    pictures = [(picture, state.slug) for picture, state in pictures]
+
+    if deleted:
+        session.execute(delete(Item).where(Item.id.in_(deleted)))
+    inserted = []
+    changed = {}
+    for name, state in items.items():
+        if state is None or not state.changes:
+            continue
+        if state.id is None:
+            inserted.append(dict(state.changes, name=name))
+        else:
+            # one executemany per set of changed columns
+            columns = tuple(sorted(state.changes))
+            changed.setdefault(columns, []).append(
+                dict(state.changes, id=state.id))
+    for rows in changed.values():
+        session.execute(update(Item), rows)
+    ids = {}
+    if inserted:
+        session.execute(insert(Item), inserted)
+        for names in _chunks([row['name'] for row in inserted]):
+            ids.update(session.execute(
+                select(Item.name, Item.id).where(Item.name.in_(names)))
+                .all())
+    for result, state in created:
+        # None when a later operation of the batch deleted it
+        result['id'] = ids.get(state.name)
+    scopes.add('items')
+    return BatchResult(True, results, sorted(scopes), pictures)
+
+
+def _create(operation, user_id, categories, items, result, created):
+    name = operation.get('name')
+    if not name:
+        return 400, 'name is required'
+    if operation.get('item') is not None:
+        return 400, 'item is only given to update and delete'
+    if name in items:
+        return 409, 'An item called %s already exists' % name
+    category = categories.get(operation.get('category'))
+    if category is None:
+        return 404, 'No category called %s' % operation.get('category')
+    state = items[name] = _ItemState(None, name, None, user_id, category)
+    created.append((result, state))
+    state.changes.update(description=operation.get('description'),
+                         picture=operation.get('picture'),
+                         category_id=category.id,
+                         user_id=user_id)
+    result.update(status=201, scopes=['category:' + category.slug])
+    return None
+
+
+def _update(operation, user_id, categories, items, result):
+    name = operation.get('item')
+    state = items.get(name) if name else None
+    if state is None:
+        return 404, 'No item called %s' % name
+    if state.user_id != user_id:
+        return 403, 'You do not have the privilege to edit %s' % name
+    new_name = operation.get('name')
+    if new_name == name:
+        new_name = None
+    if new_name and new_name in items:
+        return 409, 'An item called %s already exists' % new_name
+    category = None
+    if operation.get('category'):
+        category = categories.get(operation['category'])
+        if category is None:
+            return 404, 'No category called %s' % operation['category']
+
+    scopes = ['category:' + state.category.slug]
+    # the items created by the batch get their slug once it is checked
+    if state.slug is not None:
+        scopes.append('item:' + state.slug)
+    if new_name:
+        items[new_name] = state
+        items[name] = None
+        state.name = state.changes['name'] = new_name
+        result['item'] = new_name
+    for field in ('description', 'picture'):
+        if operation.get(field):
+            state.changes[field] = operation[field]
+    if category is not None:
+        state.category = category
+        state.changes['category_id'] = category.id
+        scopes.append('category:' + category.slug)
+    result.update(status=200, scopes=scopes)
+    return None
+
+
+def _delete(operation, user_id, items, result, deleted):
+    name = operation.get('item')
+    state = items.get(name) if name else None
+    if state is None:
+        return 404, 'No item called %s' % name
+    if state.category.user_id != user_id:
+        return 403, 'You do not have the privilege to delete %s' % name
+    if state.id is not None:
+        deleted.append(state.id)
+    items[name] = state.name = None
+    scopes = ['category:' + state.category.slug]
+    if state.slug is not None:
+        scopes.append('item:' + state.slug)
+    result.update(status=200, slug=state.slug, scopes=scopes)
+    return None
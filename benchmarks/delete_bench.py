@@ -0,0 +1,71 @@
+"""
+Time deleting a large category item by item, the way deleteCategory used
+to, against the single bulk DELETE it uses now. The item by item loop grows
+quadratically, as every commit expires the items still waiting, so keep
+--items modest.
+
+Usage:
+    python -m benchmarks.delete_bench --items 5000
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.synthetic import build_catalog
+from database_setup import Category, Item, get_engine
+
+
+def delete_item_by_item(session, category):
+    """the former deleteCategory loop, one commit per item"""
+    for item in session.query(Item).filter_by(category=category).all():
+        session.delete(item)
+        session.commit()
+    session.delete(category)
+    session.commit()
+
+
+def delete_in_bulk(session, category):
+    """the current deleteCategory, one transaction"""
+    session.query(Item).filter_by(category_id=category.id)\
+        .delete(synchronize_session=False)
+    session.delete(category)
+    session.commit()
+
+
+def timed_delete(path, strategy):
+    engine = get_engine('sqlite:///' + path)
+    session = sessionmaker(bind=engine)()
+    category = session.query(Category).filter_by(name='Category 0').one()
+    started = time.time()
+    strategy(session, category)
+    elapsed = time.time() - started
+    session.close()
+    engine.dispose()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--items', type=int, default=5000,
+                        help='number of items in the deleted category')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'source.db')
+    build_catalog('sqlite:///' + source, args.items, categories=1).dispose()
+
+    for strategy in (delete_item_by_item, delete_in_bulk):
+        path = os.path.join(directory, strategy.__name__ + '.db')
+        shutil.copyfile(source, path)
+        print("%s: %.2fs for %d items"
+              % (strategy.__name__, timed_delete(path, strategy),
+                 args.items))
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,424 @@
+"""
+Load test of every route of views.py on a synthetic catalog.
+
+Each route is requested --requests times, anonymously and logged in where
+both make sense, first through the Flask test client and then over HTTP
+against a threaded WSGI server with --concurrency client threads. The write
+routes work on categories and items the run creates for itself. For every
+route the report gives the p50 and p99 latency, the requests per second and
+the SQL queries run per request; --report saves it as JSON and --compare
+prints the change against an earlier report.
+
+gconnect and fbconnect are only requested with a wrong state token, which
+they reject before calling the providers, and fbdisconnect is left out as
+it always calls Facebook.
+
+Usage:
+    python -m benchmarks.route_bench --items 100000 --report run.json
+    python -m benchmarks.route_bench --reuse --url sqlite:///bench.db \\
+        --compare run.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from sqlalchemy import event, text
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+# session of the logged-in user, the owner of the categories the run creates
+LOGIN = {'username': 'Benchmark User 1', 'email': 'bench1@example.com',
+         'picture': '', 'user_id': 1, 'provider': 'google',
+         'state': 'benchmark'}
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+class QueryCounter(object):
+    """Counts the statements sent to the database by an engine"""
+
+    def __init__(self, engine):
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def read_routes(app, connection, rng, count):
+    """
+    Return (name, logged in, [(method, url, form)]) for the read routes,
+    with categories, items and cursors drawn at random from the catalog.
+    The edit and delete forms get items of categories of the logged-in
+    user, so they render instead of redirecting.
+    """
+    from flask import url_for
+    from pagination import encode_cursor
+
+    categories = [row[0] for row in connection.execute(
+        text('SELECT name FROM category'))]
+    max_id = connection.execute(text('SELECT MAX(id) FROM item')).scalar()
+    items = []
+    while len(items) < count:
+        row = connection.execute(text(
+            'SELECT item.id, item.name, category.slug, item.slug FROM item '
+            'JOIN category ON category.id = item.category_id '
+            'WHERE item.id >= :id ORDER BY item.id LIMIT 1'),
+            {'id': rng.randint(1, max_id)}).first()
+        if row is not None:
+            items.append(row)
+    owned = connection.execute(text(
+        'SELECT item.id, item.name, category.slug, item.slug FROM item '
+        'JOIN category ON category.id = item.category_id '
+        'WHERE item.user_id = :user AND category.user_id = :user '
+        'LIMIT 1000'), {'user': LOGIN['user_id']}).fetchall()
+    owned = [rng.choice(owned) for _ in range(count)] if owned else items
+
+    def urls(build, rows=items):
+        with app.test_request_context():
+            return [('GET', build(row), None) for row in rows]
+
+    pages = [
+        ('catalog', lambda i: url_for('showCatalog')),
+        ('catalog deep page', lambda i: url_for(
+            'showCatalog', cursor=encode_cursor(i[1], i[0]))),
+        ('category', lambda i: url_for('showCategory', categorySlug=i[2])),
+        ('category deep page', lambda i: url_for(
+            'showCategory', categorySlug=i[2],
+            cursor=encode_cursor(i[1], i[0]))),
+        ('item', lambda i: url_for('showItem', categorySlug=i[2],
+                                   itemSlug=i[3])),
+        ('search', lambda i: url_for('showSearch', q=i[1].split()[0])),
+    ]
+    apis = [
+        ('categories JSON', lambda i: url_for('showCategoriesJSON')),
+        ('category JSON', lambda i: url_for('showCategoryJSON',
+                                            categorySlug=i[2])),
+        ('items JSON', lambda i: url_for('showItemsJSON')),
+        ('items JSON deep page', lambda i: url_for(
+            'showItemsJSON', cursor=encode_cursor(i[1], i[0]))),
+        ('item JSON', lambda i: url_for('showItemJSON', categorySlug=i[2],
+                                        itemSlug=i[3])),
+        ('search JSON', lambda i: url_for('showSearchJSON',
+                                          q=i[1].split()[0])),
+        ('cache stats', lambda i: url_for('showCacheStats')),
+        ('metrics', lambda i: url_for('showMetrics')),
+    ]
+    forms = [
+        ('add category form', lambda i: url_for('addCategory')),
+        ('edit category form', lambda i: url_for('editCategory',
+                                                 categorySlug=i[2])),
+        ('delete category form', lambda i: url_for('deleteCategory',
+                                                   categorySlug=i[2])),
+        ('add item form', lambda i: url_for('addItem')),
+        ('edit item form', lambda i: url_for('editItem', categorySlug=i[2],
+                                             itemSlug=i[3])),
+        ('delete item form', lambda i: url_for(
+            'deleteItem', categorySlug=i[2], itemSlug=i[3])),
+    ]
+    routes = []
+    for name, build in pages + apis:
+        routes.append((name, False, urls(build)))
+        routes.append((name, True, urls(build)))
+    for name, build in forms:
+        routes.append((name, True, urls(build, owned)))
+    with app.test_request_context():
+        routes.append(('login', False, [('GET', url_for('showLogin'), None)]
+                       * count))
+        routes.append(('disconnect', False,
+                       [('GET', url_for('disconnect'), None)] * count))
+        routes.append(('gdisconnect', False,
+                       [('GET', url_for('gdisconnect'), None)] * count))
+        for endpoint in ('gconnect', 'fbconnect'):
+            routes.append((endpoint + ' bad state', True, [
+                ('POST', url_for(endpoint, state='wrong'), None)] * count))
+    return routes
+
+
+def write_routes(app, run, count):
+    """
+    Return (name, logged in, [(method, url, form)]) for the write routes,
+    in an order where every step works on what the previous ones created:
+    add, rename and delete categories, and add, edit and delete items in
+    them.
+    :param run: tag making the names of this run unique
+    """
+    from flask import url_for
+    from slugs import slugify
+
+    names = ['Bench %s %d' % (run, n) for n in range(count)]
+    steps = dict((step, []) for step in (
+        'add category', 'edit category', 'add item', 'edit item',
+        'delete item', 'delete category'))
+    with app.test_request_context():
+        for name in names:
+            renamed = name + ' renamed'
+            item = name + ' item'
+            steps['add category'].append(
+                ('POST', url_for('addCategory'), {'name': name}))
+            steps['edit category'].append(
+                ('POST', url_for('editCategory',
+                                 categorySlug=slugify(name)),
+                 {'name': renamed}))
+            steps['add item'].append(
+                ('POST', url_for('addItem'),
+                 {'name': item, 'description': 'benchmark item',
+                  'picture': '', 'category': renamed}))
+            steps['edit item'].append(
+                ('POST', url_for('editItem',
+                                 categorySlug=slugify(renamed),
+                                 itemSlug=slugify(item)),
+                 {'name': '', 'description': 'edited', 'picture': '',
+                  'category': ''}))
+            steps['delete item'].append(
+                ('POST', url_for('deleteItem',
+                                 categorySlug=slugify(renamed),
+                                 itemSlug=slugify(item)), {}))
+            steps['delete category'].append(
+                ('POST', url_for('deleteCategory',
+                                 categorySlug=slugify(renamed)),
+                 {}))
+    return [(step, True, steps[step]) for step in (
+        'add category', 'edit category', 'add item', 'edit item',
+        'delete item', 'delete category')]
+
+
+class TestClientDriver(object):
+    """Sends the requests through the Flask test client, one at a time"""
+
+    mode = 'test client'
+
+    def __init__(self, app):
+        self.anonymous = app.test_client()
+        self.logged_in = app.test_client()
+        with self.logged_in.session_transaction() as session:
+            session.update(LOGIN)
+
+    def run(self, requests_, logged_in):
+        client = self.logged_in if logged_in else self.anonymous
+        timings, statuses = [], {}
+        started = time.perf_counter()
+        for method, url, form in requests_:
+            sent = time.perf_counter()
+            response = client.open(url, method=method, data=form)
+            response.get_data()
+            response.close()
+            timings.append((time.perf_counter() - sent) * 1000)
+            statuses[response.status_code] = \
+                statuses.get(response.status_code, 0) + 1
+        return timings, statuses, time.perf_counter() - started
+
+    def close(self):
+        pass
+
+
+class Handler(WSGIRequestHandler):
+    # keep-alive, so the timings are not dominated by new connections
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class ServerDriver(object):
+    """Sends the requests over HTTP to a threaded WSGI server"""
+
+    mode = 'wsgi server'
+
+    def __init__(self, app, concurrency):
+        self.concurrency = concurrency
+        self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                                  request_handler=Handler)
+        self.base = 'http://127.0.0.1:%d' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        # log in through the app's own session interface, whichever store
+        # it uses, and send its cookie
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session.update(LOGIN)
+        cookie = client.get_cookie(app.config['SESSION_COOKIE_NAME'])
+        self.cookie = {cookie.key: cookie.value}
+
+    def run(self, requests_, logged_in):
+        timings, statuses = [], {}
+        lock = threading.Lock()
+        pending = list(reversed(requests_))
+
+        def worker():
+            http = requests.Session()
+            if logged_in:
+                http.cookies.update(self.cookie)
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    method, url, form = pending.pop()
+                sent = time.perf_counter()
+                response = http.request(method, self.base + url, data=form,
+                                        allow_redirects=False)
+                elapsed = (time.perf_counter() - sent) * 1000
+                with lock:
+                    timings.append(elapsed)
+                    statuses[response.status_code] = \
+                        statuses.get(response.status_code, 0) + 1
+
+        # the write steps depend on each other, run them in order
+        threads = [threading.Thread(target=worker) for _ in
+                   range(1 if requests_ and requests_[0][0] == 'POST'
+                         else self.concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return timings, statuses, time.perf_counter() - started
+
+    def close(self):
+        self.server.shutdown()
+
+
+def measure(driver, routes, counter):
+    """Run every route through a driver, return the report of each one"""
+    report = {}
+    for name, logged_in, requests_ in routes:
+        before = counter.count
+        timings, statuses, elapsed = driver.run(requests_, logged_in)
+        key = '%s (%s)' % (name, 'logged in' if logged_in else 'anonymous')
+        report[key] = {
+            'requests': len(timings),
+            'p50_ms': round(percentile(timings, 0.5), 3),
+            'p99_ms': round(percentile(timings, 0.99), 3),
+            'requests_per_second': round(len(timings) / elapsed, 1),
+            'queries_per_request': round(
+                (counter.count - before) / float(len(timings)), 2),
+            'statuses': dict((str(status), n)
+                             for status, n in sorted(statuses.items())),
+        }
+    return report
+
+
+def print_report(mode, report, previous=None):
+    print("\n%s" % mode)
+    print("%-40s %9s %9s %9s %8s" % ('route', 'p50 ms', 'p99 ms', 'req/s',
+                                     'queries'))
+    for key, row in report.items():
+        line = "%-40s %9.2f %9.2f %9.1f %8.2f" % (
+            key, row['p50_ms'], row['p99_ms'], row['requests_per_second'],
+            row['queries_per_request'])
+        old = (previous or {}).get(key)
+        if old and old['p50_ms']:
+            line += "  p50 %+.0f%%" % (
+                (row['p50_ms'] / old['p50_ms'] - 1) * 100)
+        if list(row['statuses']) not in (['200'], ['302']):
+            line += "  %s" % row['statuses']
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--categories', type=int, default=50)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per read route (default %(default)s)')
+    parser.add_argument('--writes', type=int, default=50,
+                        help='requests per write route (default %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='client threads against the WSGI server')
+    parser.add_argument('--mode', choices=['all', 'client', 'server'],
+                        default='all')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable the response cache')
+    parser.add_argument('--url', help='database to build, a temporary '
+                                      'SQLite file by default')
+    parser.add_argument('--reuse', action='store_true',
+                        help='run against the catalog already at --url')
+    parser.add_argument('--check-budgets', action='store_true',
+                        help='exit with an error when a route ran more '
+                             'queries than its budget')
+    parser.add_argument('--report', help='save the report to this JSON file')
+    parser.add_argument('--compare', help='JSON report of an earlier run')
+    args = parser.parse_args()
+
+    url = args.url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(),
+                                                  'routes.db')
+    # database_setup and views build their engine and caches from the
+    # environment when first imported
+    os.environ['CATALOG_DATABASE_URL'] = url
+    if args.no_cache:
+        os.environ['CATALOG_CACHE_SIZE'] = '0'
+    from benchmarks.synthetic import build_catalog
+    import views
+
+    if not args.reuse:
+        started = time.time()
+        build_catalog(url, args.items, args.categories, users=args.users,
+                      skewed=True).dispose()
+        print("Built %d items in %d categories for %d users in %.1fs"
+              % (args.items, args.categories, args.users,
+                 time.time() - started))
+
+    views.app.secret_key = 'benchmark'
+    counter = QueryCounter(views.engine)
+
+    rng = random.Random(1)
+    with views.engine.connect() as connection:
+        reads = read_routes(views.app, connection, rng, args.requests)
+
+    drivers = []
+    if args.mode in ('all', 'client'):
+        drivers.append(lambda: TestClientDriver(views.app))
+    if args.mode in ('all', 'server'):
+        drivers.append(lambda: ServerDriver(views.app, args.concurrency))
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['modes']
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'config': {'url': url, 'items': args.items,
+                         'categories': args.categories, 'users': args.users,
+                         'requests': args.requests, 'writes': args.writes,
+                         'concurrency': args.concurrency,
+                         'cache': not args.no_cache},
+              'modes': {}}
+    for run, make_driver in enumerate(drivers):
+        driver = make_driver()
+        try:
+            routes = reads + write_routes(views.app, '%d-%d' % (
+                os.getpid(), run), args.writes)
+            results = measure(driver, routes, counter)
+        finally:
+            driver.close()
+        report['modes'][driver.mode] = results
+        print_report(driver.mode, results, previous.get(driver.mode))
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("\nSaved the report to %s" % args.report)
+
+    if args.check_budgets:
+        over = views.metrics.over_budget()
+        for endpoint, queries, budget in over:
+            print("%s ran %d queries, its budget is %d"
+                  % (endpoint, queries, budget))
+        if over:
+            sys.exit(1)
+        print("Every route stayed within its query budget")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Latency of the item search on a synthetic catalog.
+
+Usage:
+    python -m benchmarks.search_bench --items 1000000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.synthetic import Vocabulary, build_catalog
+from database_setup import get_engine
+from search import search_items
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--url', help='database to build, a temporary '
+                                      'SQLite file by default')
+    parser.add_argument('--reuse', action='store_true',
+                        help='search the catalog already built at --url')
+    args = parser.parse_args()
+
+    url = args.url
+    if url is None:
+        url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'search.db')
+    vocabulary = Vocabulary()
+    if args.reuse:
+        engine = get_engine(url)
+    else:
+        started = time.time()
+        engine = build_catalog(url, args.items, vocabulary=vocabulary)
+        print("Built %d items in %.1fs" % (args.items, time.time() - started))
+
+    # users search with the same skew the words are written with: one
+    # word, two words with the last one half typed, or one word within a
+    # category
+    rng = random.Random(1)
+    queries = []
+    for _ in range(args.queries):
+        kind = rng.randrange(3)
+        words = vocabulary.sample(rng, 2)
+        if kind == 0:
+            queries.append((words[0], None))
+        elif kind == 1:
+            queries.append(('%s %s' % (words[0], words[1][:3]), None))
+        else:
+            queries.append((words[0], rng.randint(1, 50)))
+
+    timings = []
+    with engine.connect() as connection:
+        for query, category_id in queries:
+            started = time.time()
+            search_items(connection, query, category_id)
+            timings.append((time.time() - started) * 1000)
+
+    print("%d queries: p50 %.2fms, p99 %.2fms, max %.2fms"
+          % (len(timings), percentile(timings, 0.5),
+             percentile(timings, 0.99), max(timings)))
+
+
+if __name__ == '__main__':
+    main()
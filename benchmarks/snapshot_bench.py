@@ -0,0 +1,123 @@
+"""
+Memory of the in-memory catalog snapshot and latency of its reads against
+the SQLAlchemy queries of the views.
+
+Usage:
+    python -m benchmarks.snapshot_bench --items 1000000
+"""
+import argparse
+import gc
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.synthetic import build_catalog
+from database_setup import Category, Item, get_engine
+from pagination import encode_cursor, paginate
+from snapshot import CatalogSnapshot, paginate_records
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def sql_reads(session):
+    """the reads of the views, as run against the database"""
+    def category_page(slug, cursor):
+        category = session.query(Category).filter_by(slug=slug).one()
+        query = session.query(Item).filter_by(category=category)
+        paginate(query, Item.name, Item.id, 50, cursor=cursor)
+        category.item_count
+
+    def items_page(name, cursor):
+        paginate(session.query(Item), Item.name, Item.id, 50, cursor=cursor)
+
+    def item(slug, cursor):
+        session.query(Item).filter_by(slug=slug).first()
+
+    return [category_page, items_page, item]
+
+
+def snapshot_reads(snapshot):
+    """the same reads answered by a snapshot"""
+    def category_page(slug, cursor):
+        category = snapshot.category(slug)
+        items = snapshot.category_items[category.id]
+        paginate_records(items, 50, cursor=cursor)
+        len(items)
+
+    def items_page(name, cursor):
+        paginate_records(snapshot.items, 50, cursor=cursor)
+
+    def item(slug, cursor):
+        snapshot.item(slug)
+
+    return [category_page, items_page, item]
+
+
+def time_reads(reads, requests):
+    timings = dict((read.__name__, []) for read in reads)
+    for read in reads:
+        for args in requests[read.__name__]:
+            started = time.perf_counter()
+            read(*args)
+            timings[read.__name__].append(
+                (time.perf_counter() - started) * 1e6)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--items', type=int, default=200000)
+    parser.add_argument('--reads', type=int, default=2000)
+    args = parser.parse_args()
+
+    url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'snapshot.db')
+    engine = build_catalog(url, args.items)
+    engine.dispose()
+    engine = get_engine(url)
+
+    gc.collect()
+    tracemalloc.start()
+    started = time.time()
+    with engine.connect() as connection:
+        snapshot = CatalogSnapshot.load(connection)
+    elapsed = time.time() - started
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("Snapshot of %d items: %.1f MB, %d bytes per item, %.0f MB per "
+          "million items, loaded in %.2fs (traced)"
+          % (args.items, size / 1e6, size / args.items,
+             size / args.items, elapsed))
+
+    # random categories, items and cursors drawn from the catalog
+    rng = random.Random(1)
+    items = snapshot.items
+    requests = {'category_page': [], 'items_page': [], 'item': []}
+    for _ in range(args.reads):
+        item = items[rng.randrange(len(items))]
+        cursor = encode_cursor(item.name, item.id)
+        requests['category_page'].append((item.category.slug, cursor))
+        requests['items_page'].append((None, cursor))
+        requests['item'].append((item.slug, None))
+
+    session = sessionmaker(bind=engine)()
+    sql = time_reads(sql_reads(session), requests)
+    session.close()
+    memory = time_reads(snapshot_reads(snapshot), requests)
+
+    for name in ('category_page', 'items_page', 'item'):
+        print("%-14s SQLAlchemy p50 %8.1fus p99 %8.1fus | snapshot p50 "
+              "%6.1fus p99 %6.1fus"
+              % (name, percentile(sql[name], 0.5), percentile(sql[name], 0.99),
+                 percentile(memory[name], 0.5),
+                 percentile(memory[name], 0.99)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Synthetic catalogs for the benchmarks.
+
+Item names and descriptions are drawn from a pseudo-word vocabulary with a
+seeded random generator, so the same arguments always build the same
+catalog.
+"""
+import random
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+from bulk_import import BulkImporter
+from database_setup import User, get_engine
+from migrations import reset, upgrade
+
+SYLLABLES = ('ba', 'ke', 'lo', 'mi', 'nu', 'po', 'ra', 'si', 'tu', 've',
+             'zo', 'gri', 'pla', 'stro', 'cor', 'fen', 'dal', 'mur', 'tis',
+             'quan', 'bel', 'vor', 'sen', 'kal', 'rim', 'hon', 'jex', 'wab')
+
+
+def make_vocabulary(size, rng):
+    """Build size distinct pseudo-words out of two to four syllables"""
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES)
+                          for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def zipf_weights(size):
+    """Cumulative weights making the word of rank r 1/r as frequent"""
+    total, weights = 0.0, []
+    for rank in range(1, size + 1):
+        total += 1.0 / rank
+        weights.append(total)
+    return weights
+
+
+class Vocabulary(object):
+    """Seeded word source where a few words are common and most are rare"""
+
+    def __init__(self, size=20000, seed=0):
+        rng = random.Random(seed)
+        self.words = make_vocabulary(size, rng)
+        rng.shuffle(self.words)
+        self.weights = zipf_weights(size)
+
+    def sample(self, rng, count):
+        return rng.choices(self.words, cum_weights=self.weights, k=count)
+
+
+def generate_items(count, categories=50, seed=0, vocabulary=None,
+                   skewed=False):
+    """
+    Yield count item rows in the bulk_import format, with names and
+    descriptions drawn from a Zipf distributed vocabulary.
+    :param count: number of items
+    :param categories: number of categories the items are spread over
+    :param seed: seed of the random generator
+    :param vocabulary: Vocabulary to draw words from
+    :param skewed: spread the items over the categories with a Zipf
+        distribution, so a few categories hold most of them, instead of
+        evenly
+    """
+    rng = random.Random(seed)
+    vocabulary = vocabulary or Vocabulary(seed=seed)
+    category_weights = zipf_weights(categories) if skewed else None
+    for i in range(count):
+        if skewed:
+            category = rng.choices(range(categories),
+                                   cum_weights=category_weights)[0]
+        else:
+            category = rng.randrange(categories)
+        name = ' '.join(vocabulary.sample(rng, rng.randint(2, 3))).title()
+        description = ' '.join(vocabulary.sample(rng, rng.randint(8, 20)))
+        yield {'name': '%s %d' % (name, i),
+               'description': description,
+               'picture': 'https://example.com/%d.jpg' % i,
+               'category': 'Category %d' % category}
+
+
+def build_catalog(url, count, categories=50, seed=0, batch_size=10000,
+                  vocabulary=None, users=1, skewed=False):
+    """
+    Create a fresh catalog database filled with synthetic items.
+    :param url: database URL, its current content is dropped
+    :param users: number of users owning the categories and items, user 1
+        is bench1@example.com, user 2 bench2@example.com and so on
+    :param skewed: give the categories Zipf distributed sizes
+    :return: the engine of the database
+    """
+    engine = get_engine(url)
+    reset(engine)
+    upgrade(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all(User(name='Benchmark User %d' % n,
+                         email='bench%d@example.com' % n)
+                    for n in range(1, users + 1))
+    session.commit()
+    session.close()
+    BulkImporter(engine, user_id=1, batch_size=batch_size)\
+        .run(generate_items(count, categories, seed, vocabulary, skewed))
+    if users > 1:
+        # the importer gives everything to one user, deal the rows out
+        with engine.begin() as connection:
+            for table in ('category', 'item'):
+                connection.execute(text(
+                    'UPDATE %s SET user_id = (id - 1) %% :users + 1' % table),
+                    {'users': users})
+    return engine
@@ -0,0 +1,216 @@
+"""
+Bulk import of items into the catalog from CSV, JSON or JSON Lines feeds.
+
+Each input row needs a name and a category name, description and picture
+are optional. Categories that do not exist yet are created, owned by the
+importing user. Rows are written with executemany in transactions of
+--batch-size rows, and the throughput is reported after every batch. New
+items and categories whose slug is taken get a numbered one, like the
+ones created through the app, see slugs.free_slugs.
+
+Usage:
+    python bulk_import.py items.csv --batch-size 5000 --upsert
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database_setup import Category, Item, get_engine
+from migrations import upgrade
+from slugs import free_slugs
+
+DEFAULT_BATCH_SIZE = 5000
+# names per IN (...) lookup, below the bound parameter limit of SQLite
+LOOKUP_CHUNK = 500
+ITEM_FIELDS = ('name', 'description', 'picture')
+
+
+def read_rows(path, fmt=None):
+    """
+    Yield the rows of a feed file as dicts, one at a time for CSV and
+    JSON Lines so large feeds are never loaded whole.
+    :param path: path of the feed, '-' reads standard input
+    :param fmt: csv, json or jsonl, guessed from the extension by default
+    """
+    if fmt is None:
+        fmt = path.rsplit('.', 1)[-1].lower() if '.' in path else 'jsonl'
+    stream = io.open(sys.stdin.fileno(), encoding='utf-8', closefd=False) \
+        if path == '-' else io.open(path, encoding='utf-8', newline='')
+    with stream:
+        if fmt == 'csv':
+            for row in csv.DictReader(stream):
+                yield row
+        elif fmt == 'json':
+            data = json.load(stream)
+            # accept both a bare list and the {"items": [...]} API shape
+            for row in data.get('items', []) if isinstance(data, dict) \
+                    else data:
+                yield row
+        elif fmt in ('jsonl', 'ndjson'):
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError('Unknown feed format %r' % fmt)
+
+
+def _insert_for(engine, table):
+    """Return the dialect insert construct supporting ON CONFLICT"""
+    if engine.dialect.name == 'sqlite':
+        return sqlite.insert(table)
+    if engine.dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    raise ValueError('Upserts are not supported on %s' % engine.dialect.name)
+
+
+class BulkImporter(object):
+    """Writes items to the catalog in batches, resolving categories"""
+
+    def __init__(self, engine, user_id, batch_size=DEFAULT_BATCH_SIZE,
+                 upsert=False, progress=None):
+        """
+        :param engine: engine of the catalog database
+        :param user_id: id of the user owning the imported rows
+        :param batch_size: number of rows written per transaction
+        :param upsert: update the existing item with the same name instead
+            of failing on the unique constraint
+        :param progress: callable(rows written, seconds elapsed) called
+            after each batch
+        """
+        self.engine = engine
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.progress = progress
+        self.category_ids = {}
+        self.rows_written = 0
+        self.started = None
+
+    def load_categories(self):
+        """Read the name -> id map of all categories once"""
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                select(Category.__table__.c.name, Category.__table__.c.id))
+            self.category_ids = dict(rows.fetchall())
+
+    def _create_categories(self, connection, names):
+        table = Category.__table__
+        slugs = free_slugs(connection, table, names)
+        connection.execute(
+            _insert_for(self.engine, table).on_conflict_do_nothing(
+                index_elements=['name']),
+            [{'name': name, 'slug': slugs[name], 'user_id': self.user_id}
+             for name in names])
+        rows = connection.execute(
+            select(table.c.name, table.c.id).where(table.c.name.in_(names)))
+        self.category_ids.update(rows.fetchall())
+
+    def _write_batch(self, batch):
+        table = Item.__table__
+        with self.engine.begin() as connection:
+            missing = sorted(set(row['category'] for row in batch
+                                 if row['category'] not in
+                                 self.category_ids))
+            if missing:
+                self._create_categories(connection, missing)
+            names = list(OrderedDict.fromkeys(row['name'] for row in batch))
+            owners = {}
+            if self.upsert:
+                # the existing items keep their slug
+                for start in range(0, len(names), LOOKUP_CHUNK):
+                    owners.update(connection.execute(
+                        select(table.c.name, table.c.id).where(
+                            table.c.name.in_(
+                                names[start:start + LOOKUP_CHUNK]))).all())
+            slugs = free_slugs(connection, table, names, owners)
+            mappings = []
+            for row in batch:
+                mapping = dict((field, row.get(field) or None)
+                               for field in ITEM_FIELDS)
+                mapping['slug'] = slugs[row['name']]
+                mapping['category_id'] = self.category_ids[row['category']]
+                mapping['user_id'] = self.user_id
+                mappings.append(mapping)
+            if self.upsert:
+                statement = _insert_for(self.engine, table)
+                statement = statement.on_conflict_do_update(
+                    index_elements=['name'],
+                    set_=dict((column, statement.excluded[column])
+                              for column in ('description', 'picture',
+                                             'category_id', 'updated_at')))
+            else:
+                statement = table.insert()
+            connection.execute(statement, mappings)
+        self.rows_written += len(batch)
+        if self.progress is not None:
+            self.progress(self.rows_written, time.time() - self.started)
+
+    def run(self, rows):
+        """
+        Import all rows.
+        :param rows: iterable of dicts with name, category and optionally
+            description and picture
+        :return: number of rows written
+        """
+        self.started = time.time()
+        self.load_categories()
+        batch = []
+        for row in rows:
+            if not row.get('name') or not row.get('category'):
+                raise ValueError('Row without name or category: %r' % row)
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self._write_batch(batch)
+                batch = []
+        if batch:
+            self._write_batch(batch)
+        return self.rows_written
+
+
+def report_progress(rows, elapsed):
+    sys.stderr.write('%d rows in %.1fs (%.0f rows/sec)\n'
+                     % (rows, elapsed, rows / elapsed if elapsed else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Bulk import items into the item catalog.')
+    parser.add_argument('path', help="feed file, '-' for standard input")
+    parser.add_argument('--format', choices=['csv', 'json', 'jsonl'],
+                        help='feed format, guessed from the extension')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='rows per transaction (default %(default)s)')
+    parser.add_argument('--upsert', action='store_true',
+                        help='update items whose name already exists')
+    parser.add_argument('--user-id', type=int, default=1,
+                        help='owner of the imported rows (default 1)')
+    parser.add_argument('--url', help='database URL, defaults to '
+                                      'CATALOG_DATABASE_URL')
+    args = parser.parse_args()
+
+    engine = get_engine(args.url)
+    upgrade(engine)
+    importer = BulkImporter(engine, args.user_id,
+                            batch_size=args.batch_size, upsert=args.upsert,
+                            progress=report_progress)
+    try:
+        rows = importer.run(read_rows(args.path, args.format))
+    except IntegrityError as e:
+        sys.exit("Import stopped after %d rows: %s%s"
+                 % (importer.rows_written, e.orig, '' if args.upsert else
+                    "\nRerun with --upsert to update existing items."))
+    elapsed = time.time() - importer.started
+    print("Imported %d items in %.1fs (%.0f rows/sec)"
+          % (rows, elapsed, rows / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    main()
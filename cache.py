@@ -0,0 +1,375 @@
+"""
+Response cache for the public catalog pages and JSON endpoints.
+
+Cached responses are keyed on the request path plus the current revision
+of every scope the response depends on, e.g. the list of categories, the
+list of items or one category. Writes bump the revisions of the scopes
+they touch, which makes all the keys built from the old revisions
+unreachable; the stale entries then age out of the backend on their own.
+Being timestamps, revisions also give the ETag and Last-Modified
+validators of the responses.
+
+Revisions are kept in the process or the backend by default, which only
+sees the writes of the app. DatabaseRevisions keeps them in the catalog
+database instead, where triggers bump them in the transaction of every
+write, so all the workers, and the scripts writing to the database, agree
+on them.
+"""
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import bindparam, func, select, text
+
+# body is bytes, headers a list of (name, value) pairs
+CachedResponse = namedtuple('CachedResponse',
+                            ['body', 'status', 'mimetype', 'headers'])
+
+
+def _new_revision(previous=None):
+    """
+    Revisions are millisecond timestamps bumped to stay strictly increasing,
+    so a revision lost by the backend restarts above every value handed out
+    before and can never match an old key.
+    """
+    revision = int(time.time() * 1000)
+    if previous is not None and revision <= previous:
+        revision = previous + 1
+    return revision
+
+
+class LRUCache(object):
+    """Thread-safe in-process LRU mapping with a time to live per entry"""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        """
+        :param maxsize: number of entries kept before evicting the least
+            recently used one
+        :param ttl: default seconds an entry stays valid, None for ever
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # revisions live apart from the entries so they are never evicted
+        self._revisions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def purge(self):
+        """Drop the expired entries, return how many were dropped"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (value, expires)
+                       in self._entries.items()
+                       if expires is not None and expires < now]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def revision(self, scope):
+        with self._lock:
+            revision = self._revisions.get(scope)
+            if revision is None:
+                revision = self._revisions[scope] = _new_revision()
+            return revision
+
+    def bump(self, *scopes):
+        with self._lock:
+            for scope in scopes:
+                self._revisions[scope] = _new_revision(
+                    self._revisions.get(scope))
+
+
+class SharedBackend(object):
+    """
+    Cache backend shared between processes through a memcached-like client,
+    anything with get(key), set(key, value, expire) and delete(key) such as
+    pymemcache.Client or the LocalClient stand-in below. Keys are hashed,
+    since memcached refuses keys longer than 250 bytes or holding spaces
+    and control characters, which request paths and slugs may have.
+    """
+
+    def __init__(self, client, prefix='catalog:', ttl=300):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, key):
+        """Return the memcached key of a cache key"""
+        return self.prefix + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        data = self.client.get(self._key(key))
+        return None if data is None else pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self._key(key), pickle.dumps(value), ttl or 0)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def revision(self, scope):
+        key = self._key('rev:' + scope)
+        revision = self.client.get(key)
+        if revision is None:
+            revision = _new_revision()
+            self.client.set(key, str(revision).encode('ascii'), 0)
+            return revision
+        return int(revision)
+
+    def bump(self, *scopes):
+        for scope in scopes:
+            key = self._key('rev:' + scope)
+            previous = self.client.get(key)
+            revision = _new_revision(
+                None if previous is None else int(previous))
+            self.client.set(key, str(revision).encode('ascii'), 0)
+
+
+class LocalClient(object):
+    """In-process stand-in for a memcached client, for development"""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires and expires < time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, expire=0):
+        with self._lock:
+            self._data[key] = (value, time.time() + expire if expire else 0)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+        return True
+
+
+class DatabaseRevisions(object):
+    """
+    Revisions kept in the catalog_revision table, see
+    database_setup.CatalogRevision, which the triggers of migrations.py
+    bump on every write to the categories and items. The revisions read
+    are remembered in the process, and a background thread reads the ones
+    bumped since every poll_interval seconds, so other processes' writes
+    show within that time and serving a revision read before needs no
+    query. A scope never bumped has revision 0.
+    """
+
+    def __init__(self, engine, poll_interval=1.0, overlap=10.0,
+                 maxsize=100000):
+        """
+        :param engine: engine of the catalog database
+        :param poll_interval: seconds between the reads of the revisions
+            bumped by other processes, None to never read them
+        :param overlap: seconds of revisions read again by every poll, so
+            a transaction committing that late after its bump still shows
+        :param maxsize: number of scopes remembered
+        """
+        from database_setup import CatalogRevision, REVISION_CLOCK
+        self.engine = engine
+        self.poll_interval = poll_interval
+        self.overlap = int(overlap * 1000)
+        self._known = LRUCache(maxsize=maxsize, ttl=None)
+        # highest revision read, the polls read the ones above
+        self._seen = None
+        self._poller = None
+        self._lock = threading.Lock()
+        table = CatalogRevision.__table__
+        self._get = select(table.c.scope, table.c.revision).where(
+            table.c.scope.in_(bindparam('scopes', expanding=True)))
+        self._since = select(table.c.scope, table.c.revision).where(
+            table.c.revision > bindparam('since'))
+        self._latest = select(func.max(table.c.revision))
+        # the same steps as the triggers: the database time, or one more
+        # than the previous revision
+        self._bump = text(
+            'INSERT INTO catalog_revision (scope, revision) '
+            'VALUES (:scope, %s) ON CONFLICT (scope) DO UPDATE '
+            'SET revision = CASE WHEN catalog_revision.revision < '
+            'excluded.revision THEN excluded.revision '
+            'ELSE catalog_revision.revision + 1 END'
+            % REVISION_CLOCK[engine.dialect.name])
+
+    def _remember(self, rows):
+        """Keep the higher of the read and remembered revisions"""
+        with self._lock:
+            for scope, revision in rows:
+                known = self._known.get(scope)
+                if known is None or known < revision:
+                    self._known.set(scope, revision)
+                if self._seen is not None and revision > self._seen:
+                    self._seen = revision
+
+    def revisions(self, scopes):
+        """Return the current revision of each scope"""
+        self._start_poller()
+        found = [self._known.get(scope) for scope in scopes]
+        missing = [scope for scope, revision in zip(scopes, found)
+                   if revision is None]
+        if not missing:
+            return found
+        with self.engine.connect() as connection:
+            rows = connection.execute(self._get, {'scopes': missing}).all()
+        self._remember([(scope, 0) for scope in missing] + rows)
+        return [self._known.get(scope) if revision is None else revision
+                for scope, revision in zip(scopes, found)]
+
+    def revision(self, scope):
+        return self.revisions([scope])[0]
+
+    def bump(self, *scopes):
+        with self.engine.begin() as connection:
+            connection.execute(self._bump,
+                               [{'scope': scope} for scope in scopes])
+            rows = connection.execute(
+                self._get, {'scopes': list(scopes)}).all()
+        self._remember(rows)
+
+    def poll(self):
+        """Read the revisions bumped since the previous poll"""
+        with self.engine.connect() as connection:
+            if self._seen is None:
+                self._seen = connection.execute(self._latest).scalar() or 0
+            rows = connection.execute(
+                self._since, {'since': self._seen - self.overlap}).all()
+        self._remember(rows)
+
+    def _start_poller(self):
+        """Start the poll thread of this process, after a fork too"""
+        if self.poll_interval is None or (
+                self._poller is not None and self._poller.is_alive()):
+            return
+        with self._lock:
+            if self._poller is not None and self._poller.is_alive():
+                return
+            self._poller = threading.Thread(target=self._poll,
+                                            name='revision-poller')
+            self._poller.daemon = True
+            self._poller.start()
+
+    def _poll(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                # the next round reads from the same revision again
+                pass
+            time.sleep(self.poll_interval)
+
+
+class ResponseCache(object):
+    """Revision keyed response cache counting its hits and misses"""
+
+    def __init__(self, backend=None, revisions=None, release=None):
+        """
+        :param backend: LRUCache or SharedBackend, a default LRUCache is
+            used when omitted
+        :param revisions: DatabaseRevisions, the backend keeps the
+            revisions when omitted
+        :param release: part of every key, such as the time the templates
+            last changed, so a new release of the app doesn't serve the
+            responses of the previous one
+        """
+        self.backend = backend if backend is not None else LRUCache()
+        self.revision_store = revisions if revisions is not None \
+            else self.backend
+        self.release = release
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def revisions(self, scopes):
+        """Return the current revision of each scope"""
+        if hasattr(self.revision_store, 'revisions'):
+            return self.revision_store.revisions(scopes)
+        return [self.revision_store.revision(scope) for scope in scopes]
+
+    def key(self, path, revisions):
+        """
+        Build the cache key of a request.
+        :param path: request path with its query string
+        :param revisions: revisions of the scopes the response depends on
+        """
+        return 'view:%s:%s:%s' % (self.release, path,
+                                  '.'.join(map(str, revisions)))
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, ttl)
+
+    def fragment(self, name, scopes, render):
+        """
+        Return a rendered fragment shared by several pages, rendering it
+        again only after one of the scopes it depends on was bumped.
+        :param name: name of the fragment
+        :param scopes: scopes the fragment depends on
+        :param render: function returning the fragment, called on a miss
+        """
+        key = 'fragment:%s:%s:%s' % (self.release, name, '.'.join(
+            map(str, self.revisions(scopes))))
+        value = self.backend.get(key)
+        if value is None:
+            value = render()
+            self.backend.set(key, value)
+        return value
+
+    def bump(self, *scopes):
+        """Invalidate every response depending on one of the scopes"""
+        self.revision_store.bump(*scopes)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
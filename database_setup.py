@@ -1,22 +1,35 @@
 import os
 import sys
+import datetime
 
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
+from sqlalchemy import BigInteger, Float, LargeBinary, Text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from sqlalchemy.orm import relationship, backref
+from sqlalchemy import inspect
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from slugs import free_slugs, slugify
 
 # an instance of new base class of declarative_base
 Base = declarative_base()
 
 
+def _default_slug(context):
+    """slug of the rows inserted by Core statements without one, which
+    isn't numbered like the ones of free_slugs"""
+    return slugify(context.get_current_parameters()['name'])
+
+
 class User(Base):
     """class for user information"""
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
-    email = Column(String(250), nullable=False)
+    email = Column(String(250), nullable=False, index=True)
     image = Column(String(250))
 
 
@@ -26,8 +39,15 @@ class Category(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False, unique=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
     user = relationship(User)
+    # number of items in the category, kept up to date by database
+    # triggers on the item table, see migrations._maintain_item_counts
+    item_count = Column(Integer, nullable=False, default=0,
+                        server_default='0')
+    # URL segment of the category, follows the name, see slugs.py
+    slug = Column(String(250), unique=True, index=True,
+                  default=_default_slug)
 
     @property
     def serialize(self):
@@ -45,11 +65,26 @@ class Item(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False, unique=True)
     description = Column(String(250))
-    category_id = Column(Integer, ForeignKey('category.id'))
-    category = relationship(Category)
+    category_id = Column(Integer, ForeignKey('category.id',
+                                             ondelete='CASCADE'))
+    # deleting a category deletes its items in the database itself, without
+    # loading them into the session first
+    category = relationship(Category, backref=backref(
+        'items', cascade='all, delete-orphan', passive_deletes=True))
     picture = Column(String(250))
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
     user = relationship(User)
+    # time of the last insert or update, used by incremental exports
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow,
+                        onupdate=datetime.datetime.utcnow, index=True)
+    # URL segment of the item, follows the name, see slugs.py
+    slug = Column(String(250), unique=True, index=True,
+                  default=_default_slug)
+
+    # serves the items of a category ordered by name
+    __table_args__ = (
+        Index('ix_item_category_id_name', 'category_id', 'name'),
+    )
 
     @property
     def serialize(self):
@@ -62,6 +97,133 @@ class Item(Base):
         }
 
 
-engine = create_engine('sqlite:///itemCatalog.db')
+def _assign_slug(mapper, connection, target):
+    """give the new and renamed categories and items a free slug"""
+    if target.slug is None or inspect(target).attrs.name.history.deleted:
+        owners = {target.name: target.id} if target.id is not None else None
+        target.slug = free_slugs(connection, mapper.local_table,
+                                 [target.name], owners)[target.name]
+
+
+for _model in (Category, Item):
+    event.listen(_model, 'before_insert', _assign_slug)
+    event.listen(_model, 'before_update', _assign_slug)
+
+
+class AuditEvent(Base):
+    """one edit of the catalog, written behind by writebehind"""
+    __tablename__ = 'audit_log'
+
+    id = Column(Integer, primary_key=True)
+    # time of the edit, not of the write
+    created_at = Column(DateTime, nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
+    # such as 'item.create' or 'category.delete'
+    action = Column(String(32), nullable=False)
+    # name of the category or item, or email of the user
+    target = Column(String(250))
+    # JSON of what else there is to know, such as the new name
+    detail = Column(Text)
+
+
+class LoginSession(Base):
+    """server-side login session, see sessions.DatabaseStore"""
+    __tablename__ = 'sessions'
+
+    id = Column(String(64), primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+    # Unix time after which the session is expired
+    expires = Column(Float, nullable=False, index=True)
+
+
+class CatalogRevision(Base):
+    """revision of a response cache scope, see cache.DatabaseRevisions"""
+    __tablename__ = 'catalog_revision'
+
+    # such as 'items' or 'category:soccer'
+    scope = Column(String(300), primary_key=True)
+    # millisecond timestamp of the database clock, bumped by the triggers
+    # of migrations.py in the transaction of every write
+    revision = Column(BigInteger, nullable=False, index=True)
+
+
+# current time of the database clock in milliseconds, per dialect
+REVISION_CLOCK = {
+    'sqlite': "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)",
+    'postgresql': 'CAST(EXTRACT(EPOCH FROM clock_timestamp()) * 1000 '
+                  'AS BIGINT)',
+}
+
+
+# Database connection settings, each one can be overridden from the
+# environment so several workers can share one configured database
+DATABASE_URL = os.environ.get('CATALOG_DATABASE_URL',
+                              'sqlite:///itemCatalog.db')
+POOL_SIZE = int(os.environ.get('CATALOG_DB_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.environ.get('CATALOG_DB_MAX_OVERFLOW', 10))
+# seconds a SQLite connection waits on a locked database before failing
+BUSY_TIMEOUT = float(os.environ.get('CATALOG_DB_BUSY_TIMEOUT', 30))
+# databases the migrations have triggers for, see migrations.py
+SUPPORTED_DATABASES = ('sqlite', 'postgresql')
+
+
+def _is_memory_url(url):
+    return url in ('sqlite://', 'sqlite:///:memory:')
+
+
+def get_engine(url=None, pool_size=None, max_overflow=None,
+               busy_timeout=None):
+    """
+    Create an engine for the catalog database.
+    SQLite databases are switched to WAL mode with a busy timeout so readers
+    never block the writer and concurrent writers wait instead of failing
+    with "database is locked".
+    :param url: database URL, defaults to DATABASE_URL
+    :param pool_size: number of pooled connections kept open
+    :param max_overflow: connections allowed on top of pool_size
+    :param busy_timeout: seconds to wait for a SQLite write lock
+    :return: a configured SQLAlchemy engine
+    :raise ValueError: when the URL is not a SQLite or PostgreSQL one
+    """
+    url = url or DATABASE_URL
+    backend = make_url(url).get_backend_name()
+    if backend not in SUPPORTED_DATABASES:
+        raise ValueError('Unsupported database %s, the catalog runs on %s'
+                         % (backend, ' or '.join(SUPPORTED_DATABASES)))
+    pool_size = POOL_SIZE if pool_size is None else pool_size
+    max_overflow = MAX_OVERFLOW if max_overflow is None else max_overflow
+    busy_timeout = BUSY_TIMEOUT if busy_timeout is None else busy_timeout
+
+    if not url.startswith('sqlite'):
+        return create_engine(url, pool_size=pool_size,
+                             max_overflow=max_overflow, pool_pre_ping=True)
+
+    connect_args = {'check_same_thread': False, 'timeout': busy_timeout}
+    if _is_memory_url(url):
+        # every connection to :memory: is a new empty database, share one
+        engine = create_engine(url, connect_args=connect_args,
+                               poolclass=StaticPool)
+    else:
+        engine = create_engine(url, connect_args=connect_args,
+                               poolclass=QueuePool, pool_size=pool_size,
+                               max_overflow=max_overflow)
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not _is_memory_url(url):
+            cursor.execute('PRAGMA journal_mode=WAL')
+            # WAL keeps commits durable against crashes at this level
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=%d' % int(busy_timeout * 1000))
+        # SQLite only enforces foreign keys, and ON DELETE CASCADE, when
+        # asked to on each connection
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+    return engine
+
+
+engine = get_engine()
 
 Base.metadata.create_all(engine)
@@ -1,14 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from database_setup import *
+from migrations import reset, upgrade
 
-engine = create_engine('sqlite:///itemCatalog.db')
+engine = get_engine()
 
 # clear the existing database if there is any
-Base.metadata.drop_all(engine)
-Base.metadata.create_all(engine)
+reset(engine)
+upgrade(engine)
 
 Base.metadata.bind = engine
 DBsession = sessionmaker(bind=engine)
@@ -24,45 +24,35 @@ user_1 = User(name="Bob Wang",
               email="wwwyyycss@gmail.com",
               image="https://bit.ly/29KRDC2")
 session.add(user_1)
-session.commit()
 
 # Add category data to the database
 
 cat1 = Category(name="Soccer", user_id=1)
 session.add(cat1)
-session.commit()
 
 cat2 = Category(name="Basketball", user_id=1)
 session.add(cat2)
-session.commit()
 
 cat3 = Category(name="Baseball", user_id=1)
 session.add(cat3)
-session.commit()
 
 cat4 = Category(name="Frisbee", user_id=1)
 session.add(cat4)
-session.commit()
 
 cat5 = Category(name="Snowboarding", user_id=1)
 session.add(cat5)
-session.commit()
 
 cat6 = Category(name="Rock Climbing", user_id=1)
 session.add(cat6)
-session.commit()
 
 cat7 = Category(name="Football", user_id=1)
 session.add(cat7)
-session.commit()
 
 cat8 = Category(name="Skating", user_id=1)
 session.add(cat8)
-session.commit()
 
 cat9 = Category(name="Hockey", user_id=1)
 session.add(cat9)
-session.commit()
 
 # Add item data to the database
 
@@ -74,7 +64,6 @@ item1 = Item(name="Two shinguards",
              user_id=1)
 
 session.add(item1)
-session.commit()
 
 item2 = Item(name="Shinguards",
              description="A piece of equipment worn on the front of "
@@ -84,7 +73,6 @@ item2 = Item(name="Shinguards",
              user_id=1)
 
 session.add(item2)
-session.commit()
 
 item3 = Item(name="Jersey",
              description="The standard equipment and attire worn by players.",
@@ -93,7 +81,6 @@ item3 = Item(name="Jersey",
              user_id=1)
 
 session.add(item3)
-session.commit()
 
 item4 = Item(name="Soccer Cleats",
              description="The classic soccer shoe with cleats/studs designed "
@@ -104,7 +91,6 @@ item4 = Item(name="Soccer Cleats",
              user_id=1)
 
 session.add(item4)
-session.commit()
 
 item5 = Item(name="Bat",
              description="A smooth wooden or metal club used in the sport "
@@ -115,7 +101,6 @@ item5 = Item(name="Bat",
              user_id=1)
 
 session.add(item5)
-session.commit()
 
 item6 = Item(name="Frisbee",
              description="A gliding toy or sporting item that is generally "
@@ -126,7 +111,6 @@ item6 = Item(name="Frisbee",
              user_id=1)
 
 session.add(item6)
-session.commit()
 
 item7 = Item(name="Goggles",
              description="Forms of protective eyewear that usually enclose "
@@ -138,7 +122,6 @@ item7 = Item(name="Goggles",
              user_id=1)
 
 session.add(item7)
-session.commit()
 
 item8 = Item(name="Snowboard",
              description="Boards where both feet are secured to the same "
@@ -149,7 +132,6 @@ item8 = Item(name="Snowboard",
              user_id=1)
 
 session.add(item8)
-session.commit()
 
 item9 = Item(name="Stick",
              description="A piece of equipment used by the players in most "
@@ -159,6 +141,8 @@ item9 = Item(name="Stick",
              user_id=1)
 
 session.add(item9)
+
+# Write all rows in one transaction instead of one commit per row
 session.commit()
 
 print("Item catalogs have been initiated!")
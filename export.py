@@ -0,0 +1,154 @@
+"""
+Offline export of the catalog items to JSON Lines or CSV files.
+
+Items are streamed from the database in chunks of --chunk-size rows and
+written as they arrive, so memory use does not grow with the catalog.
+Output files ending in .gz are gzip compressed. Every record is the item's
+serialize dict plus its category name, picture and modification time, the
+same fields bulk_import.py reads back.
+
+Usage:
+    python export.py items.jsonl.gz
+    python export.py soccer.csv --category Soccer
+    python export.py changes.jsonl --since 2018-06-01T00:00:00
+"""
+import argparse
+import csv
+import datetime
+import gzip
+import io
+import json
+import sys
+
+from sqlalchemy import asc
+from sqlalchemy.orm import sessionmaker
+
+from database_setup import Category, Item, get_engine
+from migrations import upgrade
+
+DEFAULT_CHUNK_SIZE = 1000
+CSV_FIELDS = ['id', 'name', 'description', 'picture', 'cat_id', 'category',
+              'updated_at']
+
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp such as 2018-06-01 or 2018-06-01T12:00"""
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Invalid timestamp %r' % value)
+
+
+def iter_records(session, categories=None, since_id=None, since=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield the export record of each matching item, in id order.
+    :param session: database session
+    :param categories: only export items of these category names
+    :param since_id: only export items with a larger id
+    :param since: only export items modified after this datetime
+    :param chunk_size: number of rows fetched from the cursor at a time
+    """
+    query = session.query(Item, Category.name)\
+        .join(Category, Item.category_id == Category.id)
+    if categories:
+        query = query.filter(Category.name.in_(categories))
+    if since_id is not None:
+        query = query.filter(Item.id > since_id)
+    if since is not None:
+        query = query.filter(Item.updated_at > since)
+    for item, category_name in query.order_by(asc(Item.id))\
+            .yield_per(chunk_size):
+        record = item.serialize
+        record['category'] = category_name
+        record['picture'] = item.picture
+        record['updated_at'] = item.updated_at.isoformat() \
+            if item.updated_at else None
+        yield record
+        # drop the rows already written so the identity map stays small
+        session.expunge(item)
+
+
+def open_output(path):
+    """Open the output for text writing, gzip compressed for .gz paths"""
+    if path == '-':
+        return io.open(sys.stdout.fileno(), 'w', encoding='utf-8',
+                       newline='', closefd=False)
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, 'wb'), encoding='utf-8',
+                                newline='')
+    return io.open(path, 'w', encoding='utf-8', newline='')
+
+
+def write_records(records, stream, fmt):
+    """
+    Write the records to a text stream.
+    :return: (number of records, last id, latest updated_at)
+    """
+    count, last_id, latest = 0, None, None
+    writer = None
+    if fmt == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+    for record in records:
+        if writer is not None:
+            writer.writerow(record)
+        else:
+            stream.write(json.dumps(record, sort_keys=True) + '\n')
+        count += 1
+        last_id = record['id']
+        if record['updated_at'] and (latest is None or
+                                     record['updated_at'] > latest):
+            latest = record['updated_at']
+    return count, last_id, latest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export the item catalog to JSON Lines or CSV.')
+    parser.add_argument('path', help="output file, '-' for standard output, "
+                                     "a .gz suffix compresses it")
+    parser.add_argument('--format', choices=['jsonl', 'csv'],
+                        help='output format, guessed from the extension')
+    parser.add_argument('--category', action='append', dest='categories',
+                        help='only export this category, can be repeated')
+    parser.add_argument('--since-id', type=int,
+                        help='only export items with a larger id')
+    parser.add_argument('--since', type=parse_timestamp,
+                        help='only export items modified after this UTC '
+                             'timestamp')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='rows fetched at a time (default %(default)s)')
+    parser.add_argument('--url', help='database URL, defaults to '
+                                      'CATALOG_DATABASE_URL')
+    args = parser.parse_args()
+
+    fmt = args.format
+    if fmt is None:
+        name = args.path[:-3] if args.path.endswith('.gz') else args.path
+        fmt = 'csv' if name.endswith('.csv') else 'jsonl'
+
+    engine = get_engine(args.url)
+    upgrade(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        records = iter_records(session, args.categories, args.since_id,
+                               args.since, args.chunk_size)
+        with open_output(args.path) as stream:
+            count, last_id, latest = write_records(records, stream, fmt)
+    finally:
+        session.close()
+
+    sys.stderr.write("Exported %d items\n" % count)
+    if count:
+        # what to pass to the next run to export only newer changes
+        sys.stderr.write("Next incremental export: --since-id %d for new "
+                         "items or --since %s for new and changed items\n"
+                         % (last_id, latest))
+
+
+if __name__ == '__main__':
+    main()
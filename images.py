@@ -0,0 +1,385 @@
+"""
+Local copies of the item pictures, so pages never hot-link remote hosts.
+
+Item.picture holds the URL the user entered. When an item is added or
+edited, ImageFetcher downloads that picture once on a background thread and
+ImageStore writes it into a content-addressed store: files are named after
+the SHA-256 of the original bytes, so they never change and can be served
+with a cache lifetime of a year, and the same picture entered under several
+URLs is stored once. With Pillow installed, resized JPEG or PNG thumbnails
+and WebP variants are written next to the original.
+
+A small index file per URL maps the picture URL to its stored digest.
+Pages look it up when they are rendered and fall back to the remote URL
+until the picture is stored; the fetcher then bumps the cache scopes of the
+item so its pages are rendered again with the local copy.
+
+Only http and https URLs are fetched, redirects are followed one hop at a
+time, and hosts resolving to private, loopback or link-local addresses are
+refused unless allow_private is set, which lets a local HTTP stand-in play
+the remote hosts in tests.
+
+Usage, to store the pictures of the items already in the database:
+    python images.py
+"""
+import argparse
+import hashlib
+import io
+import ipaddress
+import json
+import logging
+import os
+import queue
+import socket
+import tempfile
+import threading
+from collections import namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache import LRUCache
+
+try:
+    from urllib.parse import urljoin, urlparse
+except ImportError:
+    from urlparse import urljoin, urlparse
+
+log = logging.getLogger('catalog.images')
+
+# longest side in pixels of the thumbnails, pages show 400 and 800 for
+# high density screens
+THUMBNAIL_SIZES = (200, 400, 800)
+# pictures larger than this are not stored
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+# seconds to wait for a remote host to connect and to answer
+DEFAULT_TIMEOUT = 10
+MAX_REDIRECTS = 5
+# seconds the browsers may keep a stored picture, which never changes
+CACHE_MAX_AGE = 365 * 24 * 3600
+# stored pictures whose lookup is remembered in the process
+KNOWN_IMAGES = 10000
+
+EXTENSIONS = {
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+    'image/gif': 'gif',
+    'image/webp': 'webp',
+}
+
+
+class ImageError(Exception):
+    """raised when a picture can't be fetched or isn't an image"""
+
+
+class StoredImage(namedtuple('StoredImage', ['digest', 'extension',
+                                             'sizes'])):
+    """
+    A stored picture: the original saved as <digest>.<extension>, and
+    for every size in sizes a thumbnail <digest>-<size>.<jpg or png> and
+    a WebP variant <digest>-<size>.webp.
+    """
+    __slots__ = ()
+
+    def filename(self, size=None, webp=False):
+        """
+        Return the path of a stored file relative to the store.
+        :param size: one of sizes, None for the original
+        :param webp: the WebP variant of the thumbnail
+        """
+        name = self.digest
+        if size is None:
+            extension = self.extension
+        else:
+            name = '%s-%d' % (name, size)
+            extension = 'webp' if webp else \
+                ('png' if self.extension in ('png', 'gif') else 'jpg')
+        return '%s/%s.%s' % (self.digest[:2], name, extension)
+
+
+def _url_key(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+class ImageStore(object):
+    """Content-addressed directory of pictures and their variants"""
+
+    def __init__(self, root, known=KNOWN_IMAGES):
+        """
+        :param root: directory of the store, created when missing
+        :param known: number of stored pictures whose lookup is remembered
+        """
+        self.root = root
+        # positive lookups only, a missing picture may be stored at any
+        # time by this or another worker
+        self._known = LRUCache(maxsize=known, ttl=None)
+
+    def _path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def _write(self, relative, data):
+        """Write a file atomically, readers never see a partial file"""
+        path = self._path(relative)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(data)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def lookup(self, url):
+        """Return the StoredImage of a picture URL, None when not stored"""
+        stored = self._known.get(url)
+        if stored is not None:
+            return stored
+        key = _url_key(url)
+        try:
+            with open(self._path('urls', key[:2], key + '.json')) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        stored = StoredImage(entry['digest'], entry['extension'],
+                             tuple(entry['sizes']))
+        self._known.set(url, stored)
+        return stored
+
+    def put(self, url, data, content_type):
+        """
+        Store the picture fetched from url with its variants.
+        :param data: bytes of the picture
+        :param content_type: its media type, one of EXTENSIONS
+        :return: the StoredImage
+        """
+        extension = EXTENSIONS[content_type]
+        digest = hashlib.sha256(data).hexdigest()
+        stored = StoredImage(digest, extension, ())
+        # the thumbnails come first, so a picture Pillow can't read is
+        # not stored at all
+        stored = stored._replace(sizes=self._thumbnails(url, stored, data))
+        if not os.path.exists(self._path(stored.filename())):
+            self._write(stored.filename(), data)
+        key = _url_key(url)
+        self._write(os.path.join('urls', key[:2], key + '.json'),
+                    json.dumps({'url': url, 'digest': digest,
+                                'extension': extension,
+                                'sizes': list(stored.sizes)}).encode('utf-8'))
+        self._known.set(url, stored)
+        return stored
+
+    def _thumbnails(self, url, stored, data):
+        """Write the thumbnails of a picture, return their sizes"""
+        try:
+            from PIL import Image
+        except ImportError:
+            # without Pillow only the original is stored
+            return ()
+        if all(os.path.exists(self._path(stored.filename(size, webp)))
+               for size in THUMBNAIL_SIZES for webp in (False, True)):
+            return THUMBNAIL_SIZES
+        try:
+            original = Image.open(io.BytesIO(data))
+            original.load()
+        except Exception as e:
+            raise ImageError('%s is not a readable image: %s' % (url, e))
+        keep_alpha = stored.extension in ('png', 'gif')
+        original = original.convert('RGBA' if keep_alpha else 'RGB')
+        for size in THUMBNAIL_SIZES:
+            thumbnail = original.copy()
+            # never enlarges, small pictures keep their size
+            thumbnail.thumbnail((size, size), Image.LANCZOS)
+            for webp in (False, True):
+                output = io.BytesIO()
+                if webp:
+                    thumbnail.save(output, 'WEBP', quality=80)
+                elif keep_alpha:
+                    thumbnail.save(output, 'PNG', optimize=True)
+                else:
+                    thumbnail.save(output, 'JPEG', quality=85,
+                                   optimize=True, progressive=True)
+                self._write(stored.filename(size, webp), output.getvalue())
+        return THUMBNAIL_SIZES
+
+
+class ImageFetcher(object):
+    """Downloads pictures into an ImageStore on a background thread"""
+
+    def __init__(self, store, on_stored=None, allow_private=False,
+                 timeout=DEFAULT_TIMEOUT):
+        """
+        :param store: the ImageStore
+        :param on_stored: called with the scopes passed to submit once
+            their picture is stored
+        :param allow_private: also fetch from hosts with private or
+            loopback addresses, such as a local stand-in server
+        :param timeout: seconds to wait for a remote host
+        """
+        self.store = store
+        self.on_stored = on_stored
+        self.allow_private = allow_private
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, url, scopes=()):
+        """
+        Queue the download of a picture unless it is stored or queued
+        already, and return at once.
+        :param scopes: cache scopes to bump once it is stored
+        """
+        if not url or self.store.lookup(url) is not None:
+            return
+        with self._lock:
+            if url in self._pending:
+                return
+            self._pending.add(url)
+        self._start_thread()
+        self._queue.put((url, tuple(scopes)))
+
+    def _start_thread(self):
+        """Start the fetch thread of this process, after a fork too"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='image-fetcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def join(self):
+        """Wait until every queued picture is processed"""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            url, scopes = self._queue.get()
+            try:
+                self.process(url)
+                if self.on_stored is not None and scopes:
+                    self.on_stored(scopes)
+            except ImageError as e:
+                # the pages keep linking the remote picture
+                log.warning('Picture not stored: %s', e)
+            except Exception:
+                log.exception('Picture %s not stored', url)
+            finally:
+                with self._lock:
+                    self._pending.discard(url)
+                self._queue.task_done()
+
+    def process(self, url):
+        """Fetch and store one picture now, return its StoredImage"""
+        data, content_type = self.fetch(url)
+        return self.store.put(url, data, content_type)
+
+    def _check_host(self, url):
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise ImageError('%s is not an http or https URL' % url)
+        if self.allow_private:
+            return
+        try:
+            addresses = socket.getaddrinfo(parsed.hostname, None)
+        except socket.error as e:
+            raise ImageError('%s can not be resolved: %s' % (url, e))
+        for address in addresses:
+            ip = ipaddress.ip_address(address[4][0].split('%')[0])
+            if not ip.is_global:
+                raise ImageError('%s resolves to the non public address %s'
+                                 % (url, ip))
+
+    def fetch(self, url):
+        """
+        Download a picture, following redirects.
+        :return: (bytes, content type)
+        :raise ImageError: when it can't be fetched, is too large or
+            isn't one of the image types of EXTENSIONS
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            self._check_host(url)
+            try:
+                response = self.session.get(url, timeout=self.timeout,
+                                            stream=True,
+                                            allow_redirects=False)
+            except requests.RequestException as e:
+                raise ImageError('GET %s failed: %s' % (url, e))
+            with response:
+                if response.is_redirect:
+                    url = urljoin(url, response.headers['Location'])
+                    continue
+                if response.status_code != 200:
+                    raise ImageError('GET %s returned %d'
+                                     % (url, response.status_code))
+                content_type = response.headers.get('Content-Type', '') \
+                    .split(';')[0].strip().lower()
+                if content_type not in EXTENSIONS:
+                    raise ImageError('%s is %s, not an image'
+                                     % (url, content_type or 'untyped'))
+                chunks = []
+                received = 0
+                try:
+                    for chunk in response.iter_content(64 * 1024):
+                        received += len(chunk)
+                        if received > MAX_IMAGE_BYTES:
+                            raise ImageError('%s is larger than %d bytes'
+                                             % (url, MAX_IMAGE_BYTES))
+                        chunks.append(chunk)
+                except requests.RequestException as e:
+                    raise ImageError('GET %s failed: %s' % (url, e))
+                return b''.join(chunks), content_type
+        raise ImageError('%s redirects more than %d times'
+                         % (url, MAX_REDIRECTS))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Store local copies of the pictures of all items.')
+    parser.add_argument('--url', help='database URL, defaults to '
+                                      'CATALOG_DATABASE_URL')
+    parser.add_argument('--dir', default=os.environ.get(
+        'CATALOG_IMAGE_DIR', os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), 'static', 'images')),
+        help='directory of the store, defaults to CATALOG_IMAGE_DIR')
+    parser.add_argument('--allow-private', action='store_true',
+                        default=bool(os.environ.get(
+                            'CATALOG_IMAGE_ALLOW_PRIVATE')),
+                        help='fetch from private and loopback addresses')
+    args = parser.parse_args()
+
+    from sqlalchemy import text
+    from database_setup import get_engine
+
+    fetcher = ImageFetcher(ImageStore(args.dir),
+                           allow_private=args.allow_private)
+    with get_engine(args.url).connect() as connection:
+        urls = [row[0] for row in connection.execute(text(
+            "SELECT DISTINCT picture FROM item WHERE picture IS NOT NULL "
+            "AND picture != ''"))]
+    stored = failed = 0
+    for url in urls:
+        if fetcher.store.lookup(url) is not None:
+            continue
+        try:
+            fetcher.process(url)
+            stored += 1
+        except ImageError as e:
+            print("Skipped: %s" % e)
+            failed += 1
+    print("Stored %d pictures, %d failed, %d already stored"
+          % (stored, failed, len(urls) - stored - failed))
+
+
+if __name__ == '__main__':
+    main()
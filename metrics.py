@@ -0,0 +1,274 @@
+"""
+Per-route request metrics: latency, SQL queries and time, template time.
+
+Metrics hooks the SQLAlchemy engine events and the Flask request and
+template signals, and accumulates for every endpoint the number of
+requests, a latency histogram, the queries run, and the time spent in SQL
+and in templates. A request is recorded when its request context is torn
+down, or for streamed bodies when the server closes the response, so the
+queries run while streaming count too. render() returns them all in the
+Prometheus text format.
+
+Queries slower than slow_query_ms are logged to the catalog.sql logger.
+Views can declare how many queries they may run with the budget decorator;
+when budgets are enforced a request running one query more raises
+QueryBudgetExceeded at that query, which turns an N+1 regression into a
+failing request with a traceback pointing at the loop.
+"""
+import logging
+import threading
+import time
+
+from flask import g, has_app_context, request
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+
+log = logging.getLogger('catalog.sql')
+
+# upper bounds in seconds of the request latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class QueryBudgetExceeded(Exception):
+    """raised when a request runs more queries than its route's budget"""
+
+
+class RequestMetrics(object):
+    """what one request has spent so far"""
+
+    __slots__ = ('endpoint', 'method', 'status', 'streamed', 'budget',
+                 'started', 'queries', 'sql_time', 'template_time',
+                 'template_depth', 'template_started', 'slow_queries')
+
+    def __init__(self, endpoint, method, budget=None):
+        self.endpoint = endpoint
+        self.method = method
+        # replaced by the status of the response, if one is made
+        self.status = 500
+        self.streamed = False
+        self.budget = budget
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.template_started = None
+        self.slow_queries = 0
+
+
+class RouteMetrics(object):
+    """totals of every request served by one endpoint"""
+
+    def __init__(self):
+        self.requests = {}
+        self.buckets = [0] * len(BUCKETS)
+        self.duration = 0.0
+        self.count = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.slow_queries = 0
+
+
+def _current():
+    """Return the RequestMetrics of the request being served, if any"""
+    if not has_app_context():
+        return None
+    return g.get('request_metrics')
+
+
+class Metrics(object):
+    """Collects the metrics of an app and the SQL it runs"""
+
+    def __init__(self, slow_query_ms=100, enforce_budgets=False):
+        """
+        :param slow_query_ms: log queries taking longer, None to never log
+        :param enforce_budgets: raise QueryBudgetExceeded when a request
+            goes over its route's query budget
+        """
+        self.slow_query_ms = slow_query_ms
+        self.enforce_budgets = enforce_budgets
+        self.budgets = {}
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app, engine):
+        """Hook the request, template and SQL events"""
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        app.teardown_request(self._teardown_request)
+        before_render_template.connect(self._start_template, app)
+        template_rendered.connect(self._end_template, app)
+        event.listen(engine, 'before_cursor_execute', self._start_query)
+        event.listen(engine, 'after_cursor_execute', self._end_query)
+
+    def budget(self, queries):
+        """
+        Decorator declaring the most queries a view may run per request.
+        :param queries: the budget of the view
+        """
+        def decorator(f):
+            self.budgets[f.__name__] = queries
+            return f
+        return decorator
+
+    def over_budget(self):
+        """Return (endpoint, most queries run, budget) of every endpoint
+        that went over its budget at least once"""
+        with self._lock:
+            return sorted(
+                (endpoint, route.max_queries, self.budgets[endpoint])
+                for endpoint, route in self.routes.items()
+                if endpoint in self.budgets and
+                route.max_queries > self.budgets[endpoint])
+
+    def _start_request(self):
+        endpoint = request.endpoint or 'unmatched'
+        g.request_metrics = RequestMetrics(endpoint, request.method,
+                                           self.budgets.get(endpoint))
+
+    def _end_request(self, response):
+        current = _current()
+        if current is not None:
+            current.status = response.status_code
+            if response.is_streamed:
+                current.streamed = True
+                response.call_on_close(lambda: self._record(current))
+        return response
+
+    def _teardown_request(self, exception=None):
+        current = _current()
+        if current is not None and not current.streamed:
+            self._record(current)
+
+    def _record(self, current):
+        duration = time.perf_counter() - current.started
+        with self._lock:
+            route = self.routes.get(current.endpoint)
+            if route is None:
+                route = self.routes[current.endpoint] = RouteMetrics()
+            key = (current.method, current.status)
+            route.requests[key] = route.requests.get(key, 0) + 1
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    route.buckets[i] += 1
+            route.duration += duration
+            route.count += 1
+            route.queries += current.queries
+            route.max_queries = max(route.max_queries, current.queries)
+            route.sql_time += current.sql_time
+            route.template_time += current.template_time
+            route.slow_queries += current.slow_queries
+
+    def _start_template(self, sender, **extra):
+        current = _current()
+        if current is not None:
+            # templates rendered inside another one, such as cached
+            # fragments, are part of the outer one's time
+            if current.template_depth == 0:
+                current.template_started = time.perf_counter()
+            current.template_depth += 1
+
+    def _end_template(self, sender, **extra):
+        current = _current()
+        if current is not None and current.template_depth:
+            current.template_depth -= 1
+            if current.template_depth == 0:
+                current.template_time += \
+                    time.perf_counter() - current.template_started
+
+    def _start_query(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        context._metrics_started = time.perf_counter()
+        current = _current()
+        if current is None:
+            return
+        current.queries += 1
+        if self.enforce_budgets and current.budget is not None and \
+                current.queries > current.budget:
+            raise QueryBudgetExceeded(
+                '%s ran query %d with a budget of %d: %s'
+                % (current.endpoint, current.queries, current.budget,
+                   statement))
+
+    def _end_query(self, conn, cursor, statement, parameters, context,
+                   executemany):
+        elapsed = time.perf_counter() - context._metrics_started
+        current = _current()
+        if current is not None:
+            current.sql_time += elapsed
+        if self.slow_query_ms is not None and \
+                elapsed * 1000 > self.slow_query_ms:
+            if current is not None:
+                current.slow_queries += 1
+            log.warning('Slow query (%.1fms) in %s: %s %r',
+                        elapsed * 1000,
+                        current.endpoint if current else 'no request',
+                        statement, parameters)
+
+    def render(self, extra=None):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        :param extra: list of (name, type, help, value) of more metrics
+            without labels
+        """
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % pair for pair in labels)
+                lines.append('%s{%s} %s' % (name, label_text, value)
+                             if label_text else '%s %s' % (name, value))
+
+        with self._lock:
+            routes = sorted(self.routes.items())
+            family('catalog_requests_total', 'counter',
+                   'Requests served by endpoint, method and status',
+                   [((('endpoint', endpoint), ('method', method),
+                      ('status', status)), count)
+                    for endpoint, route in routes
+                    for (method, status), count
+                    in sorted(route.requests.items())])
+            family('catalog_request_duration_seconds', 'histogram',
+                   'Time to serve a request, body included', [])
+            for endpoint, route in routes:
+                for bound, count in zip(BUCKETS, route.buckets):
+                    lines.append('catalog_request_duration_seconds_bucket'
+                                 '{endpoint="%s",le="%r"} %d'
+                                 % (endpoint, bound, count))
+                lines.append('catalog_request_duration_seconds_bucket'
+                             '{endpoint="%s",le="+Inf"} %d'
+                             % (endpoint, route.count))
+                lines.append('catalog_request_duration_seconds_sum'
+                             '{endpoint="%s"} %.6f' % (endpoint,
+                                                       route.duration))
+                lines.append('catalog_request_duration_seconds_count'
+                             '{endpoint="%s"} %d' % (endpoint, route.count))
+            for name, kind, help, attribute, fmt in (
+                    ('catalog_sql_queries_total', 'counter',
+                     'SQL statements run', 'queries', '%d'),
+                    ('catalog_sql_queries_per_request_max', 'gauge',
+                     'Most SQL statements run by one request',
+                     'max_queries', '%d'),
+                    ('catalog_sql_seconds_total', 'counter',
+                     'Time spent running SQL', 'sql_time', '%.6f'),
+                    ('catalog_template_seconds_total', 'counter',
+                     'Time spent rendering templates', 'template_time',
+                     '%.6f'),
+                    ('catalog_slow_queries_total', 'counter',
+                     'SQL statements slower than the slow query threshold',
+                     'slow_queries', '%d')):
+                family(name, kind, help,
+                       [((('endpoint', endpoint),),
+                         fmt % getattr(route, attribute))
+                        for endpoint, route in routes])
+            family('catalog_sql_query_budget', 'gauge',
+                   'Most SQL statements a request of the endpoint may run',
+                   [((('endpoint', endpoint),), budget)
+                    for endpoint, budget in sorted(self.budgets.items())])
+        for name, kind, help, value in extra or []:
+            family(name, kind, help, [((), value)])
+        return '\n'.join(lines) + '\n'
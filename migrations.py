@@ -0,0 +1,408 @@
+"""
+Versioned schema migrations for the item catalog database.
+
+New databases get their full schema from Base.metadata.create_all, existing
+databases are brought up to date in place by running every migration newer
+than the version recorded in the schema_version table. Each migration is
+written so it can also run against a database that create_all has already
+built, which keeps fresh and upgraded databases identical.
+
+Usage:
+    python migrations.py            upgrade the configured database
+    python migrations.py --explain  show the query plans of the hot queries
+    python migrations.py --check-counts   compare the category item counts
+                                          with the items
+    python migrations.py --repair-counts  recount them where they are wrong
+"""
+import argparse
+import sys
+
+from sqlalchemy import inspect, text
+
+from database_setup import Base, REVISION_CLOCK, get_engine
+from slugs import unique_slugs
+
+
+def _create_lookup_indexes(connection):
+    """indexes for the category, owner and email lookups"""
+    for statement in (
+            'CREATE INDEX IF NOT EXISTS ix_item_category_id_name '
+            'ON item (category_id, name)',
+            'CREATE INDEX IF NOT EXISTS ix_item_user_id ON item (user_id)',
+            'CREATE INDEX IF NOT EXISTS ix_category_user_id '
+            'ON category (user_id)',
+            'CREATE INDEX IF NOT EXISTS ix_users_email ON users (email)'):
+        connection.execute(text(statement))
+
+
+def _add_column(connection, table, column, ddl):
+    """Add a column unless create_all already built the table with it"""
+    columns = [c['name'] for c in inspect(connection).get_columns(table)]
+    if column in columns:
+        return False
+    connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s'
+                            % (table, column, ddl)))
+    return True
+
+
+def _add_item_updated_at(connection):
+    """modification time of items, for incremental exports"""
+    if _add_column(connection, 'item', 'updated_at', 'DATETIME'):
+        connection.execute(text(
+            'UPDATE item SET updated_at = CURRENT_TIMESTAMP'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_item_updated_at '
+                            'ON item (updated_at)'))
+
+
+def _create_item_search_index(connection):
+    """FTS5 index over item names and descriptions, kept in sync by
+    triggers so every write path, ORM or bulk, updates it. The category id
+    is indexed too, so filtering by category is a posting list
+    intersection inside the index."""
+    if connection.dialect.name != 'sqlite':
+        return
+    columns = 'name, description, category_id'
+    old = ', '.join('old.' + c for c in columns.split(', '))
+    new = ', '.join('new.' + c for c in columns.split(', '))
+    for statement in (
+            "CREATE VIRTUAL TABLE IF NOT EXISTS item_fts USING fts5("
+            "%s, content='item', content_rowid='id', "
+            "tokenize='unicode61', prefix='2 3')" % columns,
+            "CREATE TRIGGER IF NOT EXISTS item_fts_insert "
+            "AFTER INSERT ON item BEGIN "
+            "INSERT INTO item_fts (rowid, %s) VALUES (new.id, %s); END"
+            % (columns, new),
+            "CREATE TRIGGER IF NOT EXISTS item_fts_delete "
+            "AFTER DELETE ON item BEGIN "
+            "INSERT INTO item_fts (item_fts, rowid, %s) "
+            "VALUES ('delete', old.id, %s); END" % (columns, old),
+            "CREATE TRIGGER IF NOT EXISTS item_fts_update "
+            "AFTER UPDATE OF %s ON item BEGIN "
+            "INSERT INTO item_fts (item_fts, rowid, %s) "
+            "VALUES ('delete', old.id, %s); "
+            "INSERT INTO item_fts (rowid, %s) VALUES (new.id, %s); END"
+            % (columns, columns, old, columns, new),
+            "INSERT INTO item_fts (item_fts) VALUES ('rebuild')"):
+        connection.execute(text(statement))
+
+
+# recounts the items of every category
+RECOUNT_ITEMS = ('UPDATE category SET item_count = (SELECT COUNT(*) FROM item '
+                 'WHERE item.category_id = category.id)')
+
+
+def _maintain_item_counts(connection):
+    """number of items of each category, kept up to date by triggers in
+    the transaction of every insert, delete or move of an item, whichever
+    path writes it, so listing categories with their counts is one query.
+    Deleting a category deletes its items first, which leaves nothing to
+    count."""
+    _add_column(connection, 'category', 'item_count',
+                'INTEGER NOT NULL DEFAULT 0')
+    if connection.dialect.name == 'sqlite':
+        statements = [
+            "CREATE TRIGGER IF NOT EXISTS item_count_insert "
+            "AFTER INSERT ON item BEGIN "
+            "UPDATE category SET item_count = item_count + 1 "
+            "WHERE id = new.category_id; END",
+            "CREATE TRIGGER IF NOT EXISTS item_count_delete "
+            "AFTER DELETE ON item BEGIN "
+            "UPDATE category SET item_count = item_count - 1 "
+            "WHERE id = old.category_id; END",
+            "CREATE TRIGGER IF NOT EXISTS item_count_update "
+            "AFTER UPDATE OF category_id ON item "
+            "WHEN old.category_id IS NOT new.category_id BEGIN "
+            "UPDATE category SET item_count = item_count - 1 "
+            "WHERE id = old.category_id; "
+            "UPDATE category SET item_count = item_count + 1 "
+            "WHERE id = new.category_id; END"]
+    elif connection.dialect.name == 'postgresql':
+        statements = [
+            "CREATE OR REPLACE FUNCTION item_count_trigger() "
+            "RETURNS trigger AS $$ BEGIN "
+            "IF TG_OP = 'UPDATE' AND "
+            "old.category_id IS NOT DISTINCT FROM new.category_id THEN "
+            "RETURN NULL; END IF; "
+            "IF TG_OP IN ('UPDATE', 'DELETE') THEN "
+            "UPDATE category SET item_count = item_count - 1 "
+            "WHERE id = old.category_id; END IF; "
+            "IF TG_OP IN ('UPDATE', 'INSERT') THEN "
+            "UPDATE category SET item_count = item_count + 1 "
+            "WHERE id = new.category_id; END IF; "
+            "RETURN NULL; END $$ LANGUAGE plpgsql",
+            "DROP TRIGGER IF EXISTS item_count ON item",
+            "CREATE TRIGGER item_count "
+            "AFTER INSERT OR DELETE OR UPDATE OF category_id ON item "
+            "FOR EACH ROW EXECUTE PROCEDURE item_count_trigger()"]
+    else:
+        raise NotImplementedError('No item count triggers for %s'
+                                  % connection.dialect.name)
+    for statement in statements + [RECOUNT_ITEMS]:
+        connection.execute(text(statement))
+
+
+def _add_slugs(connection):
+    """URL slugs of the categories and items. Names giving the same slug,
+    such as 'Rock Climbing' and 'rock climbing', are numbered in id
+    order."""
+    for table in ('category', 'item'):
+        _add_column(connection, table, 'slug', 'VARCHAR(250)')
+        rows = connection.execute(text(
+            'SELECT id, name FROM %s WHERE slug IS NULL ORDER BY id'
+            % table)).all()
+        if rows:
+            taken = connection.execute(text(
+                'SELECT slug FROM %s WHERE slug IS NOT NULL' % table))
+            connection.execute(
+                text('UPDATE %s SET slug = :slug WHERE id = :id' % table),
+                [{'id': id, 'slug': slug} for id, slug
+                 in unique_slugs(rows, taken.scalars())])
+        connection.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS '
+                                'ix_%s_slug ON %s (slug)' % (table, table)))
+
+
+# scopes of the response cache bumped by the writes to each table, see
+# views.invalidate: (trigger event, scopes) pairs. The page of a new item
+# can't be cached yet, its category page is bumped instead; the item count
+# of a category moves with its items, which bump the same pages already.
+_CATEGORY_OF = "(SELECT slug FROM category WHERE id = %s.category_id)"
+REVISION_TRIGGERS = {
+    'category': [
+        ('INSERT', ["'categories'", "'category:' || new.slug"]),
+        ('DELETE', ["'categories'", "'category:' || old.slug"]),
+        ('UPDATE OF name, user_id, slug',
+         ["'categories'", "'category:' || old.slug",
+          "'category:' || new.slug"]),
+    ],
+    'item': [
+        ('INSERT', ["'items'", "'category:' || " + _CATEGORY_OF % 'new']),
+        ('DELETE', ["'items'", "'item:' || old.slug",
+                    "'category:' || " + _CATEGORY_OF % 'old']),
+        ('UPDATE', ["'items'", "'item:' || old.slug", "'item:' || new.slug",
+                    "'category:' || " + _CATEGORY_OF % 'old',
+                    "'category:' || " + _CATEGORY_OF % 'new']),
+    ],
+}
+
+
+def _track_revisions(connection):
+    """revisions of the response cache scopes, bumped by triggers in the
+    transaction of every write to the categories and items, whichever
+    process or script makes it, so every worker sees every change, see
+    cache.DatabaseRevisions. A revision is the database time in
+    milliseconds, or one more than the previous revision of its scope."""
+    clock = REVISION_CLOCK.get(connection.dialect.name)
+    if connection.dialect.name == 'sqlite':
+        bump = ("INSERT INTO catalog_revision (scope, revision) "
+                "SELECT scope, %s FROM (SELECT %%s AS scope) "
+                "WHERE scope IS NOT NULL ON CONFLICT (scope) DO UPDATE "
+                "SET revision = MAX(excluded.revision, revision + 1); "
+                % clock)
+        statements = [
+            "CREATE TRIGGER IF NOT EXISTS %s_revision_%s "
+            "AFTER %s ON %s BEGIN %sEND"
+            % (table, event.split()[0].lower(), event, table,
+               ''.join(bump % scope for scope in scopes))
+            for table, triggers in sorted(REVISION_TRIGGERS.items())
+            for event, scopes in triggers]
+    elif connection.dialect.name == 'postgresql':
+        statements = [
+            "CREATE OR REPLACE FUNCTION catalog_revision_bump(bumped text) "
+            "RETURNS void AS $$ BEGIN "
+            "IF bumped IS NULL THEN RETURN; END IF; "
+            "INSERT INTO catalog_revision (scope, revision) "
+            "VALUES (bumped, %s) ON CONFLICT (scope) DO UPDATE "
+            "SET revision = GREATEST(excluded.revision, "
+            "catalog_revision.revision + 1); "
+            "END $$ LANGUAGE plpgsql" % clock]
+        for table, triggers in sorted(REVISION_TRIGGERS.items()):
+            statements += [
+                "CREATE OR REPLACE FUNCTION %s_revision_trigger() "
+                "RETURNS trigger AS $$ BEGIN %s"
+                "RETURN NULL; END $$ LANGUAGE plpgsql"
+                % (table, ''.join(
+                    "IF TG_OP = '%s' THEN %sEND IF; "
+                    % (event.split()[0], ''.join(
+                        'PERFORM catalog_revision_bump(%s); ' % scope
+                        for scope in scopes))
+                    for event, scopes in triggers)),
+                "DROP TRIGGER IF EXISTS %s_revision ON %s" % (table, table),
+                "CREATE TRIGGER %s_revision AFTER %s ON %s "
+                "FOR EACH ROW EXECUTE PROCEDURE %s_revision_trigger()"
+                % (table, ' OR '.join(event for event, scopes in triggers),
+                   table, table)]
+    else:
+        raise NotImplementedError('No revision triggers for %s'
+                                  % connection.dialect.name)
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+# (version, function) pairs, applied in order, never reorder or renumber
+MIGRATIONS = [
+    (1, _create_lookup_indexes),
+    (2, _add_item_updated_at),
+    (3, _create_item_search_index),
+    (4, _maintain_item_counts),
+    (5, _add_slugs),
+    (6, _track_revisions),
+]
+
+# the queries run on every page view, with sample parameters
+HOT_QUERIES = [
+    ('items of a category by name',
+     'SELECT id, name FROM item WHERE category_id = :category_id '
+     'ORDER BY name, id LIMIT 51',
+     {'category_id': 1}),
+    ('items of a category after a cursor',
+     'SELECT id, name FROM item WHERE category_id = :category_id '
+     'AND (name > :name OR (name = :name AND id > :id)) '
+     'ORDER BY name, id LIMIT 51',
+     {'category_id': 1, 'name': 'a', 'id': 1}),
+    ('items by name',
+     'SELECT id, name FROM item ORDER BY name, id LIMIT 51', {}),
+    ('categories with their item counts',
+     'SELECT id, name, item_count FROM category ORDER BY name', {}),
+    ('category by name',
+     'SELECT id FROM category WHERE name = :name', {'name': 'Soccer'}),
+    ('category by slug',
+     'SELECT id FROM category WHERE slug = :slug', {'slug': 'soccer'}),
+    ('item by slug',
+     'SELECT id FROM item WHERE slug = :slug', {'slug': 'jersey'}),
+    ('items written since the route index was loaded',
+     'SELECT slug, id FROM item WHERE updated_at >= :since',
+     {'since': '2024-01-01 00:00:00'}),
+    ('user by email',
+     'SELECT id FROM users WHERE email = :email', {'email': 'a@b.c'}),
+]
+
+
+def current_version(connection):
+    """Return the schema version of the database, 0 if never migrated"""
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_version (version INTEGER)'))
+    version = connection.execute(
+        text('SELECT MAX(version) FROM schema_version')).scalar()
+    return version or 0
+
+
+def upgrade(engine):
+    """
+    Create missing tables and apply pending migrations, each in its own
+    transaction together with the bump of the recorded version.
+    :param engine: engine of the database to upgrade
+    :return: the list of applied migration versions
+    """
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        version = current_version(connection)
+    applied = []
+    for number, migration in MIGRATIONS:
+        if number <= version:
+            continue
+        with engine.begin() as connection:
+            migration(connection)
+            connection.execute(
+                text('INSERT INTO schema_version (version) VALUES (:v)'),
+                {'v': number})
+        applied.append(number)
+    return applied
+
+
+def reset(engine):
+    """
+    Drop every table of the catalog, including the ones managed only by
+    migrations, so the next upgrade rebuilds an empty database.
+    """
+    Base.metadata.drop_all(engine)
+    with engine.begin() as connection:
+        for table in ('item_fts', 'schema_version'):
+            connection.execute(text('DROP TABLE IF EXISTS %s' % table))
+        if connection.dialect.name == 'postgresql':
+            for function in ('item_count_trigger()',
+                             'category_revision_trigger()',
+                             'item_revision_trigger()',
+                             'catalog_revision_bump(text)'):
+                connection.execute(text(
+                    'DROP FUNCTION IF EXISTS %s' % function))
+
+
+def check_item_counts(connection, repair=False):
+    """
+    Compare the stored item count of every category with its items.
+    :param connection: connection to the catalog database
+    :param repair: recount the items of every category, in the
+        connection's transaction
+    :return: list of (category name, stored count, actual count) of the
+        categories whose count was wrong
+    """
+    wrong = connection.execute(text(
+        'SELECT name, item_count, actual FROM category JOIN '
+        '(SELECT category.id AS id, COUNT(item.id) AS actual FROM category '
+        'LEFT JOIN item ON item.category_id = category.id '
+        'GROUP BY category.id) AS counts ON counts.id = category.id '
+        'WHERE item_count != actual ORDER BY name')).all()
+    if repair and wrong:
+        connection.execute(text(RECOUNT_ITEMS))
+    return [tuple(row) for row in wrong]
+
+
+def explain_hot_queries(engine):
+    """
+    Return the SQLite query plan of each hot query, to check that the
+    lookups are served by an index instead of a full table scan.
+    :return: list of (description, [plan lines])
+    """
+    plans = []
+    with engine.connect() as connection:
+        for description, sql, params in HOT_QUERIES:
+            rows = connection.execute(text('EXPLAIN QUERY PLAN ' + sql),
+                                      params)
+            plans.append((description, [row[-1] for row in rows]))
+    return plans
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Upgrade the item catalog database schema in place.')
+    parser.add_argument('--url', help='database URL, defaults to '
+                                      'CATALOG_DATABASE_URL')
+    parser.add_argument('--explain', action='store_true',
+                        help='print the query plans of the hot queries')
+    parser.add_argument('--check-counts', action='store_true',
+                        help='compare the item counts of the categories '
+                             'with their items')
+    parser.add_argument('--repair-counts', action='store_true',
+                        help='recount the items of the categories whose '
+                             'count is wrong')
+    args = parser.parse_args()
+
+    engine = get_engine(args.url)
+    applied = upgrade(engine)
+    if applied:
+        print("Applied migrations %s" % ', '.join(map(str, applied)))
+    else:
+        print("Database schema is up to date")
+
+    if args.check_counts or args.repair_counts:
+        with engine.begin() as connection:
+            wrong = check_item_counts(connection, repair=args.repair_counts)
+        for name, stored, actual in wrong:
+            print("Category %s counts %d items, holds %d"
+                  % (name, stored, actual))
+        if not wrong:
+            print("Item counts are correct")
+        elif args.repair_counts:
+            print("Repaired the item counts of %d categories" % len(wrong))
+        else:
+            sys.exit(1)
+
+    if args.explain:
+        for description, plan in explain_hot_queries(engine):
+            print("%s:" % description)
+            for line in plan:
+                print("    %s" % line)
+
+
+if __name__ == '__main__':
+    main()
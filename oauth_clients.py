@@ -0,0 +1,280 @@
+"""
+Clients for the Google and Facebook APIs used by the login flow.
+
+The client secrets are read once when a client is created, and every
+client keeps a pooled requests session, so successive logins reuse open
+keep-alive TLS connections instead of paying a new handshake per call.
+Calls have a timeout, and idempotent ones are retried on connection errors
+and 5xx answers. A base_url replaces the provider hosts, which lets the
+clients run against a local stub server.
+
+The login views run the provider calls through run_concurrently, which
+starts the independent calls of a step at the same time and gives up on
+them at a deadline, so a slow provider holds a worker for at most the
+deadline instead of the sum of its answer times. Every client runs its
+calls on its own small thread pool, and refuses new calls while all its
+threads are still busy with calls given up on, so a slow provider can only
+fail its own logins and never starves the logins through the others.
+"""
+import base64
+import json
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+# seconds to wait for a provider to connect and to answer
+DEFAULT_TIMEOUT = 5
+# extra attempts for GET and DELETE calls
+DEFAULT_RETRIES = 2
+# keep-alive connections kept open, and calls running at once, per provider
+DEFAULT_POOL_SIZE = 10
+# seconds a login step may wait for the provider before failing
+DEFAULT_DEADLINE = 3
+
+
+class ProviderError(Exception):
+    """raised when a provider can't be reached or rejects a call"""
+
+
+def load_secrets(path):
+    """Return the 'web' section of a client secrets file"""
+    with open(path, 'r') as f:
+        return json.load(f)['web']
+
+
+def decode_id_token(id_token):
+    """
+    Return the claims of a Google ID token. The token comes straight from
+    Google's token endpoint over TLS, so like oauth2client we only decode
+    the payload without checking the signature.
+    """
+    try:
+        payload = id_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload).decode('utf-8'))
+    except (AttributeError, IndexError, TypeError, ValueError):
+        raise ProviderError('Invalid ID token')
+
+
+def run_concurrently(*calls, **kwargs):
+    """
+    Run independent provider calls at the same time and wait for all of
+    them, at most until the deadline. The calls left at the deadline are
+    cancelled when they haven't started yet, a call already running ends on
+    its own at the client timeout and holds a thread of its client until
+    then.
+    :param calls: (method, arg, ...) tuples, the methods being those of
+        ProviderClient instances
+    :param deadline: seconds to wait, DEFAULT_DEADLINE when omitted
+    :return: list of the results, in the order of the calls
+    :raise ProviderError: when a call fails or the deadline passes
+    """
+    deadline = kwargs.get('deadline') or DEFAULT_DEADLINE
+    futures = []
+    try:
+        for call in calls:
+            futures.append(call[0].__self__.submit(call[0], *call[1:]))
+        done, pending = wait(futures, deadline,
+                             return_when=FIRST_EXCEPTION)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    for future in pending:
+        future.cancel()
+    for future in futures:
+        if future in done and future.exception() is not None:
+            raise future.exception()
+    if pending:
+        raise ProviderError('Provider did not answer within %s seconds'
+                            % deadline)
+    return [future.result() for future in futures]
+
+
+class ProviderClient(object):
+    """
+    Pooled HTTP session and thread pool shared by all the calls to one
+    provider
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 pool_size=DEFAULT_POOL_SIZE):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=pool_size,
+            thread_name_prefix='catalog-%s' % type(self).__name__)
+        # a slot per thread, so that calls never queue behind stuck ones
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self.session = requests.Session()
+        # POST calls, such as exchanging a single use code, are not retried
+        retry = Retry(total=retries, backoff_factor=0.1,
+                      status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'DELETE']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def submit(self, function, *args):
+        """
+        Start a call on the threads of the provider.
+        :return: the concurrent.futures.Future of the call
+        :raise ProviderError: when all the threads are busy
+        """
+        if not self._slots.acquire(False):
+            raise ProviderError('%s has %d calls still running'
+                                % (type(self).__name__, self.pool_size))
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        return future
+
+    def request(self, method, url, **kwargs):
+        """
+        Call the provider.
+        :return: the requests.Response, whatever its status
+        :raise ProviderError: when the provider can't be reached in time
+        """
+        try:
+            return self.session.request(method, url, timeout=self.timeout,
+                                        **kwargs)
+        except requests.RequestException as e:
+            raise ProviderError('%s %s failed: %s' % (method, url, e))
+
+    def request_json(self, method, url, **kwargs):
+        """Call the provider and decode its JSON answer"""
+        response = self.request(method, url, **kwargs)
+        try:
+            return response.json()
+        except ValueError:
+            raise ProviderError('%s %s returned no JSON (status %d)'
+                                % (method, url, response.status_code))
+
+
+class GoogleClient(ProviderClient):
+    """Google OAuth 2.0 code exchange, token and profile calls"""
+
+    def __init__(self, secrets_path='client_secrets.json', base_url=None,
+                 **kwargs):
+        """
+        :param secrets_path: client secrets downloaded from Google
+        :param base_url: replaces https://accounts.google.com and
+            https://www.googleapis.com, for a stub server
+        """
+        super(GoogleClient, self).__init__(**kwargs)
+        secrets = load_secrets(secrets_path)
+        self.client_id = secrets['client_id']
+        self.client_secret = secrets['client_secret']
+        self.token_uri = secrets['token_uri']
+        self.accounts_url = 'https://accounts.google.com'
+        self.api_url = 'https://www.googleapis.com'
+        if base_url:
+            self.token_uri = base_url + urlparse(self.token_uri).path
+            self.accounts_url = self.api_url = base_url
+
+    def exchange_code(self, code):
+        """
+        Upgrade a one-time authorization code from the sign in button.
+        :return: (access token, claims of the ID token)
+        """
+        response = self.request('POST', self.token_uri, data={
+            'grant_type': 'authorization_code',
+            'code': code,
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'redirect_uri': 'postmessage'})
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        if response.status_code != 200 or 'access_token' not in data:
+            raise ProviderError('Code exchange failed: %s'
+                                % data.get('error', response.status_code))
+        return data['access_token'], decode_id_token(data.get('id_token'))
+
+    def token_info(self, access_token):
+        """Return what Google knows about an access token"""
+        return self.request_json('GET', self.api_url + '/oauth2/v1/tokeninfo',
+                                 params={'access_token': access_token})
+
+    def user_info(self, access_token):
+        """Return the profile of the user owning the access token"""
+        return self.request_json('GET', self.api_url + '/oauth2/v1/userinfo',
+                                 params={'access_token': access_token,
+                                         'alt': 'json'})
+
+    def revoke(self, access_token):
+        """
+        Revoke an access token.
+        :return: True when Google accepted the revocation
+        """
+        response = self.request('GET', self.accounts_url + '/o/oauth2/revoke',
+                                params={'token': access_token})
+        return response.status_code == 200
+
+
+class FacebookClient(ProviderClient):
+    """Facebook Graph API token exchange and profile calls"""
+
+    def __init__(self, secrets_path='fb_client_secrets.json', base_url=None,
+                 **kwargs):
+        """
+        :param secrets_path: app id and secret of the Facebook app
+        :param base_url: replaces https://graph.facebook.com, for a stub
+            server
+        """
+        super(FacebookClient, self).__init__(**kwargs)
+        secrets = load_secrets(secrets_path)
+        self.app_id = secrets['app_id']
+        self.app_secret = secrets['app_secret']
+        self.graph_url = base_url or 'https://graph.facebook.com'
+
+    def exchange_token(self, short_lived_token):
+        """Swap the token from the JavaScript SDK for a long-lived one"""
+        data = self.request_json(
+            'GET', self.graph_url + '/oauth/access_token',
+            params={'grant_type': 'fb_exchange_token',
+                    'client_id': self.app_id,
+                    'client_secret': self.app_secret,
+                    'fb_exchange_token': short_lived_token})
+        if not data.get('access_token'):
+            raise ProviderError('Token exchange failed: %s'
+                                % data.get('error'))
+        return data['access_token']
+
+    def me(self, access_token):
+        """Return the name, id and email of the user"""
+        return self.request_json('GET', self.graph_url + '/v2.8/me',
+                                 params={'access_token': access_token,
+                                         'fields': 'name,id,email'})
+
+    def picture_url(self, access_token):
+        """Return the URL of the user's profile picture"""
+        data = self.request_json(
+            'GET', self.graph_url + '/v2.8/me/picture',
+            params={'access_token': access_token, 'redirect': 0,
+                    'height': 200, 'width': 200})
+        try:
+            return data['data']['url']
+        except (KeyError, TypeError):
+            raise ProviderError('No picture in %r' % (data,))
+
+    def revoke(self, facebook_id, access_token):
+        """Remove the app's permissions for the user"""
+        response = self.request(
+            'DELETE', self.graph_url + '/%s/permissions' % facebook_id,
+            params={'access_token': access_token})
+        return response.status_code == 200
@@ -0,0 +1,110 @@
+import base64
+import json
+from collections import namedtuple
+
+from sqlalchemy import and_, or_, asc, desc
+
+# Default and largest number of rows returned on one page
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+# items of the current page and the cursors of its neighbours
+Page = namedtuple('Page', ['items', 'next_cursor', 'prev_cursor'])
+
+
+class InvalidCursor(ValueError):
+    """raised when a cursor or limit from the query string can't be used"""
+
+
+def encode_cursor(name, id):
+    """
+    Encode the (name, id) key of a row, or its (score, id) key in a
+    search, into an opaque URL-safe token
+    """
+    raw = json.dumps([name, id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        key, id = json.loads(raw.decode('utf-8'))
+    except (TypeError, ValueError):
+        raise InvalidCursor('Invalid cursor %r' % cursor)
+    # bool is an int too
+    if not isinstance(id, int) or isinstance(id, bool):
+        raise InvalidCursor('Invalid cursor %r' % cursor)
+    return key, id
+
+
+def decode_cursor(cursor):
+    """Decode a token made by encode_cursor back into (name, id)"""
+    name, id = _decode(cursor)
+    if not isinstance(name, str):
+        raise InvalidCursor('Invalid cursor %r' % cursor)
+    return name, id
+
+
+def decode_score_cursor(cursor):
+    """Decode a token made by encode_cursor back into (score, id)"""
+    score, id = _decode(cursor)
+    if not isinstance(score, (int, float)) or isinstance(score, bool):
+        raise InvalidCursor('Invalid cursor %r' % cursor)
+    return score, id
+
+
+def parse_limit(value, default=DEFAULT_LIMIT):
+    """Turn the limit query parameter into a page size in 1..MAX_LIMIT"""
+    if value is None or value == '':
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise InvalidCursor('Invalid limit %r' % value)
+    if limit < 1:
+        raise InvalidCursor('Invalid limit %r' % value)
+    return min(limit, MAX_LIMIT)
+
+
+def paginate(query, name_column, id_column, limit, cursor=None,
+             before=None):
+    """
+    Return one page of a query ordered by (name, id) using keyset
+    pagination: the page starts right after (or ends right before) the key
+    stored in the cursor, so deep pages cost the same as the first one.
+    :param query: query to page through, without an ORDER BY
+    :param name_column: column holding the name of the row
+    :param id_column: primary key column breaking ties between names
+    :param limit: number of rows on the page
+    :param cursor: token of the row the page starts after
+    :param before: token of the row the page ends before
+    :return: a Page
+    """
+    if before is not None:
+        name, id = decode_cursor(before)
+        rows = query.filter(or_(name_column < name,
+                                and_(name_column == name, id_column < id)))\
+            .order_by(desc(name_column), desc(id_column))\
+            .limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit][::-1]
+        prev_cursor = _row_cursor(rows[0]) if has_more else None
+        next_cursor = _row_cursor(rows[-1]) if rows else None
+        return Page(rows, next_cursor, prev_cursor)
+
+    if cursor is not None:
+        name, id = decode_cursor(cursor)
+        query = query.filter(or_(name_column > name,
+                                 and_(name_column == name, id_column > id)))
+    rows = query.order_by(asc(name_column), asc(id_column))\
+        .limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = _row_cursor(rows[-1]) if has_more else None
+    prev_cursor = _row_cursor(rows[0]) if cursor is not None and rows \
+        else None
+    return Page(rows, next_cursor, prev_cursor)
+
+
+def _row_cursor(row):
+    return encode_cursor(row.name, row.id)
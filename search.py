@@ -0,0 +1,217 @@
+"""
+Full-text search over item names and descriptions.
+
+On SQLite the search runs against the item_fts FTS5 table created by
+migration 3. The index only finds the MAX_CANDIDATES newest matches, which
+are ranked here with BM25, weighting name matches over description
+matches, so a query on a word found in most items costs the same as one on
+a rare word: the results are the best of those candidates, best first.
+FTS5's own bm25() isn't used since it reads every match of each word to
+count them, whatever the LIMIT. Pages are cut with a keyset on (score, id),
+deep pages cost the same as the first one. Other databases fall back to a
+LIKE scan, ordered and paged on (name, id).
+"""
+import re
+from collections import namedtuple
+
+from sqlalchemy import text
+
+from pagination import Page, decode_cursor, decode_score_cursor, \
+    encode_cursor
+
+# a name match counts this many times more than a description match
+NAME_WEIGHT = 10.0
+# most matches ranked by a search, the newest ones
+MAX_CANDIDATES = 500
+# term frequency saturation and length normalization, those of FTS5
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# words as the unicode61 tokenizer of item_fts splits them
+TOKEN = re.compile(r'[^\W_]+', re.UNICODE)
+
+_SearchResult = namedtuple('SearchResult', ['id', 'name', 'description',
+                                            'category_id', 'category', 'slug',
+                                            'category_slug', 'rank'])
+
+
+class SearchResult(_SearchResult):
+    """
+    one matching item with the name and slug of its category, and its rank
+    in the results: the BM25 score on SQLite, the name elsewhere
+    """
+    __slots__ = ()
+
+    @property
+    def cursor(self):
+        """Return the token of the (rank, id) key of the result"""
+        return encode_cursor(self.rank, self.id)
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {
+            'name': self.name,
+            'id': self.id,
+            'cat_id': self.category_id,
+            'category': self.category,
+            'description': self.description
+        }
+
+
+def match_expression(query, category_id=None):
+    """
+    Turn free text into an FTS5 query matching items that contain every
+    word, the last word also as a prefix so results show up while typing.
+    Words are quoted so FTS5 operators in the input are taken literally.
+    :param query: text typed by the user
+    :param category_id: only match items of this category
+    :return: the expression or None when the text has no words
+    """
+    words = re.findall(r'\w+', query, re.UNICODE)
+    if not words:
+        return None
+    terms = ['"%s"' % word for word in words]
+    terms[-1] += '*'
+    expression = '{name description}: (%s)' % ' '.join(terms)
+    if category_id is not None:
+        expression += ' AND category_id: "%d"' % category_id
+    return expression
+
+
+def bm25_scores(rows, words):
+    """
+    Score candidates with BM25 like FTS5's bm25(), lower being better.
+    Every candidate contains every word, so over the candidates the words
+    are equally rare and weigh the same. To keep the scoring to a few
+    string searches per candidate, a word is counted each time a space
+    separated word of the candidate starts with it, and lengths are
+    counted in characters.
+    :param rows: (name, description) of the candidates
+    :param words: words of the query
+    :return: list of the scores, in the order of the rows
+    """
+    words = [' ' + word.lower() for word in words]
+    rows = [(' ' + (name or '').lower(), ' ' + (description or '').lower())
+            for name, description in rows]
+    lengths = [len(name) + len(description) for name, description in rows]
+    average = float(sum(lengths)) / len(lengths) if lengths else 1.0
+    scores = []
+    for (name, description), length in zip(rows, lengths):
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average)
+        score = 0.0
+        for word in words:
+            f = NAME_WEIGHT * name.count(word) + description.count(word)
+            score -= f * (BM25_K1 + 1) / (f + norm)
+        scores.append(score)
+    return scores
+
+
+def _dialect_name(connection):
+    bind = connection.get_bind() if hasattr(connection, 'get_bind') \
+        else connection
+    return bind.dialect.name
+
+
+def search_items(connection, query, category_id=None, limit=50,
+                 cursor=None, before=None):
+    """
+    Find the items matching a free text query, best matches first, one
+    page at a time like pagination.paginate.
+    :param connection: database connection or session
+    :param query: text typed by the user
+    :param category_id: only return items of this category
+    :param limit: number of results on the page
+    :param cursor: token of the result the page starts after
+    :param before: token of the result the page ends before
+    :return: a pagination.Page of SearchResult
+    :raise pagination.InvalidCursor: when a token can't be used
+    """
+    if _dialect_name(connection) == 'sqlite':
+        expression = match_expression(query, category_id)
+        if expression is None:
+            return Page([], None, None)
+        results = _rank_candidates(connection, expression,
+                                   TOKEN.findall(query), limit, cursor,
+                                   before)
+    else:
+        words = re.findall(r'\w+', query, re.UNICODE)
+        if not words:
+            return Page([], None, None)
+        results = _scan(connection, words, category_id, limit, cursor,
+                        before)
+
+    has_more = len(results) > limit
+    results = results[:limit]
+    if before is not None:
+        results.reverse()
+        prev_cursor = results[0].cursor if has_more else None
+        next_cursor = results[-1].cursor if results else None
+    else:
+        next_cursor = results[-1].cursor if has_more else None
+        prev_cursor = results[0].cursor if cursor is not None and results \
+            else None
+    return Page(results, next_cursor, prev_cursor)
+
+
+def _rank_candidates(connection, expression, words, limit, cursor, before):
+    """
+    Return limit + 1 results after the cursor, or before the before token
+    in reverse order, out of the ranked candidates
+    """
+    # the newest matches come first out of the index, which stops at the
+    # LIMIT instead of reading every match
+    sql = ('SELECT item.id, item.name, item.description, '
+           'item.category_id, category.name, item.slug, category.slug '
+           'FROM ('
+           'SELECT rowid FROM item_fts WHERE item_fts MATCH :query '
+           'ORDER BY rowid DESC LIMIT :candidates) AS hits '
+           'JOIN item ON item.id = hits.rowid '
+           'JOIN category ON category.id = item.category_id')
+    rows = connection.execute(text(sql), {
+        'query': expression, 'candidates': MAX_CANDIDATES}).fetchall()
+    scores = bm25_scores([(row[1], row[2]) for row in rows], words)
+    ranked = sorted(zip(scores, (row[0] for row in rows), rows))
+    if before is not None:
+        key = decode_score_cursor(before)
+        ranked = [hit for hit in reversed(ranked) if hit[:2] < key]
+    elif cursor is not None:
+        key = decode_score_cursor(cursor)
+        ranked = [hit for hit in ranked if hit[:2] > key]
+    return [SearchResult(*(tuple(row) + (score,)))
+            for score, id, row in ranked[:limit + 1]]
+
+
+def _scan(connection, words, category_id, limit, cursor, before):
+    """
+    Return limit + 1 items containing every word after the cursor, or
+    before the before token in reverse order, ordered by (name, id)
+    """
+    params = {'limit': limit + 1}
+    conditions = []
+    order = 'ASC'
+    if before is not None:
+        params['name'], params['id'] = decode_cursor(before)
+        conditions.append('(item.name < :name OR '
+                          '(item.name = :name AND item.id < :id))')
+        order = 'DESC'
+    elif cursor is not None:
+        params['name'], params['id'] = decode_cursor(cursor)
+        conditions.append('(item.name > :name OR '
+                          '(item.name = :name AND item.id > :id))')
+    for i, word in enumerate(words):
+        params['word%d' % i] = '%' + word + '%'
+        conditions.append('(item.name LIKE :word%d OR '
+                          'item.description LIKE :word%d)' % (i, i))
+    if category_id is not None:
+        params['category_id'] = category_id
+        conditions.append('item.category_id = :category_id')
+    sql = ('SELECT item.id, item.name, item.description, '
+           'item.category_id, category.name, item.slug, category.slug, '
+           'item.name '
+           'FROM item '
+           'JOIN category ON category.id = item.category_id '
+           'WHERE %s ORDER BY item.name %s, item.id %s LIMIT :limit'
+           % (' AND '.join(conditions), order, order))
+    return [SearchResult(*row)
+            for row in connection.execute(text(sql), params)]
@@ -0,0 +1,293 @@
+"""
+Server-side login sessions.
+
+Flask's default session serializes the whole login state into an
+HMAC-signed cookie, which is verified on every request and signed and sent
+back on every change. ServerSessionInterface keeps the session data in a
+store instead, and the cookie only holds a random id:
+
+- the data is loaded from the store the first time a view or template
+  touches the session, so requests that never look at it cost nothing
+- the data is written back only when it changed, plus once every
+  touch_interval seconds to push back its expiry while the user is active
+- sessions idle for idle_timeout seconds expire, and a background thread
+  purges them from the stores that don't expire entries on their own
+- ids sent by the browser that the store doesn't know are never reused, a
+  new one is issued when the session is first written, and the id changes
+  when the user logs in or out, see ServerSession.regenerate
+
+The stores are MemoryStore, in-process and lost on restart, DatabaseStore,
+a table of the catalog database shared by the workers using it, and
+SharedStore, any memcached-like client such as pymemcache or the LocalClient
+stand-in of cache.py.
+"""
+import re
+import secrets
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from flask.sessions import session_json_serializer
+from sqlalchemy import bindparam, delete, insert, select, update
+
+from cache import LRUCache
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+# seconds a session may stay unused before it expires
+DEFAULT_IDLE_TIMEOUT = 24 * 3600
+# seconds between the purges of expired sessions
+PURGE_INTERVAL = 300
+
+_SESSION_ID = re.compile(r'^[A-Za-z0-9_-]{43}$')
+
+
+class MemoryStore(object):
+    """Sessions kept in an LRU of this process"""
+
+    def __init__(self, maxsize=100000):
+        self.entries = LRUCache(maxsize=maxsize, ttl=None)
+
+    def get(self, sid):
+        return self.entries.get(sid)
+
+    def set(self, sid, data, ttl):
+        self.entries.set(sid, data, ttl)
+
+    def delete(self, sid):
+        self.entries.delete(sid)
+
+    def purge(self):
+        return self.entries.purge()
+
+
+class DatabaseStore(object):
+    """Sessions kept in the sessions table of the catalog database"""
+
+    def __init__(self, engine):
+        """
+        :param engine: engine of a database with the sessions table, see
+            database_setup.LoginSession
+        """
+        from database_setup import LoginSession
+        self.engine = engine
+        table = LoginSession.__table__
+        # built once, so each call reuses the compiled statement
+        self._get = select(table.c.data).where(
+            table.c.id == bindparam('sid'),
+            table.c.expires > bindparam('now'))
+        self._update = update(table).where(table.c.id == bindparam('sid'))
+        self._insert = insert(table)
+        self._delete = delete(table).where(table.c.id == bindparam('sid'))
+        self._purge = delete(table).where(table.c.expires <= bindparam('now'))
+
+    def get(self, sid):
+        with self.engine.connect() as connection:
+            return connection.execute(
+                self._get, {'sid': sid, 'now': time.time()}).scalar()
+
+    def set(self, sid, data, ttl):
+        values = {'data': data, 'expires': time.time() + ttl}
+        with self.engine.begin() as connection:
+            updated = connection.execute(
+                self._update.values(**values), {'sid': sid}).rowcount
+            if not updated:
+                connection.execute(self._insert, dict(values, id=sid))
+
+    def delete(self, sid):
+        with self.engine.begin() as connection:
+            connection.execute(self._delete, {'sid': sid})
+
+    def purge(self):
+        with self.engine.begin() as connection:
+            return connection.execute(self._purge,
+                                      {'now': time.time()}).rowcount
+
+
+class SharedStore(object):
+    """Sessions kept in memcached, which expires them by itself"""
+
+    def __init__(self, client, prefix='catalog:session:'):
+        """
+        :param client: anything with get(key), set(key, value, expire) and
+            delete(key) such as pymemcache.Client or cache.LocalClient
+        """
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, sid):
+        return self.client.get(self.prefix + sid)
+
+    def set(self, sid, data, ttl):
+        self.client.set(self.prefix + sid, data, int(ttl))
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+    def purge(self):
+        return 0
+
+
+class ServerSession(SessionMixin, MutableMapping):
+    """Session data loaded from the store on first use"""
+
+    def __init__(self, store, sid):
+        self.store = store
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        # time the stored copy was written, None when not stored
+        self.written = None
+        # the browser sent an id the store doesn't know
+        self.stale = False
+        self._data = None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def _load(self):
+        if self._data is None:
+            self.accessed = True
+            self._data = {}
+            raw = self.store.get(self.sid) if self.sid else None
+            if raw is None:
+                # unknown or expired, never reuse an id the store
+                # didn't issue
+                self.stale = self.sid is not None
+                self.sid = None
+                self.new = True
+            else:
+                written, payload = raw.decode('utf-8').split('\n', 1)
+                self.written = int(written)
+                self._data = session_json_serializer.loads(payload)
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self._load()[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def regenerate(self):
+        """
+        Move the data to a new id, issued when the session is saved, and
+        delete the old one from the store. Called when the user logs in or
+        out, so an id planted in the browser by someone else never carries
+        the login.
+        """
+        self._load()
+        if self.sid is not None:
+            self.store.delete(self.sid)
+            # an emptied session still gets its cookie deleted
+            self.stale = True
+        self.sid = None
+        self.new = True
+        self.modified = True
+
+    def dump(self):
+        """Return the data to store, prefixed with the time of writing"""
+        self.written = int(time.time())
+        return ('%d\n%s' % (self.written, session_json_serializer.dumps(
+            dict(self._load())))).encode('utf-8')
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keeps the session data in a store and its id in the cookie"""
+
+    def __init__(self, store, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 touch_interval=None, purge_interval=PURGE_INTERVAL):
+        """
+        :param store: MemoryStore, DatabaseStore or SharedStore
+        :param idle_timeout: seconds an unused session lives
+        :param touch_interval: seconds between the writes pushing back the
+            expiry of an unchanged session, a tenth of idle_timeout by
+            default
+        :param purge_interval: seconds between the purges of expired
+            sessions, None to never purge
+        """
+        self.store = store
+        self.idle_timeout = idle_timeout
+        self.touch_interval = idle_timeout / 10 if touch_interval is None \
+            else touch_interval
+        self.purge_interval = purge_interval
+        self._purger = None
+        self._lock = threading.Lock()
+
+    def _start_purger(self):
+        """Start the purge thread of this process, after a fork too"""
+        if self.purge_interval is None or (
+                self._purger is not None and self._purger.is_alive()):
+            return
+        with self._lock:
+            if self._purger is not None and self._purger.is_alive():
+                return
+            self._purger = threading.Thread(target=self._purge,
+                                            name='session-purger')
+            self._purger.daemon = True
+            self._purger.start()
+
+    def _purge(self):
+        while True:
+            time.sleep(self.purge_interval)
+            try:
+                self.store.purge()
+            except Exception:
+                # the next round tries again
+                pass
+
+    def open_session(self, app, request):
+        self._start_purger()
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid is not None and not _SESSION_ID.match(sid):
+            sid = None
+        return ServerSession(self.store, sid)
+
+    def save_session(self, app, session, response):
+        if not session.loaded:
+            return
+        response.vary.add('Cookie')
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+            if session.sid is not None or session.stale:
+                response.delete_cookie(
+                    name, domain=domain, path=path,
+                    secure=self.get_cookie_secure(app),
+                    samesite=self.get_cookie_samesite(app),
+                    httponly=self.get_cookie_httponly(app))
+            return
+        if session.modified:
+            if session.sid is None:
+                session.sid = secrets.token_urlsafe(32)
+            self.store.set(session.sid, session.dump(), self.idle_timeout)
+            response.set_cookie(
+                name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app), domain=domain,
+                path=path, secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app))
+        elif time.time() - session.written > self.touch_interval:
+            # still in use, push back its expiry
+            self.store.set(session.sid, session.dump(), self.idle_timeout)
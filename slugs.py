@@ -0,0 +1,242 @@
+"""
+URL slugs of the categories and items, and the in-process index resolving
+them.
+
+The slug of a name is its lower case words joined by dashes, so the
+category "Rock Climbing" lives at /catalog/rock-climbing/. Slugs are stored
+in the slug column of both tables, unique per table, and change only when
+the name does. Names whose slug is already taken, such as "rock climbing!"
+next to "Rock Climbing", or is a static part of the URLs, get the first
+free numbered one, rock-climbing-2, then -3 and so on, see free_slugs.
+Every slug is its own slugify(), which makes resolution case-insensitive:
+whatever spelling a URL uses, slugify() of it is the slug to look up, and
+the views redirect to the canonical URL when it was spelled differently.
+
+RouteIndex keeps the slug -> id maps of this process. Like the catalog
+snapshot, it reloads when the revisions of the 'categories' or 'items'
+cache scopes move: the categories are read again in full, the items only
+from the ones written since the previous load. A slug missing from the
+index is looked up in the database before concluding there is no such
+category or item, so an index lagging behind the writes of another worker
+costs a query but never a wrong answer. The callers check the rows they
+load against the slug and discard entries which turn out to be stale.
+"""
+import datetime
+import hashlib
+import re
+import threading
+import unicodedata
+from collections import Counter, namedtuple
+
+from sqlalchemy import and_, or_, select
+
+# slugs taken by the static parts of the catalog URLs
+RESERVED = frozenset(['addcategory', 'additem', 'delete', 'edit', 'items',
+                      'json', 'search'])
+# cache scopes whose revisions tell whether the index is current
+SCOPES = ['categories', 'items']
+# seconds of item writes read again by each load, so the rows of a
+# transaction committed while the previous load ran are not missed
+LOAD_OVERLAP = 60
+# slugs per IN (...) lookup, below the bound parameter limit of SQLite
+LOOKUP_CHUNK = 500
+
+# id of a category or item, and its canonical slug
+Found = namedtuple('Found', ['id', 'slug'])
+
+
+def slugify(name):
+    """
+    Return the slug of a name: its words of letters and digits in lower
+    case, joined by dashes.
+    :param name: name of a category or item, or a URL segment
+    """
+    words = re.findall(r'[^\W_]+', unicodedata.normalize('NFKC', name)
+                       .casefold(), re.UNICODE)
+    slug = '-'.join(words)
+    if not slug:
+        # names without a letter or digit still get a stable slug
+        slug = 'n-' + hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+    return slug
+
+
+def _number(base, taken):
+    """
+    Return base, or base-2, base-3... whichever is first free.
+    :param taken: function telling whether a slug is used
+    """
+    slug = base
+    n = 1
+    while slug in RESERVED or taken(slug):
+        n += 1
+        slug = '%s-%d' % (base, n)
+    return slug
+
+
+def unique_slugs(rows, taken=()):
+    """
+    Return the slugs of named rows, numbering the ones whose names give the
+    same slug in the order of the rows.
+    :param rows: (id, name) pairs
+    :param taken: slugs already used by other rows
+    :return: list of (id, slug)
+    """
+    taken = set(taken)
+    slugs = []
+    for id, name in rows:
+        slug = _number(slugify(name), taken.__contains__)
+        taken.add(slug)
+        slugs.append((id, slug))
+    return slugs
+
+
+def free_slugs(connection, table, names, owners=None):
+    """
+    Return the slugs of rows about to be written: slugify() of each name,
+    or its first numbered variant not taken by another row of the table,
+    another of the names or a static part of the URLs.
+    :param connection: connection or session of the write
+    :param table: Table with id and slug columns
+    :param names: distinct names of the rows, in the order they are numbered
+    :param owners: name -> id of the existing rows among them, which may
+        keep the slug they have
+    :return: dict of name -> slug
+    """
+    owners = owners or {}
+    bases = dict((name, slugify(name)) for name in names)
+    # slug -> id of the rows holding the slugs the names could get
+    holders = {}
+
+    def lookup(condition):
+        holders.update((slug, id) for id, slug in connection.execute(
+            select(table.c.id, table.c.slug).where(condition)))
+
+    distinct = sorted(set(bases.values()))
+    for start in range(0, len(distinct), LOOKUP_CHUNK):
+        lookup(table.c.slug.in_(distinct[start:start + LOOKUP_CHUNK]))
+    # the numbered variants matter only when the base itself is taken by
+    # another row; they are looked up as ranges of the slug index, which
+    # a LIKE can't use
+    counts = Counter(bases.values())
+    numbered = sorted(set(
+        base for name, base in bases.items() if base in RESERVED or
+        counts[base] > 1 or holders.get(base, owners.get(name)) !=
+        owners.get(name)))
+    for start in range(0, len(numbered), LOOKUP_CHUNK):
+        lookup(or_(*[and_(table.c.slug >= base + '-',
+                          table.c.slug < base + '.')
+                     for base in numbered[start:start + LOOKUP_CHUNK]]))
+    slugs = {}
+    for name in names:
+        owner = owners.get(name)
+        slug = slugs[name] = _number(bases[name], lambda slug: holders.get(
+            slug, owner) != owner)
+        # taken from now on, by a name that is no owner id
+        holders[slug] = name
+    return slugs
+
+
+class RouteIndex(object):
+    """Slug -> id maps of the categories and items of the catalog"""
+
+    def __init__(self, engine, response_cache):
+        """
+        :param engine: engine of the catalog database
+        :param response_cache: ResponseCache whose revisions of SCOPES
+            tell when the catalog changed
+        """
+        self.engine = engine
+        self.response_cache = response_cache
+        self._categories = {}
+        self._category_slugs = {}
+        self._items = {}
+        self._revisions = None
+        # time the last load of the items started
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def category(self, value):
+        """
+        Return the Found category whose slug is slugify(value), None when
+        there is none.
+        """
+        from database_setup import Category
+        self._check()
+        found = self._find(self._categories, Category, slugify(value))
+        if found is not None:
+            self._category_slugs[found.id] = found.slug
+        return found
+
+    def item(self, value):
+        """
+        Return the Found item whose slug is slugify(value), None when there
+        is none.
+        """
+        from database_setup import Item
+        self._check()
+        return self._find(self._items, Item, slugify(value))
+
+    def category_slug(self, id):
+        """Return the slug of a category id, None when not in the index"""
+        return self._category_slugs.get(id)
+
+    def discard_category(self, slug):
+        """Forget a slug found stale, the next lookup asks the database"""
+        self._categories.pop(slug, None)
+
+    def discard_item(self, slug):
+        """Forget a slug found stale, the next lookup asks the database"""
+        self._items.pop(slug, None)
+
+    def _find(self, index, model, slug):
+        id = index.get(slug)
+        if id is None:
+            # written by another worker since the last load, or unknown
+            with self.engine.connect() as connection:
+                id = connection.execute(select(model.id).where(
+                    model.slug == slug)).scalar()
+            if id is None:
+                return None
+            index[slug] = id
+        return Found(id, slug)
+
+    def _check(self):
+        revisions = self.response_cache.revisions(SCOPES)
+        if revisions != self._revisions:
+            self.refresh(revisions)
+
+    def refresh(self, revisions=None):
+        """
+        Load the categories and the items written since the last load when
+        their scope moved. Concurrent callers wait for the load in progress
+        instead of starting their own.
+        """
+        from database_setup import Category, Item
+        if revisions is None:
+            revisions = self.response_cache.revisions(SCOPES)
+        with self._lock:
+            loaded = self._revisions
+            if loaded == revisions:
+                return
+            # read the revisions before the rows: a write landing during
+            # the load leaves the index tagged as stale
+            with self.engine.connect() as connection:
+                if loaded is None or loaded[0] != revisions[0]:
+                    rows = connection.execute(
+                        select(Category.slug, Category.id)).all()
+                    self._category_slugs = dict((id, slug)
+                                                for slug, id in rows)
+                    self._categories = dict(rows)
+                if loaded is None or loaded[1] != revisions[1]:
+                    started = datetime.datetime.utcnow()
+                    query = select(Item.slug, Item.id)
+                    if self._loaded_at is None:
+                        self._items = dict(connection.execute(query).all())
+                    else:
+                        # renamed and deleted items keep their old slugs
+                        # here until a lookup finds them stale
+                        self._items.update(connection.execute(query.where(
+                            Item.updated_at >= self._loaded_at -
+                            datetime.timedelta(seconds=LOAD_OVERLAP))).all())
+                    self._loaded_at = started
+            self._revisions = revisions
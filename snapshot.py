@@ -0,0 +1,255 @@
+"""
+Read-only in-memory copy of the catalog for the public pages and JSON APIs.
+
+A CatalogSnapshot holds every category and item as immutable tuple records,
+items sorted by (name, id) globally and per category, so the pages and
+cursors of the views are answered with a bisect, and the slug lookups with
+a dict, instead of a query. A snapshot is never modified: CatalogReplica
+loads a new one in the background when the revisions of the 'categories' or
+'items' cache scopes moved, and swaps it in with a single assignment, so
+readers always see one consistent catalog and never wait for a load.
+Since every write to the categories and items bumps one of those scopes in
+the database, see cache.DatabaseRevisions, a worker reloads after its own
+writes and, within the poll interval of the revisions, after the writes of
+the other workers and scripts.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+from sqlalchemy import text
+
+from pagination import Page, decode_cursor, encode_cursor
+
+# cache scopes whose revisions tell whether a snapshot is current
+SCOPES = ['categories', 'items']
+# seconds before a failed load is tried again, doubled on every failure
+# up to MAX_RETRY_DELAY
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+log = logging.getLogger('catalog.snapshot')
+
+
+class CategoryRecord(namedtuple('CategoryRecord', ['id', 'name', 'user_id',
+                                                   'slug'])):
+    """a category as stored in a snapshot"""
+    __slots__ = ()
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {
+            'name': self.name,
+            'id': self.id
+        }
+
+
+class ItemRecord(namedtuple('ItemRecord', ['id', 'name', 'description',
+                                           'picture', 'category',
+                                           'user_id', 'slug'])):
+    """an item as stored in a snapshot, category is its CategoryRecord"""
+    __slots__ = ()
+
+    @property
+    def category_id(self):
+        return self.category.id
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {
+            'name': self.name,
+            'id': self.id,
+            'cat_id': self.category.id,
+            'description': self.description
+        }
+
+
+def _key(record):
+    return record.name, record.id
+
+
+def paginate_records(records, limit, cursor=None, before=None):
+    """
+    Return one page of records sorted by (name, id), with the same cursors
+    and page boundaries as pagination.paginate.
+    :param records: sequence of records sorted by (name, id)
+    :param limit: number of records on the page
+    :param cursor: token of the record the page starts after
+    :param before: token of the record the page ends before
+    :return: a Page
+    """
+    if before is not None:
+        end = bisect_left(records, decode_cursor(before), key=_key)
+        start = max(end - limit, 0)
+        rows = records[start:end]
+        prev_cursor = _record_cursor(rows[0]) if start > 0 else None
+        next_cursor = _record_cursor(rows[-1]) if rows else None
+        return Page(list(rows), next_cursor, prev_cursor)
+
+    start = 0
+    if cursor is not None:
+        start = bisect_right(records, decode_cursor(cursor), key=_key)
+    rows = records[start:start + limit]
+    next_cursor = _record_cursor(rows[-1]) \
+        if len(records) - start > limit else None
+    prev_cursor = _record_cursor(rows[0]) if cursor is not None and rows \
+        else None
+    return Page(list(rows), next_cursor, prev_cursor)
+
+
+def _record_cursor(record):
+    return encode_cursor(record.name, record.id)
+
+
+class CatalogSnapshot(object):
+    """Immutable copy of the categories and items of the catalog"""
+
+    __slots__ = ('revisions', 'categories', 'category_by_slug', 'items',
+                 'item_by_slug', 'category_items')
+
+    def __init__(self, categories, items, revisions=None):
+        """
+        :param categories: CategoryRecords sorted by name
+        :param items: ItemRecords sorted by (name, id)
+        :param revisions: revisions of SCOPES the snapshot was loaded at
+        """
+        self.revisions = revisions
+        self.categories = tuple(categories)
+        self.category_by_slug = dict((category.slug, category)
+                                     for category in self.categories)
+        self.items = tuple(items)
+        self.item_by_slug = dict((item.slug, item) for item in self.items)
+        grouped = dict((category.id, []) for category in self.categories)
+        for item in self.items:
+            grouped[item.category.id].append(item)
+        self.category_items = dict((id, tuple(records))
+                                   for id, records in grouped.items())
+
+    @classmethod
+    def load(cls, connection, revisions=None):
+        """Read the whole catalog through a database connection"""
+        categories = [CategoryRecord(*row) for row in connection.execute(
+            text('SELECT id, name, user_id, slug FROM category '
+                 'ORDER BY name, id'))]
+        by_id = dict((category.id, category) for category in categories)
+        items = []
+        orphans = 0
+        for id, name, description, picture, category_id, user_id, slug \
+                in connection.execute(text(
+                    'SELECT id, name, description, picture, category_id, '
+                    'user_id, slug FROM item ORDER BY name, id')):
+            category = by_id.get(category_id)
+            # no page lists the items of a missing category
+            if category is None:
+                orphans += 1
+                continue
+            items.append(ItemRecord(id, name, description, picture,
+                                    category, user_id, slug))
+        if orphans:
+            log.warning('Left %d items without a category out of the '
+                        'snapshot', orphans)
+        # bisect relies on Python's ordering, which may differ from the
+        # collation of the database
+        categories.sort(key=_key)
+        items.sort(key=_key)
+        return cls(categories, items, revisions)
+
+    def category(self, slug):
+        """Return the category at slug, None when there is none"""
+        return self.category_by_slug.get(slug)
+
+    def item(self, slug):
+        """Return the item at slug, None when there is none"""
+        return self.item_by_slug.get(slug)
+
+    def iter_categories_with_items(self):
+        """
+        Yield the serialized categories in id order with their items, in id
+        order, nested under "Item", like views.iterCategoriesWithItems.
+        """
+        for category in sorted(self.categories, key=lambda c: c.id):
+            category_dict = category.serialize
+            items = sorted(self.category_items[category.id],
+                           key=lambda item: item.id)
+            if items:
+                category_dict["Item"] = [item.serialize for item in items]
+            yield category_dict
+
+
+class CatalogReplica(object):
+    """
+    Keeps the latest CatalogSnapshot of a database in memory. New snapshots
+    are loaded by a background thread, readers keep the previous one until
+    the new one is swapped in.
+    """
+
+    def __init__(self, engine, response_cache):
+        """
+        :param engine: engine of the catalog database
+        :param response_cache: ResponseCache whose revisions of SCOPES
+            tell when the catalog changed
+        """
+        self.engine = engine
+        self.response_cache = response_cache
+        self._snapshot = None
+        self._loader = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return the latest loaded snapshot, None until the first one is
+        loaded, and start loading a new one when the catalog changed since.
+        """
+        snapshot = self._snapshot
+        if not self.is_current(snapshot):
+            self.refresh(wait=False)
+        return snapshot
+
+    def is_current(self, snapshot):
+        """Tell whether a snapshot holds the latest write"""
+        return snapshot is not None and \
+            snapshot.revisions == self.response_cache.revisions(SCOPES)
+
+    def refresh(self, wait=True):
+        """
+        Load a new snapshot, when the catalog changed since the last one,
+        and swap it in. Only one load runs at a time.
+        :param wait: wait for the new snapshot instead of loading it in
+            the background
+        :return: the latest snapshot when waiting
+        """
+        with self._lock:
+            if self._loader is None or not self._loader.is_alive():
+                self._loader = threading.Thread(target=self._load,
+                                                name='snapshot-loader')
+                self._loader.daemon = True
+                self._loader.start()
+            loader = self._loader
+        if wait:
+            loader.join()
+            return self._snapshot
+
+    def _load(self):
+        # writes landing during a load leave the new snapshot stale, load
+        # again until it is current
+        delay = RETRY_DELAY
+        while True:
+            try:
+                if self.is_current(self._snapshot):
+                    return
+                # read the revisions before the rows: a write landing
+                # during the load leaves the snapshot tagged as stale
+                revisions = self.response_cache.revisions(SCOPES)
+                with self.engine.connect() as connection:
+                    self._snapshot = CatalogSnapshot.load(connection,
+                                                          revisions)
+                delay = RETRY_DELAY
+            except Exception:
+                log.exception('Catalog snapshot not loaded, retrying in '
+                              '%.0fs', delay)
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
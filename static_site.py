@@ -0,0 +1,313 @@
+"""
+Static copy of the public catalog, for a plain file server to answer
+anonymous visitors while Flask serves the logged-in users.
+
+Every public page and JSON endpoint is requested from the app through its
+test client, as an anonymous user, and written to the output directory
+under its URL path, pages as index.html. So the files are byte for byte the
+responses Flask would send. Each file gets a gzip variant, and a brotli one
+when the brotli package is installed, for nginx's gzip_static and
+brotli_static. Files whose content did not change are not rewritten, which
+keeps their modification times and the validators derived from them.
+
+Only the first page of each list is written; the pages reached through a
+cursor in the query string, and search, are left to Flask.
+
+A manifest of the categories and items written is kept in the output
+directory. Later builds only render the pages of the items added, modified,
+renamed or moved since the previous build, or whose picture has been stored
+locally since, and of the categories holding them, and remove the files of
+the deleted ones. The home page and the catalog-wide JSON are rendered on
+every build. --full renders everything again.
+
+Usage:
+    python static_site.py public/
+    python static_site.py public/ --full
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import sys
+import tempfile
+import time
+
+from flask import url_for
+from sqlalchemy import select
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+from database_setup import Category, Item
+
+MANIFEST = '.catalog-build.json'
+# files smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 256
+# URLs of the pages listing the whole catalog, rendered on every build
+CATALOG_URLS = ['/', '/catalog/', '/catalog/JSON', '/catalog/items/JSON']
+
+
+def compressors():
+    """Return (suffix, compress function) of the available encodings"""
+    available = [('.gz', lambda data: gzip.compress(data, 9, mtime=0))]
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        available.append(('.br', lambda data: brotli.compress(data)))
+    return available
+
+
+def url_to_path(output, url):
+    """
+    Return the file holding the response of url, None when its path can't
+    be mapped safely to a file under output.
+    """
+    parts = unquote(url).split('/')[1:]
+    if parts[-1] == '':
+        parts[-1] = 'index.html'
+    if any(part in ('', '.', '..') or '\0' in part for part in parts):
+        return None
+    return os.path.join(output, *parts)
+
+
+def write_file(path, data):
+    """Write data to path unless it already holds it, return whether
+    the file changed"""
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except IOError:
+        pass
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return True
+
+
+def remove_file(output, path):
+    """Remove a file, its compressed variants and the directories left
+    empty under output"""
+    for suffix in ('', '.gz', '.br'):
+        try:
+            os.unlink(path + suffix)
+        except OSError:
+            pass
+    directory = os.path.dirname(path)
+    output = os.path.abspath(output)
+    while os.path.abspath(directory) != output:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+
+class StaticSite(object):
+    """Writes the responses of the app's public URLs to a directory"""
+
+    def __init__(self, app, output):
+        """
+        :param app: the Flask app serving the catalog
+        :param output: directory of the static copy
+        """
+        self.app = app
+        self.output = output
+        self.client = app.test_client()
+        self.compressors = compressors()
+        self.rendered = 0
+        self.written = 0
+        self.removed = 0
+        self.failed = []
+
+    def render(self, url):
+        """Request url as an anonymous user and write the response"""
+        path = url_to_path(self.output, url)
+        if path is None:
+            self.failed.append((url, 'unsafe path'))
+            return
+        response = self.client.get(url)
+        try:
+            if response.status_code != 200:
+                self.failed.append((url, response.status))
+                return
+            data = response.get_data()
+        finally:
+            response.close()
+        self.rendered += 1
+        if write_file(path, data):
+            self.written += 1
+        for suffix, compress in self.compressors:
+            if len(data) >= MIN_COMPRESS_SIZE:
+                write_file(path + suffix, compress(data))
+            elif os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+    def remove(self, url):
+        path = url_to_path(self.output, url)
+        if path is not None and os.path.exists(path):
+            remove_file(self.output, path)
+            self.removed += 1
+
+    def category_urls(self, slug):
+        """URLs of the pages and JSON of one category"""
+        with self.app.test_request_context():
+            page = url_for('showCategory', categorySlug=slug)
+            json_url = url_for('showCategoryJSON', categorySlug=slug)
+        # both routes of each view, whichever one url_for picked
+        page = page[:-len('items/')] if page.endswith('/items/') else page
+        json_url = json_url[:-len('items/JSON')] \
+            if json_url.endswith('/items/JSON') else json_url[:-len('JSON')]
+        return [page, page + 'items/', json_url + 'JSON',
+                json_url + 'items/JSON']
+
+    def item_urls(self, category_slug, slug):
+        """URLs of the page and JSON of one item"""
+        with self.app.test_request_context():
+            return [url_for('showItem', categorySlug=category_slug,
+                            itemSlug=slug),
+                    url_for('showItemJSON', categorySlug=category_slug,
+                            itemSlug=slug)]
+
+
+def load_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def build(site, connection, image_store=None, full=False):
+    """
+    Render the pages of the categories and items changed since the last
+    build, or all of them, and remove those of the deleted ones.
+    :return: (number of categories, number of items) rendered
+    :param site: the StaticSite
+    :param connection: connection to the catalog database
+    :param image_store: ImageStore of the local pictures, to render again
+        the items whose picture has been stored since the last build
+    :param full: render every page
+    """
+    manifest = load_manifest(site.output) or \
+        {'built_at': None, 'categories': {}, 'items': {}}
+    # taken before reading the rows, so writes made during the build are
+    # picked up by the next one
+    built_at = datetime.datetime.utcnow()
+    categories = dict(connection.execute(
+        select(Category.id, Category.slug)).all())
+    items = dict((row[0], row[1:]) for row in connection.execute(
+        select(Item.id, Item.slug, Item.category_id, Item.picture,
+               Item.updated_at)))
+    since = manifest['built_at'] and datetime.datetime.strptime(
+        manifest['built_at'], '%Y-%m-%dT%H:%M:%S.%f')
+    # manifests of the builds before slugs hold names, which are taken as
+    # renames: their files are removed and the slug URLs rendered
+    old_categories = dict((int(id), slug) for id, slug
+                          in manifest['categories'].items())
+    old_items = dict((int(id), entry) for id, entry
+                     in manifest['items'].items())
+    # whether each item's picture was stored locally, which once true
+    # stays true as stored pictures are never removed
+    local = {}
+
+    def has_local_picture(id, picture):
+        if id not in local:
+            local[id] = bool(image_store is not None and picture and
+                             image_store.lookup(picture) is not None)
+        return local[id]
+
+    touched_categories = set()
+    touched_items = set()
+    # remove the files of the deleted and renamed categories and items
+    for id, slug in old_categories.items():
+        if categories.get(id) != slug:
+            for url in site.category_urls(slug):
+                site.remove(url)
+            touched_categories.add(id)
+    for id, (slug, category_id, was_local) in old_items.items():
+        current = items.get(id)
+        old = (old_categories.get(category_id), slug)
+        if current is None or \
+                old != (categories.get(current[1]), current[0]):
+            for url in site.item_urls(*old):
+                site.remove(url)
+            touched_categories.add(category_id)
+            touched_items.add(id)
+        elif was_local:
+            local[id] = True
+        elif has_local_picture(id, current[2]):
+            touched_items.add(id)
+    for id, (slug, category_id, picture, updated_at) in items.items():
+        if full or id not in old_items or since is None or \
+                (updated_at is not None and updated_at >= since):
+            touched_items.add(id)
+    touched_items &= set(items)
+    touched_categories.update(items[id][1] for id in touched_items)
+    touched_categories.update(id for id in categories
+                              if full or id not in old_categories)
+    touched_categories &= set(categories)
+
+    for url in CATALOG_URLS:
+        site.render(url)
+    for id in touched_categories:
+        for url in site.category_urls(categories[id]):
+            site.render(url)
+    for id in touched_items:
+        slug, category_id = items[id][:2]
+        for url in site.item_urls(categories[category_id], slug):
+            site.render(url)
+
+    write_file(os.path.join(site.output, MANIFEST), json.dumps({
+        'built_at': built_at.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+        'categories': categories,
+        'items': dict((id, [slug, category_id,
+                            has_local_picture(id, picture)])
+                      for id, (slug, category_id, picture, updated_at)
+                      in items.items())}).encode('utf-8'))
+    return len(touched_categories), len(touched_items)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Render the public catalog to static files.')
+    parser.add_argument('output', help='directory of the static copy')
+    parser.add_argument('--full', action='store_true',
+                        help='render every page, not only the changed ones')
+    args = parser.parse_args()
+
+    # the app is built from the CATALOG_* environment like a worker's
+    import views
+
+    site = StaticSite(views.app, args.output)
+    started = time.time()
+    with views.engine.connect() as connection:
+        categories, items = build(site, connection, views.image_store,
+                                  full=args.full)
+    elapsed = time.time() - started
+    print("Rendered %d categories and %d items: %d responses, %d files "
+          "changed, %d removed in %.1fs (%.0f responses/s)"
+          % (categories, items, site.rendered, site.written, site.removed,
+             elapsed, site.rendered / elapsed if elapsed else 0))
+    for url, reason in site.failed:
+        print("Skipped %s: %s" % (url, reason))
+    if site.failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
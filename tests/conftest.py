@@ -0,0 +1,50 @@
+"""
+Test settings, applied before the tests import the app: a throwaway
+SQLite database and sessions kept in memory.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ['CATALOG_DATABASE_URL'] = 'sqlite:///' + os.path.join(
+    tempfile.mkdtemp(), 'catalog.db')
+os.environ['CATALOG_SESSION_STORE'] = 'memory'
+os.environ.pop('CATALOG_SNAPSHOT', None)
+os.environ.pop('CATALOG_MEMCACHED', None)
+
+
+@pytest.fixture
+def user():
+    """
+    id of the user 'Test User', the catalog, the audit log and the users
+    are emptied after the test
+    """
+    import views
+    from database_setup import AuditEvent, Category, Item, User
+    session = views.session
+    user = User(name='Test User', email='test@example.com')
+    session.add(user)
+    session.commit()
+    id = user.id
+    session.remove()
+    yield id
+    views.write_behind.flush()
+    session.rollback()
+    for model in (AuditEvent, Item, Category, User):
+        session.query(model).delete()
+    session.commit()
+    session.remove()
+    views.response_cache.backend.clear()
+
+
+def logIn(client, user, name='Test User', email='test@example.com'):
+    """Log a test client in as a user"""
+    with client.session_transaction() as login_session:
+        login_session['username'] = name
+        login_session['email'] = email
+        login_session['user_id'] = user
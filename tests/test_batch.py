@@ -0,0 +1,99 @@
+"""
+The batch endpoint applies creations, updates and deletions in one
+transaction, later operations seeing the items of earlier ones.
+"""
+import pytest
+
+import views
+from conftest import logIn
+from database_setup import Category, Item
+
+
+@pytest.fixture
+def client(user):
+    """A logged-in client, the user owning the category Gear and its Rope"""
+    session = views.session
+    category = Category(name='Gear', user_id=user)
+    session.add(category)
+    session.commit()
+    session.add(Item(name='Rope', description='Long', category=category,
+                     user_id=user))
+    session.commit()
+    session.remove()
+    client = views.app.test_client()
+    logIn(client, user)
+    return client
+
+
+def postBatch(client, *operations):
+    response = client.post('/catalog/items/JSON',
+                           json={'operations': list(operations)})
+    return response.status_code, response.get_json()
+
+
+def items():
+    """name -> (slug, description) of the items in the database"""
+    rows = views.session.query(Item.name, Item.slug, Item.description)
+    found = dict((name, (slug, description))
+                 for name, slug, description in rows)
+    views.session.remove()
+    return found
+
+
+def test_update_of_an_item_created_by_the_batch(client):
+    status, body = postBatch(
+        client,
+        {'op': 'create', 'name': 'Harness', 'category': 'Gear'},
+        {'op': 'update', 'item': 'Harness', 'description': 'Snug'},
+        {'op': 'update', 'item': 'Harness', 'name': 'Big Harness'})
+    assert status == 200, body
+    assert [result['slug'] for result in body['results']] == \
+        ['big-harness'] * 3
+    assert items()['Big Harness'] == ('big-harness', 'Snug')
+    assert 'Harness' not in items()
+
+
+def test_delete_of_an_item_created_by_the_batch(client):
+    status, body = postBatch(
+        client,
+        {'op': 'create', 'name': 'Chalk', 'category': 'Gear'},
+        {'op': 'delete', 'item': 'Chalk'})
+    assert status == 200, body
+    assert body['results'][0]['id'] is None
+    assert set(items()) == set(['Rope'])
+
+
+def test_create_update_and_delete_in_one_batch(client):
+    status, body = postBatch(
+        client,
+        {'op': 'create', 'name': 'Rope!', 'category': 'Gear'},
+        {'op': 'update', 'item': 'Rope', 'description': 'Longer'},
+        {'op': 'delete', 'item': 'Rope'})
+    assert status == 200, body
+    assert [result['status'] for result in body['results']] == \
+        [201, 200, 200]
+    # the slug of the deleted Rope was taken when the batch was checked
+    assert items() == {'Rope!': ('rope-2', None)}
+
+
+def test_invalid_operation_applies_nothing(client):
+    status, body = postBatch(
+        client,
+        {'op': 'create', 'name': 'Helmet', 'category': 'Gear'},
+        {'op': 'update', 'item': 'Rope', 'description': 'Short'},
+        {'op': 'delete', 'item': 'Ladder'})
+    assert status == 400
+    assert body['applied'] is False
+    assert body['results'][2]['status'] == 404
+    assert items() == {'Rope': ('rope', 'Long')}
+
+
+def test_create_is_keyed_on_its_name(client):
+    status, body = postBatch(
+        client, {'op': 'create', 'name': 'Rope 2', 'item': 'Rope',
+                 'category': 'Gear'})
+    assert status == 400
+    assert body['results'][0]['item'] == 'Rope 2'
+    assert body['results'][0]['error'] == \
+        'item is only given to update and delete'
+    assert set(items()) == set(['Rope'])
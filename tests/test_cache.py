@@ -0,0 +1,56 @@
+"""
+Keys of the shared cache are valid memcached keys whatever the request
+path.
+"""
+import re
+
+import pytest
+
+from cache import LocalClient, ResponseCache, SharedBackend
+
+
+class StrictClient(LocalClient):
+    """LocalClient refusing the keys memcached refuses"""
+
+    def _check(self, key):
+        if len(key.encode('utf-8')) > 250 or re.search(r'[\s\x00-\x1f\x7f]',
+                                                       key):
+            raise ValueError('Invalid memcached key %r' % key)
+
+    def get(self, key):
+        self._check(key)
+        return LocalClient.get(self, key)
+
+    def set(self, key, value, expire=0):
+        self._check(key)
+        return LocalClient.set(self, key, value, expire)
+
+    def delete(self, key):
+        self._check(key)
+        return LocalClient.delete(self, key)
+
+
+@pytest.mark.parametrize('path', [
+    '/catalog/search?q=' + 'rope+' * 100,
+    '/catalog/search?q=two words',
+    '/catalog/search?q=tab\there',
+    u'/catalog/caf\xe9/JSON'])
+def test_any_path_is_cached(path):
+    cache = ResponseCache(SharedBackend(StrictClient()))
+    key = cache.key(path, cache.revisions(['items', 'category:' + path]))
+    assert cache.get(key) is None
+    cache.set(key, 'page')
+    assert cache.get(key) == 'page'
+    cache.backend.delete(key)
+    assert cache.get(key) is None
+
+
+def test_keys_stay_apart():
+    backend = SharedBackend(StrictClient())
+    backend.set('view:a', 1)
+    backend.set('view:b', 2)
+    assert (backend.get('view:a'), backend.get('view:b')) == (1, 2)
+    revision = backend.revision('items')
+    backend.bump('items')
+    assert backend.revision('items') > revision
+    assert backend.get('view:a') == 1
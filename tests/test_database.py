@@ -0,0 +1,72 @@
+"""
+The catalog runs on SQLite and PostgreSQL only, and the item counts kept
+by the triggers follow every write to the items.
+"""
+import pytest
+from sqlalchemy import text
+
+from database_setup import get_engine
+from migrations import check_item_counts, upgrade
+
+
+@pytest.mark.parametrize('url', [
+    'mysql://catalog@localhost/catalog',
+    'mssql+pyodbc://catalog@localhost/catalog',
+    'oracle://catalog@localhost/catalog'])
+def test_unsupported_databases_are_refused(url):
+    with pytest.raises(ValueError, match='Unsupported database'):
+        get_engine(url)
+
+
+@pytest.fixture
+def connection(tmp_path):
+    engine = get_engine('sqlite:///%s' % tmp_path.joinpath('counts.db'))
+    upgrade(engine)
+    with engine.begin() as connection:
+        for statement in (
+                "INSERT INTO users (id, name, email) "
+                "VALUES (1, 'Test', 't@example.com')",
+                "INSERT INTO category (id, name, slug, user_id) "
+                "VALUES (1, 'Soccer', 'soccer', 1)",
+                "INSERT INTO category (id, name, slug, user_id) "
+                "VALUES (2, 'Hockey', 'hockey', 1)"):
+            connection.execute(text(statement))
+        yield connection
+
+
+def counts(connection):
+    return connection.execute(text(
+        'SELECT name, item_count FROM category ORDER BY id')).all()
+
+
+def addItem(connection, name, category_id):
+    connection.execute(text(
+        'INSERT INTO item (name, slug, category_id, user_id) '
+        'VALUES (:name, :name, :category_id, 1)'),
+        {'name': name, 'category_id': category_id})
+
+
+def test_counts_follow_the_writes(connection):
+    for name, category_id in (('ball', 1), ('net', 1), ('stick', 2)):
+        addItem(connection, name, category_id)
+    assert counts(connection) == [('Soccer', 2), ('Hockey', 1)]
+    connection.execute(text(
+        "UPDATE item SET category_id = 2 WHERE name = 'net'"))
+    assert counts(connection) == [('Soccer', 1), ('Hockey', 2)]
+    # other columns leave the counts alone
+    connection.execute(text(
+        "UPDATE item SET description = 'Round' WHERE name = 'ball'"))
+    connection.execute(text("DELETE FROM item WHERE name = 'stick'"))
+    assert counts(connection) == [('Soccer', 1), ('Hockey', 1)]
+    assert check_item_counts(connection) == []
+
+
+def test_wrong_counts_are_repaired(connection):
+    addItem(connection, 'ball', 1)
+    connection.execute(text(
+        "UPDATE category SET item_count = 5 WHERE name = 'Soccer'"))
+    assert check_item_counts(connection) == [('Soccer', 5, 1)]
+    assert counts(connection) == [('Soccer', 5), ('Hockey', 0)]
+    assert check_item_counts(connection, repair=True) == [('Soccer', 5, 1)]
+    assert counts(connection) == [('Soccer', 1), ('Hockey', 0)]
+    assert check_item_counts(connection) == []
@@ -0,0 +1,47 @@
+"""
+The image store remembers a bounded number of lookups, and the fetcher
+thread runs again in a forked worker.
+"""
+import threading
+import time
+
+import pytest
+
+from images import ImageFetcher, ImageStore
+
+
+@pytest.fixture
+def store(tmpdir, monkeypatch):
+    store = ImageStore(str(tmpdir), known=2)
+    # the tests need no thumbnails, with or without Pillow
+    monkeypatch.setattr(store, '_thumbnails', lambda *args: ())
+    return store
+
+
+def test_known_lookups_are_bounded(store):
+    for i in range(5):
+        store.put('http://example.com/%d.png' % i, b'picture %d' % i,
+                  'image/png')
+    assert len(store._known._entries) == 2
+    # forgotten lookups are read back from the store
+    assert store.lookup('http://example.com/0.png').extension == 'png'
+
+
+def test_fetcher_thread_runs_after_a_fork(store, monkeypatch):
+    fetcher = ImageFetcher(store)
+    fetched = []
+    monkeypatch.setattr(fetcher, 'process', fetched.append)
+    fetcher.submit('http://example.com/a.png')
+    fetcher.join()
+    # a forked worker inherits the thread object, but not the thread
+    dead = threading.Thread(target=lambda: None)
+    dead.start()
+    dead.join()
+    fetcher._thread = dead
+    fetcher.submit('http://example.com/b.png')
+    for attempt in range(100):
+        if len(fetched) == 2:
+            break
+        time.sleep(0.01)
+    assert fetched == ['http://example.com/a.png', 'http://example.com/b.png']
+    assert fetcher._thread.is_alive()
@@ -0,0 +1,91 @@
+"""
+Queries, SQL time and latency are recorded per route, and routes going
+over their query budget are caught.
+"""
+import logging
+
+import pytest
+from flask import Flask
+from sqlalchemy import text
+
+from database_setup import get_engine
+from metrics import Metrics, QueryBudgetExceeded
+
+
+def createApp(metrics):
+    app = Flask(__name__)
+    app.testing = True
+    engine = get_engine('sqlite://')
+    metrics.init_app(app, engine)
+
+    def runQueries(count):
+        with engine.connect() as connection:
+            for _ in range(count):
+                connection.execute(text('SELECT 1'))
+        return 'ok'
+
+    @app.route('/one')
+    @metrics.budget(1)
+    def one():
+        return runQueries(1)
+
+    @app.route('/three')
+    @metrics.budget(2)
+    def three():
+        return runQueries(3)
+
+    return app
+
+
+def test_queries_are_counted_per_route():
+    metrics = Metrics()
+    client = createApp(metrics).test_client()
+    for _ in range(2):
+        client.get('/one')
+    client.get('/three')
+    assert metrics.routes['one'].count == 2
+    assert metrics.routes['one'].queries == 2
+    assert metrics.routes['three'].max_queries == 3
+    assert metrics.over_budget() == [('three', 3, 2)]
+
+
+def test_budgets_are_enforced():
+    metrics = Metrics(enforce_budgets=True)
+    client = createApp(metrics).test_client()
+    assert client.get('/one').status_code == 200
+    with pytest.raises(QueryBudgetExceeded):
+        client.get('/three')
+
+
+def test_slow_queries_are_logged(caplog):
+    metrics = Metrics(slow_query_ms=0)
+    client = createApp(metrics).test_client()
+    with caplog.at_level(logging.WARNING, logger='catalog.sql'):
+        client.get('/one')
+    assert 'Slow query' in caplog.text
+    assert metrics.routes['one'].slow_queries == 1
+
+
+def test_prometheus_text():
+    metrics = Metrics()
+    client = createApp(metrics).test_client()
+    client.get('/one')
+    lines = metrics.render().splitlines()
+    assert '# TYPE catalog_requests_total counter' in lines
+    assert any(line.startswith('catalog_sql_queries_total{') and
+               'endpoint="one"' in line and line.endswith(' 1')
+               for line in lines)
+    assert any(line.startswith('catalog_request_duration_seconds_count{')
+               and 'endpoint="one"' in line for line in lines)
+
+
+def test_metrics_endpoint():
+    import views
+    client = views.app.test_client()
+    response = client.get('/catalog/JSON')
+    response.get_data()
+    response.close()
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert b'catalog_sql_queries_total' in response.data
+    assert b'catalog_cache_hits_total' in response.data
@@ -0,0 +1,67 @@
+"""
+A database with the schema of the first version of the app is upgraded in
+place, after which the hot queries are served by indexes.
+"""
+import re
+
+from sqlalchemy import text
+
+from database_setup import get_engine
+from migrations import MIGRATIONS, explain_hot_queries, upgrade
+
+# the tables as the first version of the app created them
+BASELINE_SCHEMA = [
+    'CREATE TABLE users (id INTEGER NOT NULL, name VARCHAR(250) NOT NULL, '
+    'email VARCHAR(250) NOT NULL, image VARCHAR(250), PRIMARY KEY (id))',
+    'CREATE TABLE category (id INTEGER NOT NULL, '
+    'name VARCHAR(250) NOT NULL, user_id INTEGER, PRIMARY KEY (id), '
+    'UNIQUE (name), FOREIGN KEY(user_id) REFERENCES users (id))',
+    'CREATE TABLE item (id INTEGER NOT NULL, name VARCHAR(250) NOT NULL, '
+    'description VARCHAR(250), category_id INTEGER, picture VARCHAR(250), '
+    'user_id INTEGER, PRIMARY KEY (id), UNIQUE (name), '
+    'FOREIGN KEY(category_id) REFERENCES category (id), '
+    'FOREIGN KEY(user_id) REFERENCES users (id))',
+    "INSERT INTO users (id, name, email) VALUES (1, 'Test', 't@example.com')",
+    "INSERT INTO category (id, name, user_id) VALUES (1, 'Soccer', 1)",
+    "INSERT INTO category (id, name, user_id) VALUES (2, 'Hockey', 1)",
+    "INSERT INTO item (name, description, category_id, user_id) "
+    "VALUES ('Ball', 'Round', 1, 1)",
+    "INSERT INTO item (name, description, category_id, user_id) "
+    "VALUES ('Stick', 'Long', 2, 1)",
+]
+
+# hot queries meant to read a whole table in the order of an index
+ORDERED_SCANS = ('items by name', 'categories with their item counts')
+
+SEARCH = re.compile(r'^SEARCH \w+ USING (COVERING )?INDEX \w+ \(')
+ORDERED_SCAN = re.compile(r'^SCAN \w+ USING (COVERING )?INDEX \w+$')
+
+
+def baselineEngine(tmp_path):
+    engine = get_engine('sqlite:///%s' % tmp_path.joinpath('baseline.db'))
+    with engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+    return engine
+
+
+def test_upgrade_applies_every_migration(tmp_path):
+    engine = baselineEngine(tmp_path)
+    assert upgrade(engine) == [number for number, migration in MIGRATIONS]
+    assert upgrade(engine) == []
+    with engine.connect() as connection:
+        assert connection.execute(text(
+            'SELECT name, slug, item_count FROM category ORDER BY id'
+        )).all() == [('Soccer', 'soccer', 1), ('Hockey', 'hockey', 1)]
+    engine.dispose()
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    engine = baselineEngine(tmp_path)
+    upgrade(engine)
+    for description, plan in explain_hot_queries(engine):
+        expected = ORDERED_SCAN if description in ORDERED_SCANS else SEARCH
+        for line in plan:
+            assert expected.match(line), \
+                '%s: %s' % (description, ' / '.join(plan))
+    engine.dispose()
@@ -0,0 +1,83 @@
+import json
+import threading
+import time
+
+import pytest
+
+from oauth_clients import (FacebookClient, ProviderClient, ProviderError,
+                           run_concurrently)
+
+
+class MockProvider(ProviderClient):
+    """Provider answering after an injected delay"""
+
+    def __init__(self, delay, **kwargs):
+        super(MockProvider, self).__init__(**kwargs)
+        self.delay = delay
+        self.release = threading.Event()
+
+    def call(self, value):
+        self.release.wait(self.delay)
+        return value
+
+    def fail(self, message):
+        raise ProviderError(message)
+
+
+def test_calls_run_at_the_same_time():
+    provider = MockProvider(0.2)
+    started = time.time()
+    assert run_concurrently((provider.call, 1), (provider.call, 2)) == [1, 2]
+    assert time.time() - started < 0.35
+
+
+def test_slow_provider_fails_at_the_deadline():
+    provider = MockProvider(5)
+    started = time.time()
+    with pytest.raises(ProviderError):
+        run_concurrently((provider.call, 1), deadline=0.2)
+    assert time.time() - started < 1
+    provider.release.set()
+
+
+def test_failed_call_is_raised():
+    provider = MockProvider(5)
+    with pytest.raises(ProviderError, match='rejected'):
+        run_concurrently((provider.call, 1), (provider.fail, 'rejected'))
+    provider.release.set()
+
+
+def test_slow_provider_does_not_starve_the_others():
+    slow = MockProvider(5, pool_size=2)
+    fast = MockProvider(0.01, pool_size=2)
+    for i in range(2):
+        with pytest.raises(ProviderError):
+            run_concurrently((slow.call, i), deadline=0.1)
+    # the calls given up on still hold the threads of the slow provider
+    started = time.time()
+    with pytest.raises(ProviderError, match='still running'):
+        run_concurrently((slow.call, 3), deadline=1)
+    assert time.time() - started < 0.5
+    assert run_concurrently((fast.call, 4), (fast.call, 5),
+                            deadline=1) == [4, 5]
+    # and are given back once those calls end
+    slow.release.set()
+    for attempt in range(50):
+        try:
+            assert run_concurrently((slow.call, 6), deadline=1) == [6]
+            break
+        except ProviderError:
+            time.sleep(0.01)
+    else:
+        pytest.fail('the threads of the slow provider were not given back')
+
+
+@pytest.mark.parametrize('reply', [{}, {'data': None}, {'data': {}}, []])
+def test_malformed_picture_reply(tmpdir, monkeypatch, reply):
+    secrets = tmpdir.join('fb_client_secrets.json')
+    secrets.write(json.dumps({'web': {'app_id': 'id', 'app_secret': 's'}}))
+    client = FacebookClient(str(secrets))
+    monkeypatch.setattr(client, 'request_json',
+                        lambda *args, **kwargs: reply)
+    with pytest.raises(ProviderError):
+        client.picture_url('token')
@@ -0,0 +1,202 @@
+"""
+The Google and Facebook logins against a stub OAuth server on localhost,
+the provider clients of the views are replaced by clients with a base_url
+pointing at it, as CATALOG_GOOGLE_BASE_URL and CATALOG_FACEBOOK_BASE_URL
+do.
+"""
+import base64
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pytest
+
+import views
+from conftest import ROOT
+from database_setup import User
+from oauth_clients import FacebookClient, GoogleClient
+
+EMAIL = 'stub@example.com'
+
+
+def idToken(claims):
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode('utf-8'))
+    return 'header.%s.signature' % payload.decode('ascii').rstrip('=')
+
+
+class StubProvider(ThreadingHTTPServer):
+    """
+    OAuth server answering each path with the answers queued for it, the
+    last answer of a path repeats
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.answers = {}
+        self.calls = []
+        self.release = threading.Event()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def answer(self, method, path, *answers):
+        """
+        :param answers: (status, JSON body) or (status, JSON body, seconds
+            to wait before answering) tuples
+        """
+        self.answers[method, path] = list(answers)
+
+    def count(self, method, path):
+        return self.calls.count((method, path))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def reply(self):
+        path = urlparse(self.path).path
+        stub = self.server
+        stub.calls.append((self.command, path))
+        answers = stub.answers.get((self.command, path),
+                                   [(404, {'error': 'not found'})])
+        answer = answers.pop(0) if len(answers) > 1 else answers[0]
+        if len(answer) > 2:
+            stub.release.wait(answer[2])
+        body = json.dumps(answer[1]).encode('utf-8')
+        self.send_response(answer[0])
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_DELETE = reply
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub(monkeypatch, user):
+    server = StubProvider()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    monkeypatch.setattr(views, 'google', GoogleClient(
+        os.path.join(ROOT, 'client_secrets.json'), base_url=server.url,
+        timeout=2))
+    monkeypatch.setattr(views, 'facebook', FacebookClient(
+        os.path.join(ROOT, 'fb_client_secrets.json'), base_url=server.url,
+        timeout=2))
+    monkeypatch.setattr(views, 'LOGIN_DEADLINE', 0.5)
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+    views.user_cache.delete('email:' + EMAIL)
+
+
+@pytest.fixture
+def client():
+    client = views.app.test_client()
+    with client.session_transaction() as login_session:
+        login_session['state'] = 'STATE'
+    return client
+
+
+def stubGoogle(stub, tokeninfo=None, userinfo=None):
+    stub.answer('POST', '/o/oauth2/token', (200, {
+        'access_token': 'google-token',
+        'id_token': idToken({'sub': '42', 'email': EMAIL})}))
+    stub.answer('GET', '/oauth2/v1/tokeninfo', *(tokeninfo or [(200, {
+        'user_id': '42', 'issued_to': views.CLIENT_ID})]))
+    stub.answer('GET', '/oauth2/v1/userinfo', *(userinfo or [(200, {
+        'name': 'Stub User', 'email': EMAIL,
+        'picture': 'http://example.com/stub.png'})]))
+
+
+def stubFacebook(stub, me=None, picture=None):
+    stub.answer('GET', '/oauth/access_token',
+                (200, {'access_token': 'facebook-token'}))
+    stub.answer('GET', '/v2.8/me', *(me or [(200, {
+        'name': 'Stub User', 'email': EMAIL, 'id': '7'})]))
+    stub.answer('GET', '/v2.8/me/picture', *(picture or [(200, {
+        'data': {'url': 'http://example.com/stub.png'}})]))
+
+
+def loggedInUser(client):
+    with client.session_transaction() as login_session:
+        return login_session.get('user_id'), login_session.get('provider')
+
+
+def test_gconnect(stub, client):
+    stubGoogle(stub)
+    response = client.post('/gconnect?state=STATE', data='code')
+    assert response.status_code == 200
+    assert b'Welcome, Stub User!' in response.data
+    user_id, provider = loggedInUser(client)
+    assert provider == 'google'
+    assert views.session.get(User, user_id).email == EMAIL
+    views.session.remove()
+
+
+def test_gconnect_retries_failed_calls(stub, client):
+    stubGoogle(stub, tokeninfo=[
+        (503, {'error': 'unavailable'}),
+        (200, {'user_id': '42', 'issued_to': views.CLIENT_ID})])
+    response = client.post('/gconnect?state=STATE', data='code')
+    assert response.status_code == 200
+    assert stub.count('GET', '/oauth2/v1/tokeninfo') == 2
+
+
+def test_gconnect_does_not_retry_the_code_exchange(stub, client):
+    stubGoogle(stub)
+    stub.answer('POST', '/o/oauth2/token', (503, {'error': 'unavailable'}))
+    response = client.post('/gconnect?state=STATE', data='code')
+    assert response.status_code == 401
+    assert stub.count('POST', '/o/oauth2/token') == 1
+    assert loggedInUser(client) == (None, None)
+
+
+def test_gconnect_times_out(stub, client):
+    stubGoogle(stub, userinfo=[(200, {}, 5)])
+    response = client.post('/gconnect?state=STATE', data='code')
+    assert response.status_code == 500
+    assert b'did not answer within' in response.data
+    assert loggedInUser(client) == (None, None)
+
+
+def test_fbconnect(stub, client):
+    stubFacebook(stub)
+    response = client.post('/fbconnect?state=STATE', data='short-token')
+    assert response.status_code == 200
+    assert b'Welcome, Stub User!' in response.data
+    assert loggedInUser(client)[1] == 'facebook'
+    with client.session_transaction() as login_session:
+        assert login_session['access_token'] == 'facebook-token'
+        assert login_session['picture'] == 'http://example.com/stub.png'
+
+
+def test_fbconnect_retries_failed_calls(stub, client):
+    stubFacebook(stub, me=[(502, {}), (503, {}),
+                           (200, {'name': 'Stub User', 'email': EMAIL,
+                                  'id': '7'})])
+    response = client.post('/fbconnect?state=STATE', data='short-token')
+    assert response.status_code == 200
+    assert stub.count('GET', '/v2.8/me') == 3
+
+
+def test_fbconnect_times_out(stub, client):
+    stubFacebook(stub, picture=[(200, {}, 5)])
+    response = client.post('/fbconnect?state=STATE', data='short-token')
+    assert response.status_code == 401
+    assert loggedInUser(client) == (None, None)
+
+
+def test_fbconnect_malformed_picture(stub, client):
+    stubFacebook(stub, picture=[(200, {'data': None})])
+    response = client.post('/fbconnect?state=STATE', data='short-token')
+    assert response.status_code == 401
+    assert loggedInUser(client) == (None, None)
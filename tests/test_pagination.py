@@ -0,0 +1,42 @@
+"""
+Cursors from the query string are decoded into a (name, id) key, or
+refused with a 400.
+"""
+import base64
+import json
+
+import pytest
+
+import views
+from pagination import InvalidCursor, decode_cursor, encode_cursor
+
+
+def rawCursor(value):
+    """Encode any JSON value the way encode_cursor does"""
+    raw = json.dumps(value).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor('Soccer Ball', 12)) == \
+        ('Soccer Ball', 12)
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64!', rawCursor('name'), rawCursor(['name']),
+    rawCursor([[1], 1]), rawCursor([{'a': 1}, 1]), rawCursor([None, 1]),
+    rawCursor(['name', '1']), rawCursor(['name', 1.5]),
+    rawCursor(['name', True])])
+def test_malformed_cursors_are_refused(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
+
+
+@pytest.mark.parametrize('path', ['/catalog/items/JSON', '/'])
+def test_views_answer_400_to_malformed_cursors(path):
+    client = views.app.test_client()
+    for cursor in (rawCursor([[1], 1]), rawCursor([{'a': 1}, 1])):
+        response = client.get(path, query_string={'cursor': cursor})
+        assert response.status_code == 400
+        response = client.get(path, query_string={'before': cursor})
+        assert response.status_code == 400
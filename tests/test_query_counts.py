@@ -0,0 +1,66 @@
+"""
+The home page runs a fixed number of queries however many items it lists,
+counted with the SQL hooks of metrics.py.
+"""
+import pytest
+
+import views
+from conftest import logIn
+from database_setup import Category, Item
+
+SMALL = 30
+LARGE = 10 * SMALL
+# items per category, the categories grow with the catalog so a lazy load
+# per category would show as well as one per item
+ITEMS_PER_CATEGORY = 3
+
+
+def seedItems(user, count):
+    """Add items, and their categories, until the catalog holds count"""
+    session = views.session
+    start = session.query(Item).count()
+    categories = {}
+    for n in range(start, count):
+        name = 'Category %d' % (n // ITEMS_PER_CATEGORY)
+        category = categories.get(name) or \
+            session.query(Category).filter_by(name=name).first()
+        if category is None:
+            category = Category(name=name, user_id=user)
+            session.add(category)
+        categories[name] = category
+        session.add(Item(name='Item %d' % n, category=category,
+                         user_id=user))
+    session.commit()
+    session.remove()
+
+
+def homePageQueries(client, count):
+    """
+    Render the whole catalog on the home page.
+    :return: the number of queries it ran
+    """
+    # start from an empty cache, so the page and the category list are
+    # rendered from the database
+    views.response_cache.backend.clear()
+    route = views.metrics.routes.get('showCatalog')
+    before = route.queries if route is not None else 0
+    response = client.get('/?limit=%d' % LARGE)
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).count(
+        'class="item-category"') == count
+    response.close()
+    return views.metrics.routes['showCatalog'].queries - before
+
+
+@pytest.mark.parametrize('loggedIn', [False, True])
+def test_home_page_queries_do_not_grow_with_the_catalog(user, loggedIn):
+    client = views.app.test_client()
+    if loggedIn:
+        logIn(client, user)
+    seedItems(user, SMALL)
+    small = homePageQueries(client, SMALL)
+    seedItems(user, LARGE)
+    large = homePageQueries(client, LARGE)
+    assert small == large, (
+        'the home page ran %d queries for %d items and %d for %d'
+        % (small, SMALL, large, LARGE))
@@ -0,0 +1,99 @@
+"""
+Search pages are cut with a keyset on (score, id) out of a bounded set of
+candidates.
+"""
+import pytest
+
+import search
+import views
+from database_setup import Category, Item
+from pagination import InvalidCursor, decode_score_cursor
+from search import search_items
+
+
+@pytest.fixture
+def items(user):
+    """ids of 12 items matching 'rope', oldest first"""
+    session = views.session
+    category = Category(name='Climbing', user_id=user)
+    session.add(category)
+    session.flush()
+    ids = []
+    for i in range(12):
+        # names made of more words match less well
+        item = Item(name='Rope' + ' long' * (i % 4) + ' %d' % i,
+                    description='Knots', category_id=category.id,
+                    user_id=user)
+        session.add(item)
+        session.flush()
+        ids.append(item.id)
+    session.add(Item(name='Harness', description='Straps',
+                     category_id=category.id, user_id=user))
+    session.commit()
+    session.remove()
+    return ids
+
+
+def allPages(query, limit, **kwargs):
+    pages = [search_items(views.session, query, limit=limit, **kwargs)]
+    while pages[-1].next_cursor is not None:
+        pages.append(search_items(views.session, query, limit=limit,
+                                  cursor=pages[-1].next_cursor))
+    views.session.remove()
+    return pages
+
+
+def test_pages_follow_each_other(items):
+    pages = allPages('rope', 5)
+    results = [result for page in pages for result in page.items]
+    assert [len(page.items) for page in pages] == [5, 5, 2]
+    assert sorted(result.id for result in results) == items
+    assert [(r.rank, r.id) for r in results] == \
+        sorted((r.rank, r.id) for r in results)
+    assert pages[0].prev_cursor is None
+    assert pages[1].prev_cursor == pages[1].items[0].cursor
+    assert pages[-1].next_cursor is None
+
+
+def test_previous_page(items):
+    pages = allPages('rope', 5)
+    previous = search_items(views.session, 'rope', limit=5,
+                            before=pages[2].prev_cursor)
+    assert [r.id for r in previous.items] == [r.id for r in pages[1].items]
+    assert previous.prev_cursor is not None
+    first = search_items(views.session, 'rope', limit=5,
+                         before=previous.prev_cursor)
+    assert [r.id for r in first.items] == [r.id for r in pages[0].items]
+    assert first.prev_cursor is None
+    views.session.remove()
+
+
+def test_only_the_newest_candidates_are_ranked(items, monkeypatch):
+    monkeypatch.setattr(search, 'MAX_CANDIDATES', 4)
+    pages = allPages('rope', 3)
+    assert sorted(r.id for page in pages for r in page.items) == items[-4:]
+
+
+def test_cursor_key(items):
+    page = search_items(views.session, 'rope', limit=1)
+    score, id = decode_score_cursor(page.next_cursor)
+    assert (score, id) == (page.items[0].rank, page.items[0].id)
+    with pytest.raises(InvalidCursor):
+        search_items(views.session, 'rope',
+                     cursor=search.encode_cursor('Rope', id))
+    views.session.remove()
+
+
+def test_search_json_pages(items):
+    client = views.app.test_client()
+    seen = []
+    url = '/catalog/search/JSON?q=rope&limit=5'
+    while url:
+        data = client.get(url).get_json()
+        seen.extend(item['id'] for item in data['items'])
+        url = data['next_cursor'] and \
+            '/catalog/search/JSON?q=rope&limit=5&cursor=' + \
+            data['next_cursor']
+    assert sorted(seen) == items
+    assert client.get('/catalog/search/JSON?q=rope&cursor=bad')\
+        .status_code == 400
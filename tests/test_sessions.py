@@ -0,0 +1,131 @@
+"""
+Server-side sessions: only an id in the cookie, idle sessions expire, and
+the id changes when the user logs in or out.
+"""
+import time
+
+import pytest
+from flask import Flask, session
+
+from database_setup import Base, LoginSession, get_engine
+from sessions import DatabaseStore, MemoryStore, ServerSessionInterface
+
+
+def createApp(store, **kwargs):
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.session_interface = ServerSessionInterface(
+        store, purge_interval=None, **kwargs)
+
+    @app.route('/set/<value>')
+    def setValue(value):
+        session['value'] = value
+        return 'ok'
+
+    @app.route('/get')
+    def getValue():
+        return session.get('value', '')
+
+    @app.route('/public')
+    def public():
+        return 'public'
+
+    @app.route('/login')
+    def logIn():
+        session.regenerate()
+        session['user_id'] = 1
+        return 'ok'
+
+    @app.route('/logout')
+    def logOut():
+        session.regenerate()
+        session.clear()
+        return 'ok'
+
+    return app
+
+
+def databaseStore():
+    engine = get_engine('sqlite://')
+    Base.metadata.create_all(engine, tables=[LoginSession.__table__])
+    return DatabaseStore(engine)
+
+
+@pytest.fixture(params=['memory', 'database'])
+def store(request):
+    return MemoryStore() if request.param == 'memory' else databaseStore()
+
+
+def sessionId(client):
+    cookie = client.get_cookie('session')
+    return cookie and cookie.value
+
+
+def test_cookie_only_holds_the_id(store):
+    client = createApp(store).test_client()
+    client.get('/set/' + 'x' * 500)
+    sid = sessionId(client)
+    assert len(sid) == 43
+    assert store.get(sid) is not None
+    assert client.get('/get').data == b'x' * 500
+
+
+def test_sessions_left_alone_are_not_written(store):
+    client = createApp(store).test_client()
+    response = client.get('/public')
+    assert 'Set-Cookie' not in response.headers
+    assert 'Cookie' not in response.vary
+
+
+def test_idle_sessions_expire(store):
+    client = createApp(store, idle_timeout=0.2).test_client()
+    client.get('/set/a')
+    sid = sessionId(client)
+    assert client.get('/get').data == b'a'
+    time.sleep(0.3)
+    assert store.get(sid) is None
+    assert client.get('/get').data == b''
+    # a new id is issued instead of the expired one
+    client.get('/set/b')
+    assert sessionId(client) not in (None, sid)
+
+
+def test_active_sessions_are_touched(store):
+    client = createApp(store, idle_timeout=0.4,
+                       touch_interval=0.1).test_client()
+    client.get('/set/a')
+    for _ in range(4):
+        time.sleep(0.15)
+        assert client.get('/get').data == b'a'
+
+
+def test_purge(store):
+    client = createApp(store, idle_timeout=0.1).test_client()
+    client.get('/set/a')
+    time.sleep(0.2)
+    assert store.purge() == 1
+    assert store.purge() == 0
+
+
+def test_unknown_ids_are_not_reused(store):
+    client = createApp(store).test_client()
+    planted = 'a' * 43
+    client.set_cookie('session', planted)
+    client.get('/set/a')
+    assert sessionId(client) != planted
+    assert store.get(planted) is None
+
+
+def test_id_changes_on_login_and_logout(store):
+    client = createApp(store).test_client()
+    client.get('/set/a')
+    anonymous = sessionId(client)
+    client.get('/login')
+    loggedIn = sessionId(client)
+    assert loggedIn != anonymous
+    assert store.get(anonymous) is None
+    # the data moves to the new id
+    assert client.get('/get').data == b'a'
+    client.get('/logout')
+    assert store.get(loggedIn) is None
+    assert sessionId(client) is None
@@ -0,0 +1,129 @@
+"""
+Slugs follow the names, numbered when taken, and other spellings of a URL
+redirect to the canonical one.
+"""
+import pytest
+
+import views
+from conftest import logIn
+from database_setup import Category, Item
+from slugs import slugify, unique_slugs
+
+
+@pytest.mark.parametrize('name, slug', [
+    ('Soccer Ball', 'soccer-ball'),
+    ('  Snow__Board!! ', 'snow-board'),
+    (u'Caf\xe9 Cr\xe8me', u'caf\xe9-cr\xe8me'),
+    ('STRASSE', 'strasse')])
+def test_slugify(name, slug):
+    assert slugify(name) == slug
+
+
+def test_names_without_words_get_a_stable_slug():
+    assert slugify('!!!') == slugify('!!!')
+    assert slugify('!!!').startswith('n-')
+    assert slugify('!!!') != slugify('???')
+
+
+def test_numbering():
+    assert unique_slugs([(1, 'Rope'), (2, 'rope!'), (3, 'ROPE'),
+                         (4, 'Edit')], taken=['rope-3']) == \
+        [(1, 'rope'), (2, 'rope-2'), (3, 'rope-4'), (4, 'edit-2')]
+
+
+@pytest.fixture
+def client(user):
+    session = views.session
+    category = Category(name='Climbing Gear', user_id=user)
+    session.add(category)
+    session.add(Category(name='Camping', user_id=user))
+    session.commit()
+    session.remove()
+    client = views.app.test_client()
+    logIn(client, user)
+    return client
+
+
+def addItem(client, name, category='Climbing Gear'):
+    return client.post('/catalog/addItem/', data={
+        'name': name, 'description': 'Long', 'picture': '',
+        'category': category})
+
+
+def get(client, url):
+    """GET a page, closing its streamed body"""
+    response = client.get(url)
+    response.get_data()
+    response.close()
+    return response
+
+
+def slugs():
+    rows = views.session.query(Item.name, Item.slug).order_by(Item.id).all()
+    views.session.remove()
+    return rows
+
+
+def test_items_of_the_same_slug_are_numbered(client):
+    for name in ('Rope', 'rope!', 'ROPE'):
+        response = addItem(client, name)
+        assert response.status_code == 302
+    assert slugs() == [('Rope', 'rope'), ('rope!', 'rope-2'),
+                       ('ROPE', 'rope-3')]
+    response = get(client, '/catalog/climbing-gear/rope-2/')
+    assert b'rope!' in response.data
+
+
+def test_other_spellings_redirect(client):
+    addItem(client, 'Rope')
+    for url in ('/catalog/Climbing Gear/', '/catalog/CLIMBING-GEAR/'):
+        response = get(client, url + '?limit=5')
+        assert response.status_code == 301
+        assert response.headers['Location'] == \
+            '/catalog/climbing-gear/?limit=5'
+    # the item under another category, or with another spelling
+    for url in ('/catalog/camping/rope/', '/catalog/climbing-gear/Rope/'):
+        response = get(client, url)
+        assert response.status_code == 301
+        assert response.headers['Location'] == '/catalog/climbing-gear/rope/'
+    response = get(client, '/catalog/climbing-gear/rope/JSON')
+    assert response.status_code == 200
+    assert get(client, '/catalog/climbing-gear/ladder/').status_code == 404
+
+
+def test_form_posts_redirect_with_their_method(client):
+    addItem(client, 'Rope')
+    response = client.post('/catalog/Climbing-Gear/Rope/edit/', data={
+        'name': '', 'description': 'Short', 'picture': '', 'category': ''})
+    assert response.status_code == 308
+    assert response.headers['Location'] == \
+        '/catalog/climbing-gear/rope/edit/'
+
+
+def test_renamed_item_gets_a_new_slug(client):
+    addItem(client, 'Rope')
+    response = client.post('/catalog/climbing-gear/rope/edit/', data={
+        'name': 'Dynamic Rope', 'description': '', 'picture': '',
+        'category': 'Camping'})
+    assert response.headers['Location'] == '/catalog/camping/items/'
+    assert slugs() == [('Dynamic Rope', 'dynamic-rope')]
+    assert get(client, '/catalog/camping/dynamic-rope/').status_code == 200
+    assert get(client, '/catalog/climbing-gear/rope/').status_code == 404
+
+
+def test_unknown_category_is_refused(client):
+    response = addItem(client, 'Rope', category='Nowhere')
+    assert response.status_code == 302
+    assert response.headers['Location'] == '/catalog/addItem/'
+    assert slugs() == []
+    addItem(client, 'Rope')
+    response = client.post('/catalog/climbing-gear/rope/edit/', data={
+        'name': 'Other', 'description': '', 'picture': '',
+        'category': 'Nowhere'})
+    assert response.status_code == 302
+    assert response.headers['Location'] == \
+        '/catalog/climbing-gear/rope/edit/'
+    assert slugs() == [('Rope', 'rope')]
+    with client.session_transaction() as login_session:
+        assert ('message', 'No category called Nowhere!') in \
+            login_session['_flashes']
@@ -0,0 +1,73 @@
+"""
+Snapshots load whatever rows the database holds, and the replica keeps
+loading them after a failure.
+"""
+import logging
+
+from sqlalchemy import text
+
+import snapshot
+from cache import ResponseCache
+from database_setup import get_engine
+from migrations import upgrade
+from snapshot import CatalogReplica, CatalogSnapshot
+
+
+def catalogEngine(tmp_path):
+    """A catalog with Rope in Gear and two items whose category is gone"""
+    engine = get_engine('sqlite:///%s' % tmp_path.joinpath('catalog.db'))
+    upgrade(engine)
+    with engine.begin() as connection:
+        for statement in (
+                "INSERT INTO users (id, name, email) "
+                "VALUES (1, 'Test', 't@example.com')",
+                "INSERT INTO category (id, name, slug, user_id) "
+                "VALUES (1, 'Gear', 'gear', 1)",
+                "INSERT INTO item (name, slug, category_id, user_id) "
+                "VALUES ('Rope', 'rope', 1, 1)",
+                "INSERT INTO item (name, slug, category_id, user_id) "
+                "VALUES ('Loose', 'loose', NULL, 1)"):
+            connection.execute(text(statement))
+    # a row left behind by a database that didn't enforce foreign keys
+    with engine.connect() as connection:
+        connection.execute(text('PRAGMA foreign_keys=OFF'))
+        connection.execute(text(
+            "INSERT INTO item (name, slug, category_id, user_id) "
+            "VALUES ('Lost', 'lost', 99, 1)"))
+        connection.commit()
+        connection.execute(text('PRAGMA foreign_keys=ON'))
+    return engine
+
+
+def test_items_without_a_category_are_left_out(tmp_path, caplog):
+    engine = catalogEngine(tmp_path)
+    with caplog.at_level(logging.WARNING, logger='catalog.snapshot'):
+        with engine.connect() as connection:
+            loaded = CatalogSnapshot.load(connection)
+    assert [item.name for item in loaded.items] == ['Rope']
+    assert [item.name for item in loaded.category_items[1]] == ['Rope']
+    assert 'Left 2 items without a category' in caplog.text
+    engine.dispose()
+
+
+def test_replica_retries_failed_loads(tmp_path, monkeypatch, caplog):
+    engine = catalogEngine(tmp_path)
+    monkeypatch.setattr(snapshot, 'RETRY_DELAY', 0.01)
+    load = CatalogSnapshot.load
+    failures = []
+
+    def failOnce(connection, revisions=None):
+        if not failures:
+            failures.append(True)
+            raise RuntimeError('database gone')
+        return load(connection, revisions)
+    monkeypatch.setattr(CatalogSnapshot, 'load', staticmethod(failOnce))
+
+    replica = CatalogReplica(engine, ResponseCache())
+    with caplog.at_level(logging.ERROR, logger='catalog.snapshot'):
+        loaded = replica.refresh()
+    assert failures
+    assert 'Catalog snapshot not loaded' in caplog.text
+    assert [item.name for item in loaded.items] == ['Rope']
+    assert replica.get() is loaded
+    engine.dispose()
@@ -2,35 +2,247 @@ import os
 import random
 import string
 import json
-import httplib2
-import requests
+import hashlib
+import calendar
+import datetime
+import time
 from flask import Flask, render_template, request, redirect, jsonify
 from flask import url_for, flash, make_response
-from sqlalchemy import create_engine, asc, desc
-from sqlalchemy.orm import sessionmaker
+from flask import Response, stream_with_context, abort
+from flask import send_from_directory, g
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from sqlalchemy import asc, desc
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, scoped_session, joinedload
 from database_setup import *
+from pagination import paginate, parse_limit, InvalidCursor, Page
+from migrations import upgrade
+from cache import ResponseCache, LRUCache, SharedBackend, CachedResponse
+from cache import LocalClient, DatabaseRevisions
+from search import search_items
+from batch import apply_batch, InvalidBatch, FIELDS
+from batch import target as batchTarget
+from snapshot import CatalogReplica, CategoryRecord, paginate_records
+from slugs import RouteIndex, slugify
+from metrics import Metrics
+from images import ImageStore, ImageFetcher, CACHE_MAX_AGE
+from sessions import ServerSessionInterface, MemoryStore, DatabaseStore
+from sessions import SharedStore, DEFAULT_IDLE_TIMEOUT
+from writebehind import WriteBehindQueue, DEFAULT_QUEUE_SIZE
+from writebehind import DEFAULT_FLUSH_INTERVAL
 from flask import session as login_session
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client.client import FlowExchangeError
+from oauth_clients import GoogleClient, FacebookClient, ProviderError
+from oauth_clients import run_concurrently
 from functools import wraps
+from itertools import groupby
+from collections import namedtuple
 
 # Flask instance
 app = Flask(__name__)
+# keep the compiled templates on disk so restarted workers load them
+# instead of compiling templates/ again, CATALOG_TEMPLATE_CACHE_DIR
+# defaults to a directory under the system temp dir
+app.jinja_options = dict(app.jinja_options, bytecode_cache=(
+    FileSystemBytecodeCache(os.environ.get('CATALOG_TEMPLATE_CACHE_DIR'))))
+
+# OAuth provider clients, the secrets are read once here and every login
+# reuses the pooled connections. The base URLs can point them at a stub
+# server for testing.
+google = GoogleClient(
+    'client_secrets.json',
+    base_url=os.environ.get('CATALOG_GOOGLE_BASE_URL'))
+facebook = FacebookClient(
+    'fb_client_secrets.json',
+    base_url=os.environ.get('CATALOG_FACEBOOK_BASE_URL'))
+
+# seconds each login step may wait for the provider
+LOGIN_DEADLINE = float(os.environ.get('CATALOG_LOGIN_DEADLINE', 3))
 
 # Google client id
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
+CLIENT_ID = google.client_id
 
 # Name of the application
 APPLICATION_NAME = "Catalog Items App"
 
-# Connect to database
-engine = create_engine('sqlite:///itemCatalog.db')
+# Connect to database, the URL and pool settings come from database_setup
 Base.metadata.bind = engine
+# bring databases created by older versions of the app up to date
+upgrade(engine)
+
+# Per-route latency, SQL and template metrics served at /metrics. Queries
+# slower than CATALOG_SLOW_QUERY_MS are logged, and with
+# CATALOG_ENFORCE_QUERY_BUDGETS set a view running more queries than its
+# metrics.budget fails, which catches N+1 regressions in tests.
+metrics = Metrics(
+    slow_query_ms=float(os.environ.get('CATALOG_SLOW_QUERY_MS', 100)),
+    enforce_budgets=bool(os.environ.get('CATALOG_ENFORCE_QUERY_BUDGETS')))
+metrics.init_app(app, engine)
 
 # Create database session
+# Each thread serving a request gets its own session, which is discarded
+# when the app context is torn down so a failed commit can not leak into
+# later requests.
 DBSession = sessionmaker(bind=engine)
-session = DBSession()
+session = scoped_session(DBSession)
+
+
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    session.remove()
+
+
+# The audit log of catalog edits is written behind the requests: events
+# are queued in memory and a background thread inserts them in group
+# commits, the queue is drained when the process exits
+write_behind = WriteBehindQueue(
+    engine,
+    maxsize=int(os.environ.get('CATALOG_WRITE_BEHIND_QUEUE_SIZE',
+                               DEFAULT_QUEUE_SIZE)),
+    flush_interval=float(os.environ.get('CATALOG_WRITE_BEHIND_INTERVAL',
+                                        DEFAULT_FLUSH_INTERVAL)))
+
+
+def auditEvent(action, target, user_id=None, **detail):
+    """
+    Queue an entry of the audit log, called by the write routes after they
+    commit.
+    :param action: what was done, such as 'item.create'
+    :param target: name of the category or item, email of the user
+    :param user_id: who did it, the logged-in user by default
+    :param detail: more facts, such as the new name, stored as JSON
+    """
+    write_behind.put(AuditEvent, {
+        'created_at': datetime.datetime.utcnow(),
+        'user_id': login_session.get('user_id') if user_id is None
+        else user_id,
+        'action': action,
+        'target': target,
+        'detail': json.dumps(detail, sort_keys=True) if detail else None})
+
+
+def sideEngine():
+    """
+    Return an engine with a pool of its own, so the lookups of the session
+    and revision stores don't wait behind the catalog queries nor count
+    against the query budgets of the views, except for in-memory databases
+    which only exist in their engine.
+    """
+    if engine.url.database in (None, '', ':memory:'):
+        return engine
+    return get_engine(pool_size=2, max_overflow=8)
+
+
+def releaseRevision():
+    """
+    Return the time in milliseconds this module or a template last
+    changed, which every response depends on.
+    """
+    paths = [os.path.abspath(__file__)]
+    for root, dirs, files in os.walk(os.path.join(app.root_path,
+                                                  app.template_folder)):
+        paths.extend(os.path.join(root, name) for name in files)
+    return int(max(os.path.getmtime(path) for path in paths) * 1000)
+
+
+def createResponseCache():
+    """
+    Build the response cache from the environment: an in-process LRU by
+    default, or memcached shared by all workers when CATALOG_MEMCACHED
+    holds its host:port. The revisions are kept in the database, read
+    again every CATALOG_REVISION_POLL_INTERVAL seconds.
+    """
+    ttl = int(os.environ.get('CATALOG_CACHE_TTL', 300))
+    memcached = os.environ.get('CATALOG_MEMCACHED')
+    if memcached:
+        from pymemcache.client.base import Client
+        host, port = memcached.rsplit(':', 1)
+        backend = SharedBackend(Client((host, int(port))), ttl=ttl)
+    else:
+        backend = LRUCache(
+            maxsize=int(os.environ.get('CATALOG_CACHE_SIZE', 1024)), ttl=ttl)
+    revisions_engine = sideEngine()
+    # nothing else can write to an in-memory database
+    poll_interval = None if revisions_engine is engine else float(
+        os.environ.get('CATALOG_REVISION_POLL_INTERVAL', 1))
+    return ResponseCache(
+        backend, DatabaseRevisions(revisions_engine, poll_interval),
+        release=releaseRevision())
+
+
+# Cache of the public pages and JSON served to anonymous users
+response_cache = createResponseCache()
+
+
+def createSessionInterface():
+    """
+    Build the login session store from CATALOG_SESSION_STORE: 'database'
+    by default, a table shared by the workers using the database, 'memory'
+    for one process, 'memcached' for the server at CATALOG_MEMCACHED, or
+    its in-process stand-in when that is unset, and 'cookie' for Flask's
+    signed cookie sessions. Only the session id goes in the cookie of the
+    server-side stores.
+    """
+    kind = os.environ.get('CATALOG_SESSION_STORE', 'database')
+    if kind == 'cookie':
+        return app.session_interface
+    if kind == 'memory':
+        store = MemoryStore()
+    elif kind == 'memcached':
+        memcached = os.environ.get('CATALOG_MEMCACHED')
+        if memcached:
+            from pymemcache.client.base import Client
+            host, port = memcached.rsplit(':', 1)
+            store = SharedStore(Client((host, int(port))))
+        else:
+            store = SharedStore(LocalClient())
+    elif kind == 'database':
+        store = DatabaseStore(sideEngine())
+    else:
+        raise ValueError('Unknown CATALOG_SESSION_STORE %r' % kind)
+    return ServerSessionInterface(store, idle_timeout=int(os.environ.get(
+        'CATALOG_SESSION_IDLE_TIMEOUT', DEFAULT_IDLE_TIMEOUT)))
+
+
+app.session_interface = createSessionInterface()
+
+
+@app.template_global()
+def categorySidebar():
+    """
+    Return the rendered list of categories shown beside the catalog, with
+    the number of items of each one, which is queried and rendered once per
+    change of the categories or items and then shared by every page,
+    whoever is logged in.
+    """
+    def render():
+        categories = session.query(Category).order_by(asc(Category.name))
+        return render_template('category_list.html', categories=categories)
+    return Markup(response_cache.fragment(
+        'categorySidebar', ['categories', 'items'], render))
+
+
+def regenerateSession():
+    """
+    Give the login session a new id when the user logs in or out. Flask's
+    cookie sessions change their cookie with their data already.
+    """
+    if hasattr(login_session, 'regenerate'):
+        login_session.regenerate()
+
+
+def commitOrRollback():
+    """
+    Commit the session, or roll it back when the writes break a unique
+    constraint, such as a name another category or item already has.
+    :return: whether the writes were committed
+    """
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return False
+    return True
 
 
 def login_required(f):
@@ -43,119 +255,457 @@ def login_required(f):
     return x
 
 
+def cachedResponse(scopes):
+    """
+    Answer conditional GET requests of a view with 304 Not Modified when
+    nothing the response depends on has changed, before the view runs any
+    query, and serve anonymous requests from the response cache.
+    :param scopes: function taking the view arguments and returning the
+        names of the scopes the response depends on, see invalidate
+    """
+    def decorator(f):
+        @wraps(f)
+        def x(*args, **kwargs):
+            # pending flash messages are rendered into the page, so the
+            # response must be built afresh
+            if request.method != 'GET' or '_flashes' in login_session:
+                return f(*args, **kwargs)
+            revisions = response_cache.revisions(scopes(**kwargs))
+            # logged-in users see their own pages, don't share those
+            anonymous = 'username' not in login_session
+            etag = hashlib.sha1(('%s|%s|%s|%s' % (
+                request.full_path, login_session.get('user_id'),
+                response_cache.release,
+                revisions)).encode('utf-8')).hexdigest()
+            lastModified = max(revisions + [response_cache.release]) // 1000
+            # a later write in the same second would keep the same
+            # Last-Modified, so it is only given once that second is over
+            if lastModified >= int(time.time()):
+                lastModified = None
+
+            if isNotModified(etag, lastModified):
+                response = Response(status=304)
+            elif not anonymous:
+                response = make_response(f(*args, **kwargs))
+            else:
+                key = response_cache.key(request.full_path, revisions)
+                cached = response_cache.get(key)
+                if cached is not None:
+                    response = Response(cached.body, status=cached.status,
+                                        mimetype=cached.mimetype,
+                                        headers=cached.headers)
+                    response.headers['X-Cache'] = 'HIT'
+                else:
+                    response = make_response(f(*args, **kwargs))
+                    response.headers['X-Cache'] = 'MISS'
+                    if response.status_code == 200 and \
+                            not g.get('staleSnapshot'):
+                        storeResponse(key, response)
+
+            # a response built from a snapshot older than the revisions
+            # must not be taken for their content
+            if response.status_code in (200, 304) and \
+                    not g.get('staleSnapshot'):
+                response.set_etag(etag)
+                if lastModified is not None:
+                    response.last_modified = \
+                        datetime.datetime.utcfromtimestamp(lastModified)
+                # clients and proxies may keep the response but have to
+                # revalidate it on every use
+                response.headers['Cache-Control'] = \
+                    'public, no-cache' if anonymous else 'private, no-cache'
+            return response
+        return x
+    return decorator
+
+
+def isNotModified(etag, lastModified):
+    """
+    Check the request validators against the current ones, If-None-Match
+    takes precedence over If-Modified-Since as required by RFC 7232.
+    :param etag: current entity tag of the response
+    :param lastModified: current modification time in epoch seconds, None
+        when it can't be compared yet
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since is not None and lastModified is not None:
+        return calendar.timegm(
+            request.if_modified_since.utctimetuple()) >= lastModified
+    return False
+
+
+def storeResponse(key, response):
+    """Store a response in the cache, once a streamed one has finished"""
+    headers = [(name, value) for name, value in response.headers
+               if name.lower() not in ('content-type', 'content-length',
+                                       'set-cookie', 'x-cache')]
+
+    def store(body):
+        response_cache.set(key, CachedResponse(
+            body, response.status_code, response.mimetype, headers))
+
+    if not response.is_streamed:
+        store(response.get_data())
+        return
+
+    chunks = response.response
+
+    def tee():
+        body = []
+        for chunk in chunks:
+            body.append(chunk if isinstance(chunk, bytes)
+                        else chunk.encode('utf-8'))
+            yield chunk
+        store(b''.join(body))
+    response.response = tee()
+
+
+def invalidate(*scopes):
+    """
+    Drop the cached responses depending on the scopes, called by the write
+    routes after they commit. The scopes are 'categories' (the list of
+    categories), 'items' (the list of all items), 'category:<slug>' (a
+    category and its items) and 'item:<slug>' (one item).
+    """
+    response_cache.bump(*scopes)
+    # load the new index now rather than in the next reader, and start
+    # loading the new snapshot
+    route_index.refresh()
+    if replica is not None:
+        replica.refresh(wait=False)
+
+
+# In-memory copy of the catalog serving the public pages and JSON APIs, on
+# when CATALOG_SNAPSHOT is set
+replica = CatalogReplica(engine, response_cache) \
+    if os.environ.get('CATALOG_SNAPSHOT') else None
+
+
+def catalogSnapshot(anonymousOnly=False):
+    """
+    Return the catalog snapshot, or None when the database must be queried
+    instead. While a new snapshot loads, anonymous users are served the
+    previous one, which cachedResponse then neither caches nor validates,
+    and logged-in users, who may have just written, the database.
+    :param anonymousOnly: also return None for logged-in users
+    """
+    anonymous = 'username' not in login_session
+    if replica is None or (anonymousOnly and not anonymous):
+        return None
+    snapshot = replica.get()
+    if snapshot is not None and not replica.is_current(snapshot):
+        if not anonymous:
+            return None
+        g.staleSnapshot = True
+    return snapshot
+
+
+# slug -> id index of the categories and items the catalog URLs name,
+# reloaded after writes like the snapshot
+route_index = RouteIndex(engine, response_cache)
+
+
+def canonicalRedirect(**slugs):
+    """
+    Return a redirect to the URL of the current view with some of its
+    arguments replaced by their canonical slugs, keeping the route and the
+    query string.
+    """
+    # the rule that matched, url_for could pick another route of the view
+    url = request.script_root + request.url_rule.build(
+        dict(request.view_args, **slugs), append_unknown=False)[1]
+    if request.query_string:
+        url += '?' + request.query_string.decode('latin-1')
+    # 308 repeats the form posts with their method and body
+    return redirect(url, 301 if request.method in ('GET', 'HEAD') else 308)
+
+
+def findCategory(categorySlug, snapshot=None):
+    """
+    Return the category at categorySlug: its record when the snapshot has
+    it, its Category row otherwise. Other spellings of the slug, such as
+    the name of the category in any case, are redirected to the canonical
+    URL, and slugs of no category answered with 404.
+    :param categorySlug: the category segment of the URL
+    :param snapshot: CatalogSnapshot to look in before the database
+    """
+    slug = slugify(categorySlug)
+    if slug != categorySlug:
+        abort(canonicalRedirect(categorySlug=slug))
+    category = snapshot and snapshot.category(slug)
+    if category:
+        return category
+    for _ in range(2):
+        found = route_index.category(slug)
+        if found is None:
+            break
+        category = session.get(Category, found.id)
+        if category is not None and category.slug == slug:
+            return category
+        # renamed or deleted by another worker since the index was
+        # loaded, the next lookup asks the database
+        route_index.discard_category(slug)
+    abort(404)
+
+
+def findItem(categorySlug, itemSlug, snapshot=None):
+    """
+    Return the item at itemSlug: its record when the snapshot has it, its
+    Item row otherwise. Other spellings of the slugs, and URLs naming
+    another category than the item's, are redirected to the canonical
+    URL, and slugs of no item answered with 404.
+    :param categorySlug: the category segment of the URL
+    :param itemSlug: the item segment of the URL
+    :param snapshot: CatalogSnapshot to look in before the database
+    """
+    slug = slugify(itemSlug)
+    item = snapshot and snapshot.item(slug)
+    if item:
+        canonical = item.category.slug
+    else:
+        for _ in range(2):
+            found = route_index.item(slug)
+            if found is None:
+                abort(404)
+            item = session.get(Item, found.id)
+            if item is not None and item.slug == slug:
+                break
+            # renamed or deleted by another worker since the index was
+            # loaded, the next lookup asks the database
+            route_index.discard_item(slug)
+        else:
+            abort(404)
+        canonical = route_index.category_slug(item.category_id) or \
+            item.category.slug
+    if (canonical, slug) != (categorySlug, itemSlug):
+        abort(canonicalRedirect(categorySlug=canonical, itemSlug=slug))
+    return item
+
+
+# Local copies of the item pictures under /static/images, fetched in the
+# background when an item is added or edited; the item's pages are then
+# rendered again to link the copy instead of the remote host.
+# CATALOG_IMAGE_ALLOW_PRIVATE lets a local stand-in serve the pictures.
+image_store = ImageStore(os.environ.get(
+    'CATALOG_IMAGE_DIR', os.path.join(app.root_path, 'static', 'images')))
+image_fetcher = ImageFetcher(
+    image_store, on_stored=lambda scopes: response_cache.bump(*scopes),
+    allow_private=bool(os.environ.get('CATALOG_IMAGE_ALLOW_PRIVATE')))
+
+
+@app.template_global()
+def storedImage(url):
+    """Return the StoredImage of a picture URL, None until it is stored"""
+    return image_store.lookup(url) if url else None
+
+
+@app.route('/static/images/<path:filename>')
+def showImage(filename):
+    """
+    Serve a stored picture. Their names are digests of their content, so
+    browsers and proxies may keep them for a year without revalidating.
+    """
+    response = send_from_directory(image_store.root, filename,
+                                   max_age=CACHE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+
 # User helper functions
 
+# the identity of a user as cached by getUserInfo and getUserID, plain
+# values that stay valid after the session that loaded them is gone
+UserIdentity = namedtuple('UserIdentity', ['id', 'name', 'email', 'image'])
+
+# users looked up by id or email, entries are keyed 'id:<id>' and
+# 'email:<email>'
+user_cache = LRUCache(
+    maxsize=int(os.environ.get('CATALOG_USER_CACHE_SIZE', 1024)))
+
+
+def cacheUser(user):
+    """Store the identity of a User row under its id and email"""
+    identity = UserIdentity(user.id, user.name, user.email, user.image)
+    user_cache.set('id:%d' % user.id, identity)
+    if user.email is not None:
+        user_cache.set('email:' + user.email, identity)
+    return identity
+
+
 def createUser(login_session):
     newUser = User(name=login_session['username'],
                    email=login_session['email'],
                    image=login_session['picture'])
     session.add(newUser)
+    # the INSERT gives the id, read it before the commit expires the row
+    # instead of querying the user back
+    session.flush()
+    identity = UserIdentity(newUser.id, newUser.name, newUser.email,
+                            newUser.image)
     session.commit()
-    user = session.query(User).filter_by(email=login_session['email'])\
-        .one_or_none()
-    return user.id
+    # replace whatever was cached for this email
+    user_cache.delete('email:' + login_session['email'])
+    auditEvent('user.create', identity.email, user_id=identity.id)
+    return cacheUser(identity).id
 
 
 def getUserInfo(user_id):
-    user = session.query(User).filter_by(id=user_id).one()
-    return user
+    """
+    Return the identity of a user, from the cache when it was looked up
+    before.
+    :param user_id: id of the user
+    :return: a UserIdentity
+    """
+    identity = user_cache.get('id:%d' % user_id)
+    if identity is None:
+        identity = cacheUser(session.query(User).filter_by(id=user_id).one())
+    return identity
 
 
 def getUserID(email):
+    identity = user_cache.get('email:%s' % email)
+    if identity is not None:
+        return identity.id
     try:
         user = session.query(User).filter_by(email=email).one()
-        return user.id
+        return cacheUser(user).id
     except:
         return None
 
 
+def pageOfItems(query):
+    """
+    Return the page of items requested by the limit, cursor and before
+    query string parameters, using keyset pagination on (name, id).
+    :param query: query of items to page through, or snapshot records
+        sorted by (name, id)
+    :return: a pagination.Page
+    """
+    try:
+        limit = parse_limit(request.args.get('limit'))
+        if isinstance(query, tuple):
+            return paginate_records(query, limit,
+                                    cursor=request.args.get('cursor'),
+                                    before=request.args.get('before'))
+        return paginate(query, Item.name, Item.id, limit,
+                        cursor=request.args.get('cursor'),
+                        before=request.args.get('before'))
+    except InvalidCursor as e:
+        abort(400, str(e))
+
+
 # Show all categories on the catalog home page
 @app.route('/')
 @app.route('/catalog/')
+@cachedResponse(lambda: ['categories', 'items'])
+@metrics.budget(4)
 def showCatalog():
     """
     Show the home page of item catalog application
     Only logged-in user can create a new category.
     :return: the rendered page of catalog app
     """
-    categories = session.query(Category).order_by(asc(Category.name))
-    items = session.query(Item).order_by(asc(Item.name))
+    snapshot = catalogSnapshot(anonymousOnly=True)
+    if snapshot is not None:
+        page = pageOfItems(snapshot.items)
+    else:
+        # load each item together with its category in the same SELECT so
+        # rendering item.category.name does not fire a lazy load per row
+        page = pageOfItems(session.query(Item).options(
+            joinedload(Item.category)))
 
+    # the list of categories comes from categorySidebar in the template
     if 'username' not in login_session:
         return render_template('public_catalog.html',
-                               categories=categories,
-                               items=items)
+                               items=page.items,
+                               page=page)
     else:
-        user = getUserInfo(login_session['user_id'])
         return render_template('catalog.html',
-                               categories=categories,
-                               items=items)
+                               items=page.items,
+                               page=page)
 
 
 # Show all items of a specific category
-@app.route('/catalog/<path:categoryName>/')
-@app.route('/catalog/<path:categoryName>/items/')
-def showCategory(categoryName):
+@app.route('/catalog/<path:categorySlug>/')
+@app.route('/catalog/<path:categorySlug>/items/')
+@cachedResponse(lambda categorySlug: ['category:' + categorySlug])
+@metrics.budget(4)
+def showCategory(categorySlug):
     """
     Show the page of a specific category.
-    :param categoryName: name of the category user wants to show
+    :param categorySlug: slug of the category user wants to show
     :return:  the rendered page of category
     """
-    categories = session.query(Category).order_by(asc(Category.name))
-    category = session.query(Category).filter_by(name=categoryName).one()
-    items = session.query(Item).filter_by(category=category)\
-        .order_by(asc(Item.name)).all()
-    itemsCount = session.query(Item).filter_by(category=category).count()
-    creator = getUserInfo(category.user_id)
-    if 'username' not in login_session or creator.id != \
+    snapshot = catalogSnapshot(anonymousOnly=True)
+    category = findCategory(categorySlug, snapshot)
+    if isinstance(category, CategoryRecord):
+        categories = snapshot.categories
+        items = snapshot.category_items[category.id]
+        page = pageOfItems(items)
+        itemsCount = len(items)
+    else:
+        categories = session.query(Category).order_by(asc(Category.name))
+        page = pageOfItems(session.query(Item).filter_by(category=category))
+        itemsCount = category.item_count
+    if 'username' not in login_session or category.user_id != \
             login_session['user_id']:
         return render_template('public_category.html',
                                categories=categories,
-                               categoryName=categoryName,
-                               items=items,
+                               categoryName=category.name,
+                               categorySlug=category.slug,
+                               items=page.items,
+                               page=page,
                                count=itemsCount)
     else:
-        user = getUserInfo(login_session['user_id'])
         return render_template('category.html',
                                categories=categories,
-                               categoryName=categoryName,
-                               items=items,
+                               categoryName=category.name,
+                               categorySlug=category.slug,
+                               items=page.items,
+                               page=page,
                                count=itemsCount,
-                               user=user)
+                               user=getUserInfo(login_session['user_id']))
 
 
 # Show a specific item
-@app.route('/catalog/<path:categoryName>/<path:itemName>/')
-def showItem(categoryName, itemName):
+@app.route('/catalog/<path:categorySlug>/<path:itemSlug>/')
+@cachedResponse(lambda categorySlug, itemSlug: ['category:' + categorySlug,
+                                                'item:' + itemSlug])
+@metrics.budget(3)
+def showItem(categorySlug, itemSlug):
     """
     Show the page of a specific item.
     User sees difference page of item depending on whether he logs in.
-    :param categoryName: name of the category which the item belongs to
-    :param itemName: the name of the item
+    :param categorySlug: slug of the category which the item belongs to
+    :param itemSlug: the slug of the item
     :return: the rendered page of item
     """
-    item = session.query(Item).filter_by(name=itemName).one()
+    snapshot = catalogSnapshot(anonymousOnly=True)
+    item = findItem(categorySlug, itemSlug, snapshot)
+    if snapshot is not None:
+        categories = snapshot.categories
+    else:
+        categories = session.query(Category).order_by(asc(Category.name))
     itemPicture = item.picture
     itemDescription = item.description
-    categories = session.query(Category).order_by(asc(Category.name))
-    creator = getUserInfo(item.user_id)
-
-    if 'username' not in login_session or creator.id !=\
+    if 'username' not in login_session or item.user_id !=\
             login_session['user_id']:
         return render_template('public_item_description.html',
                                item=item,
-                               categoryName=categoryName,
+                               categorySlug=categorySlug,
                                categories=categories)
     else:
         return render_template('item.html',
                                item=item,
-                               categoryName=categoryName,
+                               categorySlug=categorySlug,
                                categories=categories)
 
 
 # Add a new category
 @app.route('/catalog/addCategory/', methods=['GET', 'POST'])
 @login_required
+@metrics.budget(5)
 def addCategory():
     """
     Show the page of adding category.
@@ -166,7 +716,12 @@ def addCategory():
         newCategory = Category(name=request.form['name'],
                                user_id=login_session['user_id'])
         session.add(newCategory)
-        session.commit()
+        if not commitOrRollback():
+            flash("A category called %s already exists!"
+                  % request.form['name'])
+            return redirect(url_for('addCategory'))
+        invalidate('categories', 'category:' + newCategory.slug)
+        auditEvent('category.create', newCategory.name)
         flash("New category %s has been successfully created!"
               % newCategory.name)
         return redirect(url_for('showCatalog'))
@@ -175,30 +730,37 @@ def addCategory():
 
 
 # Edit a category
-@app.route('/catalog/<path:categoryName>/edit/', methods=['GET', 'POST'])
+@app.route('/catalog/<path:categorySlug>/edit/', methods=['GET', 'POST'])
 @login_required
-def editCategory(categoryName):
+@metrics.budget(7)
+def editCategory(categorySlug):
     """
     Show the page of edit a category.
     A category can only be edited by the logged-in user who originally
     creates the category.
-    :param categoryName: the name of category to be edited
+    :param categorySlug: the slug of category to be edited
     :return: the rendered page of editing category
     """
-    category = session.query(Category).filter_by(name=categoryName).one()
-    creator = getUserInfo(category.user_id)
-
-    if creator.id != login_session['user_id']:
+    category = findCategory(categorySlug)
+    if category.user_id != login_session['user_id']:
         flash("You do not have the privilege to edit this category!")
         return redirect(url_for('showCatalog'))
 
     categories = session.query(Category).all()
 
     if request.method == 'POST':
+        oldName = category.name
         if request.form['name']:
             category.name = request.form['name']
         session.add(category)
-        session.commit()
+        if not commitOrRollback():
+            flash("A category called %s already exists!"
+                  % request.form['name'])
+            return redirect(url_for('editCategory',
+                                    categorySlug=categorySlug))
+        invalidate('categories', 'category:' + categorySlug,
+                   'category:' + category.slug)
+        auditEvent('category.update', oldName, name=category.name)
         flash("The category %s has been successfully edited!" % category.name)
         return redirect(url_for('showCatalog'))
     else:
@@ -207,35 +769,33 @@ def editCategory(categoryName):
 
 
 # Delete a category
-@app.route('/catalog/<path:categoryName>/delete/', methods=['GET', 'POST'])
+@app.route('/catalog/<path:categorySlug>/delete/', methods=['GET', 'POST'])
 @login_required
-def deleteCategory(categoryName):
+@metrics.budget(5)
+def deleteCategory(categorySlug):
     """
     Show the page of delete a category.
     A Category can only be deleted by the logged-in user who originally
     creates the category.
-    :param categoryName: the name of category to be deleted
+    :param categorySlug: the slug of category to be deleted
     :return: the rendered page of deleting category
     """
-    category = session.query(Category).filter_by(name=categoryName).one()
-    creator = getUserInfo(category.user_id)
-
-    # find all items belonging to this category
-    items = session.query(Item).filter_by(category=category)\
-        .order_by(asc(Item.name)).all()
-
-    if creator.id != login_session['user_id']:
+    category = findCategory(categorySlug)
+    if category.user_id != login_session['user_id']:
         flash("You do not have the privilege to delete this category!")
         return redirect(url_for('showCatalog'))
 
     if request.method == 'POST':
-        # before deleting the category, first delete all items in the category
-        for item in items:
-            session.delete(item)
-            session.commit()
-        # delete the category
+        # delete the items of the category with one statement, in the same
+        # transaction as the category so a failure deletes nothing.
+        # Databases created with ON DELETE CASCADE would do it on their own,
+        # older ones lack the constraint.
+        session.query(Item).filter_by(category_id=category.id)\
+            .delete(synchronize_session=False)
         session.delete(category)
         session.commit()
+        invalidate('categories', 'items', 'category:' + categorySlug)
+        auditEvent('category.delete', category.name)
         flash("The category %s has been successfully deleted" % category.name)
         return redirect(url_for('showCatalog'))
     else:
@@ -246,6 +806,7 @@ def deleteCategory(categoryName):
 # Add a new item
 @app.route('/catalog/addItem/', methods=['GET', 'POST'])
 @login_required
+@metrics.budget(8)
 def addItem():
     """
     Show the page of creating a new item.
@@ -255,108 +816,180 @@ def addItem():
     categories = session.query(Category).all()
     if request.method == 'POST':
         category = session.query(Category).filter_by(
-            name=request.form['category']).one()
+            name=request.form['category']).first()
+        if category is None:
+            flash("No category called %s!" % request.form['category'])
+            return redirect(url_for('addItem'))
         newItem = Item(name=request.form['name'],
                        description=request.form['description'],
                        picture=request.form['picture'],
                        category=category,
                        user_id=login_session['user_id'])
         session.add(newItem)
-        session.commit()
+        if not commitOrRollback():
+            flash("An item called %s already exists!" % request.form['name'])
+            return redirect(url_for('addItem'))
+        invalidate('items', 'category:' + category.slug,
+                   'item:' + newItem.slug)
+        image_fetcher.submit(newItem.picture, ['item:' + newItem.slug])
+        auditEvent('item.create', newItem.name, category=category.name)
         flash("The item %s has been successfully added!" % newItem.name)
-        return redirect(url_for('showCategory', categoryName=category.name))
+        return redirect(url_for('showCategory', categorySlug=category.slug))
     else:
         return render_template('addItem.html',
                                categories=categories)
 
 
 # Edit an item
-@app.route('/catalog/<path:categoryName>/<path:itemName>/edit/',
+@app.route('/catalog/<path:categorySlug>/<path:itemSlug>/edit/',
            methods=['GET', 'POST'])
 @login_required
-def editItem(categoryName, itemName):
+@metrics.budget(8)
+def editItem(categorySlug, itemSlug):
     """
     Show the page of editing an item.
     An item can only be edited by the logged-in user
     who originally creates the item.
-    :param categoryName: the name of category which the edited item belongs to
-    :param itemName: the name of item to be edited
+    :param categorySlug: the slug of category which the edited item belongs to
+    :param itemSlug: the slug of item to be edited
     :return: the rendered page of editing an item
     """
-    item = session.query(Item).filter_by(name=itemName).one()
+    item = findItem(categorySlug, itemSlug)
     categories = session.query(Category).all()
-    creator = getUserInfo(item.user_id)
-
-    if creator.id != login_session['user_id']:
+    if item.user_id != login_session['user_id']:
         flash("You do not have the privilege to edit this item!")
         return redirect(url_for('showCatalog'))
 
     if request.method == 'POST':
+        oldName = item.name
+        # looked up before the changes, which its query would flush
+        if request.form['category']:
+            category = session.query(Category).filter_by(
+                name=request.form['category']).first()
+            if category is None:
+                flash("No category called %s!" % request.form['category'])
+                return redirect(url_for('editItem',
+                                        categorySlug=categorySlug,
+                                        itemSlug=itemSlug))
+            item.category = category
         if request.form['name']:
             item.name = request.form['name']
         if request.form['description']:
             item.description = request.form['description']
         if request.form['picture']:
             item.picture = request.form['picture']
-        if request.form['category']:
-            category = session.query(Category).filter_by(
-                name=request.form['category']).one()
-            item.category = category
         session.add(item)
-        session.commit()
+        if not commitOrRollback():
+            flash("An item called %s already exists!" % request.form['name'])
+            return redirect(url_for('editItem', categorySlug=categorySlug,
+                                    itemSlug=itemSlug))
+        invalidate('items', 'category:' + categorySlug,
+                   'category:' + item.category.slug, 'item:' + itemSlug,
+                   'item:' + item.slug)
+        if request.form['picture']:
+            image_fetcher.submit(item.picture, ['item:' + item.slug])
+        auditEvent('item.update', oldName, **dict(
+            (field, request.form[field]) for field in
+            ('name', 'description', 'picture', 'category')
+            if request.form[field]))
         flash("The item %s has been successfully edited!" % item.name)
         return redirect(url_for('showCategory',
-                                categoryName=item.category.name))
+                                categorySlug=item.category.slug))
     else:
         return render_template('editItem.html',
                                item=item,
-                               categories=categories,
-                               categoryName=categoryName)
+                               categories=categories)
 
 
 # Delete an item
-@app.route('/catalog/<path:categoryName>/<path:itemName>/delete/',
+@app.route('/catalog/<path:categorySlug>/<path:itemSlug>/delete/',
            methods=['GET', 'POST'])
 @login_required
-def deleteItem(categoryName, itemName):
+@metrics.budget(6)
+def deleteItem(categorySlug, itemSlug):
     """
     Show the page of deleting an item.
     An item can only be deleted by the logged-in user who originally
     creates the item.
-    :param categoryName: the name of category which the item belongs to
-    :param itemName: the name of item to be deleted
+    :param categorySlug: the slug of category which the item belongs to
+    :param itemSlug: the slug of item to be deleted
     :return: the rendered page of deleting an item
     """
-    item = session.query(Item).filter_by(name=itemName).one()
-    category = session.query(Category).filter_by(name=categoryName).one()
-    creator = getUserInfo(category.user_id)
-
-    if creator.id != login_session['user_id']:
+    item = findItem(categorySlug, itemSlug)
+    category = item.category
+    if category.user_id != login_session['user_id']:
         flash("You do not have the privilege to delete this item!")
         return redirect(url_for('showCatalog'))
 
     if request.method == 'POST':
+        itemCategoryName = category.name
         session.delete(item)
         session.commit()
+        invalidate('items', 'category:' + categorySlug,
+                   'item:' + itemSlug)
+        auditEvent('item.delete', item.name, category=itemCategoryName)
         flash("The item %s has been successfully deleted" % item.name)
         return redirect(url_for('showCategory',
-                                categoryName=category.name))
+                                categorySlug=categorySlug))
     else:
         return render_template('deleteItem.html',
                                item=item)
 
 
+def searchFromRequest():
+    """
+    Run the item search described by the q, category, limit, cursor and
+    before query string parameters.
+    :return: a pagination.Page of search.SearchResult
+    """
+    categoryId = None
+    if request.args.get('category'):
+        category = session.query(Category).filter_by(
+            name=request.args['category']).one_or_none()
+        if category is None:
+            return Page([], None, None)
+        categoryId = category.id
+    try:
+        return search_items(session, request.args.get('q', ''), categoryId,
+                            parse_limit(request.args.get('limit')),
+                            cursor=request.args.get('cursor'),
+                            before=request.args.get('before'))
+    except InvalidCursor as e:
+        abort(400, str(e))
+
+
+# Search items
+@app.route('/catalog/search')
+@cachedResponse(lambda: ['categories', 'items'])
+@metrics.budget(3)
+def showSearch():
+    """
+    Show the page of items matching a search, best matches first.
+    :return: the rendered page of search results
+    """
+    page = searchFromRequest()
+    categories = session.query(Category).order_by(asc(Category.name)).all()
+    return render_template('search.html',
+                           results=page.items,
+                           categories=categories,
+                           query=request.args.get('q', ''),
+                           categoryName=request.args.get('category', ''),
+                           nextCursor=page.next_cursor,
+                           prevCursor=page.prev_cursor)
+
+
 # Create anti-forgery state token
 @app.route('/login')
 def showLogin():
     state = ''.join(random.choice(string.ascii_uppercase + string.digits)
-                    for x in xrange(32))
+                    for x in range(32))
     login_session['state'] = state
     return render_template('login.html', STATE=state)
 
 
 # Create Google Sign in
 @app.route('/gconnect', methods=['POST'])
+@metrics.budget(4)
 def gconnect():
     # Validate state token
     if request.args.get('state') != login_session['state']:
@@ -369,23 +1002,23 @@ def gconnect():
     code = request.data
 
     try:
-        # Upgrade the authorization code into a credentials object
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
-    except FlowExchangeError:
+        # Upgrade the authorization code into an access token
+        access_token, id_token = run_concurrently(
+            (google.exchange_code, code), deadline=LOGIN_DEADLINE)[0]
+    except ProviderError:
         response = make_response(json.dumps(
             'Failed to upgrade the authorization code.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    # Check that the access token is valid.
-    access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token)
-    h = httplib2.Http()
-
-    result = json.loads(h.request(url, 'GET')[1].decode("utf-8"))
+    # Check that the access token is valid, and get the user info in the
+    # meantime since it only needs the token too.
+    try:
+        result, data = run_concurrently(
+            (google.token_info, access_token),
+            (google.user_info, access_token), deadline=LOGIN_DEADLINE)
+    except ProviderError as e:
+        result = {'error': str(e)}
 
     # If there was an error in the access token info, abort.
     if result.get('error') is not None:
@@ -394,7 +1027,7 @@ def gconnect():
         return response
 
     # Verify that the access token is used for the intended user.
-    gplus_id = credentials.id_token['sub']
+    gplus_id = id_token['sub']
 
     if result['user_id'] != gplus_id:
         response = make_response(
@@ -419,17 +1052,13 @@ def gconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
 
+    # a new session id for the logged-in user
+    regenerateSession()
+
     # Store the access token in the session for later use.
     login_session['access_token'] = access_token
     login_session['gplus_id'] = gplus_id
 
-    # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-
-    data = answer.json()
-
     login_session['username'] = data['name']
     login_session['picture'] = data['picture']
     login_session['email'] = data['email']
@@ -470,12 +1099,13 @@ def gdisconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=%s' \
-          % access_token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
+    try:
+        revoked = run_concurrently((google.revoke, access_token),
+                                   deadline=LOGIN_DEADLINE)[0]
+    except ProviderError:
+        revoked = False
 
-    if result['status'] == '200':
+    if revoked:
         response = make_response(json.dumps('Successfully disconnected.'),
                                  200)
         response.headers['Content-Type'] = 'application/json'
@@ -489,6 +1119,7 @@ def gdisconnect():
 
 # Add Facebook Sign in
 @app.route('/fbconnect', methods=['POST'])
+@metrics.budget(4)
 def fbconnect():
     # Validate anti-forgery state token
     if request.args.get('state') != login_session['state']:
@@ -498,27 +1129,23 @@ def fbconnect():
 
     access_token = request.data
 
-    app_id = json.loads(open('fb_client_secrets.json', 'r')
-                        .read())['web']['app_id']
-    app_secret = json.loads(open('fb_client_secrets.json', 'r').
-                            read())['web']['app_secret']
-    url = 'https://graph.facebook.com/oauth/access_token?grant_type=' \
-          'fb_exchange_token&client_id=%s&client_secret=%s&' \
-          'fb_exchange_token=%s' % (app_id, app_secret, access_token)
-    h = httplib2.Http()
-    result = json.loads((h.request(url, 'GET')[1]).decode('utf-8'))
-
-    # Use token to get user info from API
-    userinfo_url = "https://graph.facebook.com/v2.8/me"
-
-    token = result.get('access_token')
+    try:
+        # Swap the short-lived token for a long-lived one and get the
+        # user info and picture with it at the same time
+        token = run_concurrently((facebook.exchange_token, access_token),
+                                 deadline=LOGIN_DEADLINE)[0]
+        data, picture = run_concurrently(
+            (facebook.me, token), (facebook.picture_url, token),
+            deadline=LOGIN_DEADLINE)
+    except ProviderError:
+        response = make_response(json.dumps(
+            'Failed to upgrade the access token.'), 401)
+        response.headers['Content-Type'] = 'application/json'
+        return response
 
-    url = 'https://graph.facebook.com/v2.8/me?access_token=%s&fields=' \
-          'name,id,email' % token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
+    # a new session id for the logged-in user
+    regenerateSession()
 
-    data = json.loads(result)
     login_session['provider'] = 'facebook'
     login_session['username'] = data['name']
     login_session['email'] = data['email']
@@ -527,14 +1154,7 @@ def fbconnect():
     # The token must be stored in the login_session in order to properly logout
     login_session['access_token'] = token
 
-    # Get user picture
-    url = 'https://graph.facebook.com/v2.8/me/picture?access_token=%s&' \
-          'redirect=0&height=200&width=200' % token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    data = json.loads(result)
-
-    login_session['picture'] = data['data']['url']
+    login_session['picture'] = picture
 
     # see if user exists
     user_id = getUserID(login_session['email'])
@@ -563,11 +1183,11 @@ def fbdisconnect():
 
     # The access token must me included to successfully logout
     access_token = login_session['access_token']
-    url = 'https://graph.facebook.com/%s/permissions?access_token=%s' \
-          % (facebook_id, access_token)
-
-    h = httplib2.Http()
-    result = h.request(url, 'DELETE')[1]
+    try:
+        run_concurrently((facebook.revoke, facebook_id, access_token),
+                         deadline=LOGIN_DEADLINE)
+    except ProviderError:
+        pass
     return "you have been logged out"
 
 
@@ -589,6 +1209,7 @@ def disconnect():
         del login_session['picture']
         del login_session['user_id']
         del login_session['provider']
+        regenerateSession()
         flash("You have successfully been logged out.")
         return redirect(url_for('showCatalog'))
     else:
@@ -599,44 +1220,195 @@ def disconnect():
 # JSON APIs to view catalog Information
 
 
-@app.route('/catalog/JSON')
-def showCategoriesJSON():
-    """return JSON for all categories"""
-    categories = session.query(Category).all()
-    category_dict = [cat.serialize for cat in categories]
-    for cat in range(len(category_dict)):
-        items = [item.serialize for item in session.query(Item)
-                 .filter_by(category_id=category_dict[cat]["id"]).all()]
+@app.route('/cache/stats')
+def showCacheStats():
+    """return JSON with the hit and miss counters of the response cache"""
+    return jsonify(response_cache.stats())
+
+
+@app.route('/metrics')
+def showMetrics():
+    """return the request metrics in the Prometheus text format"""
+    stats = response_cache.stats()
+    queued = write_behind.stats()
+    return Response(metrics.render([
+        ('catalog_cache_hits_total', 'counter',
+         'Responses served from the response cache', stats['hits']),
+        ('catalog_cache_misses_total', 'counter',
+         'Cacheable responses that had to be rendered', stats['misses']),
+        ('catalog_write_behind_queue_depth', 'gauge',
+         'Rows waiting in the write-behind queue', queued['depth']),
+        ('catalog_write_behind_queue_capacity', 'gauge',
+         'Rows the write-behind queue holds before dropping new ones',
+         queued['capacity']),
+        ('catalog_write_behind_rows_written_total', 'counter',
+         'Rows inserted by the write-behind thread', queued['written']),
+        ('catalog_write_behind_rows_dropped_total', 'counter',
+         'Rows dropped as the write-behind queue was full',
+         queued['dropped']),
+        ('catalog_write_behind_rows_failed_total', 'counter',
+         'Rows dropped as their insert failed', queued['failed']),
+        ('catalog_write_behind_commits_total', 'counter',
+         'Group commits of the write-behind thread', queued['commits'])]),
+        mimetype='text/plain; version=0.0.4')
+
+
+def streamJSONList(key, rows):
+    """
+    Stream {key: [rows...]} piece by piece, formatted exactly as jsonify
+    would format the same object, so the whole list is never held in memory.
+    :param key: name of the top level key
+    :param rows: iterable of JSON serializable objects
+    :return: a generator of response chunks
+    """
+    pretty = app.config.get('JSONIFY_PRETTYPRINT_REGULAR') or app.debug
+    if pretty:
+        opening, separator, closing = '{\n  "%s": [\n' % key, ',\n', \
+            '\n  ]\n}\n'
+    else:
+        opening, separator, closing = '{"%s":[' % key, ',', ']}\n'
+    first = True
+    for row in rows:
+        if pretty:
+            chunk = json.dumps(row, indent=2, sort_keys=True)
+            chunk = '\n'.join('    ' + line for line in chunk.split('\n'))
+        else:
+            chunk = json.dumps(row, separators=(',', ':'), sort_keys=True)
+        if first:
+            yield opening + chunk
+            first = False
+        else:
+            yield separator + chunk
+    if first:
+        # no rows at all, mirror jsonify's rendering of an empty list
+        yield '{\n  "%s": []\n}\n' % key if pretty else '{"%s":[]}\n' % key
+    else:
+        yield closing
+
+
+def iterCategoriesWithItems():
+    """
+    Yield the serialized categories with their items nested under "Item",
+    built from one ordered outer join instead of one query per category.
+    """
+    rows = session.query(Category, Item)\
+        .outerjoin(Item, Item.category_id == Category.id)\
+        .order_by(asc(Category.id), asc(Item.id))\
+        .yield_per(1000)
+    for category, group in groupby(rows, key=lambda row: row[0]):
+        category_dict = category.serialize
+        items = [item.serialize for _, item in group if item is not None]
         if items:
-            category_dict[cat]["Item"] = items
-    return jsonify(Category=category_dict)
+            category_dict["Item"] = items
+        yield category_dict
 
 
-@app.route('/catalog/<path:categoryName>/JSON')
-@app.route('/catalog/<path:categoryName>/items/JSON')
-def showCategoryJSON(categoryName):
-    """return JSON for a specific category"""
-    category = session.query(Category).filter_by(name=categoryName).one()
-    items = session.query(Item).filter_by(category_id=category.id).all()
-    return jsonify(items=[item.serialize for item in items])
+@app.route('/catalog/JSON')
+@cachedResponse(lambda: ['categories', 'items'])
+@metrics.budget(3)
+def showCategoriesJSON():
+    """return JSON for all categories"""
+    snapshot = catalogSnapshot()
+    rows = snapshot.iter_categories_with_items() if snapshot is not None \
+        else iterCategoriesWithItems()
+    return Response(stream_with_context(streamJSONList('Category', rows)),
+                    mimetype='application/json')
+
+
+@app.route('/catalog/<path:categorySlug>/JSON')
+@app.route('/catalog/<path:categorySlug>/items/JSON')
+@cachedResponse(lambda categorySlug: ['category:' + categorySlug])
+@metrics.budget(4)
+def showCategoryJSON(categorySlug):
+    """return JSON for one page of the items of a specific category"""
+    snapshot = catalogSnapshot()
+    category = findCategory(categorySlug, snapshot)
+    if isinstance(category, CategoryRecord):
+        page = pageOfItems(snapshot.category_items[category.id])
+    else:
+        page = pageOfItems(session.query(Item)
+                           .filter_by(category_id=category.id))
+    return jsonify(items=[item.serialize for item in page.items],
+                   next_cursor=page.next_cursor)
 
 
 @app.route('/catalog/items/JSON')
+@cachedResponse(lambda: ['items'])
+@metrics.budget(3)
 def showItemsJSON():
-    """return JSON for all items"""
-    items = session.query(Item).all()
-    return jsonify(items=[item.serialize for item in items])
-
-
-@app.route('/catalog/<path:categoryName>/<path:itemName>/JSON')
-def showItemJSON(categoryName, itemName):
+    """return JSON for one page of all items"""
+    snapshot = catalogSnapshot()
+    page = pageOfItems(snapshot.items if snapshot is not None
+                       else session.query(Item))
+    return jsonify(items=[item.serialize for item in page.items],
+                   next_cursor=page.next_cursor)
+
+
+@app.route('/catalog/items/JSON', methods=['POST'])
+# at most MAX_OPERATIONS operations: chunked lookups of up to 1000
+# categories, 2000 items and the slugs of 1000 names, one UPDATE per set
+# of changed columns, the DELETE, the INSERT and the lookup of the new
+# ids, and a snapshot reload
+@metrics.budget(31)
+def batchItemsJSON():
+    """
+    Create, update and delete many items in one transaction, see batch.py.
+    The body is {"operations": [...]}; either all of them are applied, or
+    none and the result of each one tells why.
+    :return: JSON with the result of each operation
+    """
+    if 'username' not in login_session:
+        return jsonify(error='Login required'), 401
+    # a JSON body can't be sent by a form of another site, which keeps
+    # the endpoint safe from cross-site requests
+    body = request.get_json(silent=True) if request.is_json else None
+    if not isinstance(body, dict):
+        return jsonify(error='Expected a JSON object'), 400
+    try:
+        batch = apply_batch(session, body.get('operations'),
+                            login_session['user_id'])
+        if batch.ok:
+            session.commit()
+    except InvalidBatch as e:
+        return jsonify(error=str(e)), 400
+    except IntegrityError:
+        session.rollback()
+        return jsonify(error='The batch conflicts with items written '
+                             'meanwhile or renames an item to the name '
+                             'another one gives up, nothing was applied'), 409
+    if not batch.ok:
+        return jsonify(applied=False, results=batch.results), 400
+    invalidate(*batch.scopes)
+    for picture, itemSlug in batch.pictures:
+        image_fetcher.submit(picture, ['item:' + itemSlug])
+    for operation in body['operations']:
+        auditEvent('item.' + operation['op'], batchTarget(operation),
+                   batch=True,
+                   **dict((field, operation[field]) for field in FIELDS
+                          if operation.get(field)))
+    return jsonify(applied=True, results=batch.results)
+
+
+@app.route('/catalog/<path:categorySlug>/<path:itemSlug>/JSON')
+@cachedResponse(lambda categorySlug, itemSlug: ['category:' + categorySlug,
+                                                'item:' + itemSlug])
+@metrics.budget(4)
+def showItemJSON(categorySlug, itemSlug):
     """return JSON for a specific item"""
-    category = session.query(Category).filter_by(name=categoryName).one()
-    item = session.query(Item).filter_by(name=itemName,
-                                         category_id=category.id).one()
+    item = findItem(categorySlug, itemSlug, catalogSnapshot())
     return jsonify(item=[item.serialize])
 
 
+@app.route('/catalog/search/JSON')
+@cachedResponse(lambda: ['categories', 'items'])
+@metrics.budget(3)
+def showSearchJSON():
+    """return JSON for one page of the items matching a search"""
+    page = searchFromRequest()
+    return jsonify(items=[result.serialize for result in page.items],
+                   next_cursor=page.next_cursor)
+
+
 if __name__ == '__main__':
     app.secret_key = 'super_secret_key'
     app.debug = True
@@ -0,0 +1,181 @@
+"""
+Write-behind queue for rows nobody reads back in the request writing them,
+such as the audit log of catalog edits.
+
+Requests put their rows on a bounded in-memory queue and return at once; a
+background thread takes whatever has accumulated, waiting up to
+flush_interval seconds for more, and inserts it with one executemany per
+table in a single transaction. So a burst of edits costs one commit instead
+of one per row, and the request never waits on the database for them.
+
+The queue never blocks a request: when it is full, because the database
+is down or slower than the writes, further rows are dropped and counted.
+Rows whose insert fails are dropped and counted as well. The queue is
+drained when the process exits normally, and flush() waits for the rows
+queued so far, for tests and scripts.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from sqlalchemy import insert
+
+log = logging.getLogger('catalog.writebehind')
+
+# rows held in memory before new ones are dropped
+DEFAULT_QUEUE_SIZE = 10000
+# seconds the writer waits for more rows before committing a batch
+DEFAULT_FLUSH_INTERVAL = 1.0
+# rows inserted by one transaction
+MAX_BATCH = 1000
+# seconds to wait for the queue to drain when the process exits
+SHUTDOWN_TIMEOUT = 10
+
+# tells the writer to commit what it holds now
+_FLUSH = object()
+
+
+class WriteBehindQueue(object):
+    """Inserts queued rows from a background thread in group commits"""
+
+    def __init__(self, engine, maxsize=DEFAULT_QUEUE_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL):
+        """
+        :param engine: engine of the database the rows go to
+        :param maxsize: rows held before new ones are dropped
+        :param flush_interval: seconds a row may wait for others to be
+            committed with
+        """
+        self.engine = engine
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.commits = 0
+        atexit.register(self.close)
+
+    def _start_writer(self):
+        """Start the writer thread of this process, after a fork too"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def put(self, table, row):
+        """
+        Queue a row for insertion and return at once.
+        :param table: Table, or mapped class, to insert the row into
+        :param row: dict of column values
+        :return: False when the row was dropped as the queue is full or
+            closed
+        """
+        if not self._closed:
+            self._start_writer()
+            try:
+                self._queue.put_nowait((table, row))
+            except queue.Full:
+                pass
+            else:
+                self._count('queued', 1)
+                return True
+        self._count('dropped', 1)
+        return False
+
+    def depth(self):
+        """Return the number of rows waiting to be written"""
+        return self._queue.qsize()
+
+    def flush(self, timeout=None):
+        """
+        Wait until the rows queued so far are written or dropped.
+        :param timeout: seconds to wait at most, None for ever
+        :return: False when the timeout expired first
+        """
+        if self._thread is None or not self._thread.is_alive():
+            return self._queue.unfinished_tasks == 0
+        done = threading.Event()
+        started = time.time()
+        try:
+            # waits while the queue is full, the writer is emptying it
+            self._queue.put((_FLUSH, done), timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(None if timeout is None
+                         else max(timeout - (time.time() - started), 0))
+
+    def close(self, timeout=SHUTDOWN_TIMEOUT):
+        """Stop accepting rows and write the queued ones"""
+        self._closed = True
+        self.flush(timeout)
+
+    def _run(self):
+        while True:
+            table, row = self._queue.get()
+            batch = []
+            waiting = []
+            deadline = time.time() + self.flush_interval
+            # gather what arrives until the interval is over, a flush is
+            # asked for or the batch is full
+            while True:
+                if table is _FLUSH:
+                    waiting.append(row)
+                    break
+                batch.append((table, row))
+                if len(batch) >= MAX_BATCH:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    table, row = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            try:
+                if batch:
+                    self._write(batch)
+            finally:
+                for _ in range(len(batch) + len(waiting)):
+                    self._queue.task_done()
+                for done in waiting:
+                    done.set()
+
+    def _write(self, batch):
+        """Insert a batch with one statement per table and commit it"""
+        tables = {}
+        for table, row in batch:
+            tables.setdefault(table, []).append(row)
+        try:
+            with self.engine.begin() as connection:
+                for table, rows in tables.items():
+                    connection.execute(insert(table), rows)
+        except Exception:
+            log.exception('Dropped %d queued rows', len(batch))
+            self._count('failed', len(batch))
+        else:
+            self._count('written', len(batch))
+            self._count('commits', 1)
+
+    def _count(self, counter, n):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def stats(self):
+        """Return the counters of the queue"""
+        with self._lock:
+            return {'depth': self.depth(), 'capacity': self.maxsize,
+                    'queued': self.queued, 'written': self.written,
+                    'dropped': self.dropped, 'failed': self.failed,
+                    'commits': self.commits}